@@ -23,18 +23,22 @@ from Queue import Queue
 import json
 
 from twisted.application import internet, service
+from twisted.internet import reactor
 
 from broker import MessageBroker
 from fileserver import Fileserver
 from monitor import WebMonitor
 from endpoint import EndpointService
+import shard
 
 
 class PyserverApp:
     '''Application starter.'''
 
-    def __init__ (self, argv):
+    def __init__ (self, argv, worker = 0):
         self.application = service.Application("Pyserver")
+        '''Index of this C2S worker process (0 is the main process).'''
+        self.worker = worker
         self._cfgfile = 'server.conf'
         if 'config' in argv:
             self._cfgfile = argv['config']
@@ -48,7 +52,16 @@ class PyserverApp:
         log.init(self.config)
 
         # broker service
-        self.broker = MessageBroker(self.application, self.config)
+        self.broker = MessageBroker(self.application, self.config, self.worker)
+
+        workers = self.config['server']['c2s.workers']
+        if workers > 1:
+            if self.worker > 0:
+                # other services run in the main process only
+                return self.application
+
+            reactor.callWhenRunning(self._spawn_workers, workers)
+
         # fileserver service
         if self.config['server']['fileserver.enabled']:
             self.fileserver = Fileserver(self.application, self.config, self.broker)
@@ -59,6 +72,12 @@ class PyserverApp:
 
         # endpoint service
         if self.config['server']['endpoint.enabled']:
-            self.monitor = EndpointService(self.application, self.config, self.broker)
+            if workers > 1:
+                log.warn("HTTP endpoint is not supported with multiple c2s workers - disabled")
+            else:
+                self.monitor = EndpointService(self.application, self.config, self.broker)
 
         return self.application
+
+    def _spawn_workers(self, workers):
+        shard.spawn_workers(self._cfgfile, workers, self.broker.c2s_port.fileno())
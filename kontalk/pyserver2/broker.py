@@ -18,20 +18,22 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import os, socket, time
+import os, sys, socket, time
 from datetime import datetime
+from collections import OrderedDict
 from Queue import Queue
 import pickle, shelve
 import kontalklib.logging as log
 
 from twisted.application import internet, service
-from twisted.internet import task, reactor
+from twisted.internet import defer, task, reactor
 
 # local imports
-import version, storage, usercache, keyring
+import version, storage, usercache, keyring, dbpool, shard, purger, crypto, schema
+from msgid import MessageIdGenerator
+from cache import ExpiringCache
 from channels import *
 from broker_twisted import *
-from txrdq.rdq import ResizableDispatchQueue
 
 from kontalklib import database, utils
 
@@ -59,24 +61,66 @@ USER_EVENT_MASKS = {
 class MessageBroker(service.Service):
     '''Message broker connection manager.'''
 
-    def __init__(self, application, config):
+    def __init__(self, application, config, worker = 0):
         self.setServiceParent(application)
         self.config = config
         self.fingerprint = str(config['server']['fingerprint'])
+        '''Index of this C2S worker process.'''
+        self.worker = worker
+        '''Channel to the other worker processes (multi-process mode only).'''
+        self.shards = None
+        '''Message ID generator.'''
+        self._msgid = MessageIdGenerator(self.fingerprint, worker)
+        '''Server-to-server requests channel (main process only).'''
+        self.network = None
         self.ts_start = time.time()
         '''Map of the queue consumers.
         Queues in this map will contain the collection of workers for specific userids.'''
         self._consumers = {}
         '''Map of channel callbacks.'''
         self._callbacks = {}
-        '''Map of presence subscriptions.'''
+        '''Map of presence subscriptions: uhash: {resource: {subscriber: events}}.'''
         self._presence = {}
-        '''Map of reverse-presence subscriptions.'''
+        '''Map of reverse-presence subscriptions: subscriber: set(uid).'''
         self._presence_lists = {}
         '''The push notifications manager.'''
         self.push_manager = None
         '''Hide status.'''
         self._hidden = set()
+        '''Map of delivered messages not yet written to storage, waiting for ack.'''
+        self._pending_ack = {}
+        '''Delivery state of generic messages: msgid: {resource: acknowledged}, also kept in storage once stored.'''
+        self._deliveries = {}
+        '''Generic messages delivered to a resource and not acknowledged yet, by specific userid.'''
+        self._delivered_to = {}
+        '''Map of storage writes in progress.'''
+        self._writes = {}
+        '''Seconds a delivered message can wait for ack before being stored.'''
+        self._ack_grace = self.config['broker']['write_behind.delay']
+        '''Map of receipt entries waiting to be sent, by (sender, recipient).'''
+        self._receipts = {}
+        '''Seconds receipt entries are kept to be merged before sending.'''
+        self._receipt_delay = self.config['broker']['receipts.delay']
+        '''Messages published since the last reactor iteration.'''
+        self._dispatch_queue = []
+        self._dispatch_call = None
+        '''Messages to be written to storage at the end of the current dispatch.'''
+        self._dispatch_spool = None
+        self._dispatch_stats = { 'batches' : 0, 'messages' : 0, 'last_batch' : 0, 'max_batch' : 0 }
+        '''Map of offline presence events being held, by userid.'''
+        self._offline_pending = {}
+        '''Seconds an offline presence event is held waiting for a reconnection.'''
+        self._offline_delay = self.config['broker']['presence_offline.delay']
+        '''Last status message broadcasted, by userid.'''
+        self._last_status = {}
+        self._presence_stats = { 'sent' : 0, 'offline_cancelled' : 0, 'online_suppressed' : 0, 'status_suppressed' : 0 }
+        '''Database purgers, by name.'''
+        self._purgers = {}
+        '''Remote lookup results, by (fingerprint, userid): list of entries found.'''
+        self._lookup_found = ExpiringCache(self.config['broker']['lookup_cache.ttl'], self.config['broker']['lookup_cache.size'])
+        '''Users not found on a server, by (fingerprint, userid).'''
+        self._lookup_missing = ExpiringCache(self.config['broker']['lookup_cache.negative_ttl'], self.config['broker']['lookup_cache.size'])
+        self._lookup_stats = { 'hits' : 0, 'negative_hits' : 0, 'requests' : 0, 'partial' : 0 }
 
     def print_version(self):
         log.info("%s version %s" % (version.NAME, version.VERSION))
@@ -91,6 +135,14 @@ class MessageBroker(service.Service):
         # TODO network count
         return len(self._callbacks)
 
+    def local_users(self):
+        '''Returns the userids of the consumers registered in this process.'''
+        return self._callbacks.keys()
+
+    def hidden_users(self):
+        '''Returns the userids hiding their presence in this process.'''
+        return list(self._hidden)
+
     def startService(self):
         service.Service.startService(self)
         self.print_version()
@@ -98,28 +150,69 @@ class MessageBroker(service.Service):
 
         self.storage = storage.__dict__[self.config['broker']['storage'][0]](*self.config['broker']['storage'][1:])
         self.usercache = usercache.__dict__[self.config['broker']['usercache'][0]](*self.config['broker']['usercache'][1:])
+        if self.config['broker']['usercache.cache_ttl'] > 0:
+            self.usercache = usercache.CachedUsercache(self.usercache,
+                self.config['broker']['usercache.cache_ttl'],
+                self.config['broker']['usercache.cache_size'])
 
         # estabilish a connection to the database
         self.db = database.connect_config(self.config)
+        # other worker processes are spawned after this
+        if self.worker == 0:
+            schema.upgrade(self.db)
+        # pooled connections for storage and usercache queries
+        self.dbpool = dbpool.connect_config(self.config)
         # datasource it will not be used if not needed
-        self.storage.set_datasource(self.db)
-        self.usercache.set_datasource(self.db)
+        self.storage.set_datasource(self.dbpool)
+        self.usercache.set_datasource(self.dbpool)
 
         # setup keyring
         sdb = database.servers(self.db)
-        self.keyring = keyring.Keyring(sdb, self.fingerprint)
+        self.keyring = keyring.Keyring(sdb, self.fingerprint,
+            self.config['broker']['token_cache.ttl'],
+            self.config['broker']['token_cache.size'])
+        # GPG operations worker pool
+        self.crypto = crypto.CryptoPool(self.config['broker']['crypto.workers'])
+        self.crypto.start()
 
         # create push notifications manager
         if self.config['server']['push_notifications']:
             log.debug("enabling push notifications support")
             from push_notifications import PushNotifications
-            self.push_manager = PushNotifications(self.config, self.db)
+            self.push_manager = PushNotifications(self.config, self.dbpool)
 
         # create listening service for clients
-        factory = InternalServerFactory(C2SServerProtocol, C2SChannel, self, self.config)
-        c2s_service = internet.TCPServer(port=self.config['server']['c2s.bind'][1],
-            factory=factory, interface=self.config['server']['c2s.bind'][0])
-        c2s_service.setServiceParent(self.parent)
+        self.c2s_factory = InternalServerFactory(C2SServerProtocol, C2SChannel, self, self.config)
+        workers = self.config['server']['c2s.workers']
+        if workers > 1:
+            # users are sharded across worker processes sharing the c2s socket
+            self.shards = shard.ShardLink(self, self.worker, workers, self.config['server']['c2s.ipc_socket'])
+            self.shards.listen()
+            self.shards.sync()
+            if self.worker > 0:
+                self.c2s_port = reactor.adoptStreamPort(shard.C2S_FD, socket.AF_INET, self.c2s_factory)
+            else:
+                self.c2s_port = reactor.listenTCP(self.config['server']['c2s.bind'][1],
+                    self.c2s_factory, interface=self.config['server']['c2s.bind'][0])
+        else:
+            c2s_service = internet.TCPServer(port=self.config['server']['c2s.bind'][1],
+                factory=self.c2s_factory, interface=self.config['server']['c2s.bind'][0])
+            c2s_service.setServiceParent(self.parent)
+
+        # the mailboxes of all the shards are in the same database
+        if self.push_manager and self.worker == 0:
+            self._push_init()
+
+        # consumer queues width controller
+        self._loop(self.config['broker']['queue.adapt.delay'], self._adapt_queues)
+        # last seen times writer
+        self._loop(self.config['broker']['usercache.flush_delay'], self._flush_usercache)
+        # server list watcher
+        self._loop(self.config['broker']['keyring.reload_delay'], self._reload_keyring)
+
+        # server-to-server services and purgers run in the main process only
+        if self.worker > 0:
+            return
 
         # create listening service for servers (messages only)
         factory = InternalServerFactory(S2SMessageServerProtocol, S2SMessageChannel, self, self.config)
@@ -134,46 +227,323 @@ class MessageBroker(service.Service):
             protocol=protocol, interface=self.config['server']['s2s.bind'][0])
         s2s_service.setServiceParent(self.parent)
 
-        if self.push_manager:
-            self._push_init()
-
         # old usercache entries purger
-        self._loop(self.config['broker']['usercache_purger.delay'], self._purge_usercache)
+        self._purger('usercache', self.config['broker']['usercache_purger.delay'], self._purge_usercache)
         # expired/unknown messages purger
-        self._loop(self.config['broker']['message_purger.delay'], self._purge_messages, True)
+        self._purger('messages', self.config['broker']['message_purger.delay'], self._purge_messages, True)
         # old validations entries purger
-        self._loop(self.config['broker']['validations.expire'], self._purge_validations, True)
+        self._purger('validations', self.config['broker']['validations.expire'], self._purge_validations, True)
+        # deliveries to resources gone for too long purger
+        self._purger('deliveries', self.config['broker']['deliveries_purger.delay'], self._purge_deliveries)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        # send all pending receipts
+        for key in self._receipts.keys():
+            self._flush_receipts(key)
+
+        def _persist_all():
+            # messages published but not dispatched yet are spooled now
+            if self._dispatch_call:
+                self._dispatch_call.cancel()
+                self._dispatch()
+            # write all unacknowledged messages to storage
+            for userid in self._pending_ack.keys():
+                self._persist(userid)
+            # wait for every write in progress, spooled messages included
+            jobs = [d for writes in self._writes.itervalues() for d in writes]
+            jobs.append(self._flush_usercache())
+            # purgers might be deleting messages right now
+            jobs.extend([p.stop() for p in self._purgers.itervalues()])
+            if self.push_manager:
+                self.push_manager.stop()
+            return defer.DeferredList(jobs)
+
+        # published receipts are processed on the next iteration
+        return task.deferLater(reactor, 0, _persist_all)
 
     def _loop(self, delay, call, now=False):
         l = task.LoopingCall(call)
         l.start(delay, now)
         return l
 
-    def _purge_usercache(self):
+    def _purger(self, name, delay, job, now=False):
+        p = purger.Purger(name, job, delay, self.config['broker'])
+        p.start(now)
+        self._purgers[name] = p
+        return p
+
+    def push_stats(self):
+        if self.push_manager:
+            return self.push_manager.stats()
+
+    def token_cache_stats(self):
+        stats = dict(self.keyring.tokens.stats)
+        stats['entries'] = len(self.keyring.tokens)
+        return stats
+
+    def crypto_stats(self):
+        stats = dict(self.crypto.stats)
+        stats['busy'], stats['queued'] = self.crypto.pending()
+        return stats
+
+    def s2s_stats(self):
+        if self.network:
+            stats = dict(self.network.protocol.stats)
+            stats['in_flight'] = self.network.protocol.in_flight()
+            return stats
+
+    def purger_stats(self):
+        return dict((name, p.stats) for name, p in self._purgers.iteritems())
+
+    def _adapt_queues(self):
+        buffer_max = self.config['broker']['queue.buffer_max']
+        latency_max = self.config['broker']['queue.latency_max']
+        for resources in self._consumers.itervalues():
+            for q in resources.itervalues():
+                q.adapt(buffer_max, latency_max)
+
+    def consumer_queue_stats(self):
+        '''Returns a map of userid: consumer queue statistics.'''
+        stats = {}
+        for uhash, resources in self._consumers.iteritems():
+            for resource, q in resources.iteritems():
+                stats[uhash + resource] = {
+                    'length' : len(q),
+                    'width' : q.width(),
+                    'latency' : q.latency,
+                    'held' : q.held(),
+                    'dropped' : q.dropped
+                }
+        return stats
+
+    def _error(self, failure):
+        '''Errback for storage and usercache Deferreds.'''
+        # TODO handle errors
+        failure.printTraceback()
+
+    def _track_write(self, uid, d):
+        '''Keeps track of a storage write in progress for a userid.'''
+        writes = self._writes.setdefault(uid, set())
+        writes.add(d)
+
+        def _done(result):
+            writes.discard(d)
+            if not writes and self._writes.get(uid) is writes:
+                del self._writes[uid]
+            return result
+
+        d.addBoth(_done)
+        return d
+
+    def _writes_done(self, *uids):
+        '''Returns a Deferred fired when storage writes in progress for the given userids are done.'''
+        jobs = []
+        for uid in uids:
+            jobs.extend(self._writes.get(uid, ()))
+        return defer.DeferredList(jobs)
+
+    def _write_behind(self, userid, msg):
+        '''Stores a delivered message now or after the ack grace window if enabled.'''
+        if self._ack_grace > 0:
+            self._ack_later(userid, msg)
+        else:
+            self._store(userid, msg).addErrback(self._error)
+
+    def _store(self, userid, msg):
+        '''Writes a message to storage, with the resources it was delivered to if generic.'''
+        d = self.storage.store(userid, msg)
+        state = self._deliveries.get(msg['messageid'])
+        if len(userid) == utils.USERID_LENGTH and state:
+            # later changes are written by the ack and delivery paths
+            entries = [(msg['messageid'], resource, acked) for resource, acked in state.iteritems()]
+            d.addCallback(lambda _: self.storage.update_deliveries(entries))
+        return self._track_write(userid, d)
+
+    def _ack_later(self, userid, msg):
+        '''Keeps a delivered message in memory until acknowledged or the grace window expires.'''
+        if userid not in self._pending_ack:
+            self._pending_ack[userid] = {}
+        elif msg['messageid'] in self._pending_ack[userid]:
+            # delivered again (to another resource), restart the window
+            self._pending_ack[userid][msg['messageid']][1].cancel()
+        call = reactor.callLater(self._ack_grace, self._persist, userid, msg['messageid'])
+        self._pending_ack[userid][msg['messageid']] = (msg, call)
+
+    def _persist(self, userid, msgid = None):
+        '''Writes messages waiting for ack to storage (all of them if msgid is None).'''
+        try:
+            pending = self._pending_ack[userid]
+        except KeyError:
+            return defer.succeed(None)
+
+        if msgid:
+            msgid_list = [msgid] if msgid in pending else []
+        else:
+            msgid_list = pending.keys()
+
+        jobs = []
+        for msgid in msgid_list:
+            msg, call = pending.pop(msgid)
+            if call.active():
+                call.cancel()
+            d = self._store(userid, msg)
+            d.addErrback(self._error)
+            jobs.append(d)
+
+        if not pending:
+            del self._pending_ack[userid]
+        return defer.DeferredList(jobs)
+
+    def _persist_delivered(self, userid):
+        '''Writes generic messages waiting for ack delivered to a resource to storage.'''
+        uhash, resource = utils.split_userid(userid)
+        jobs = []
+        for msgid in self._pending_ack.get(uhash, {}).keys():
+            if resource in self._deliveries.get(msgid, ()):
+                jobs.append(self._persist(uhash, msgid))
+        return defer.DeferredList(jobs)
+
+    def _requeue_generic(self, uhash):
+        '''Delivers generic messages waiting for ack to the resources which didn't get them yet.'''
+        pending = self._pending_ack.get(uhash)
+        if pending:
+            self._usermsg_worker([msg for msg, call in pending.itervalues()])
+
+    def _queue_receipt(self, sender, userid, entries):
+        '''Queues receipt entries to be merged with others for the same sender/recipient pair.'''
+        key = (sender, userid)
+        try:
+            self._receipts[key][0].extend(entries)
+        except KeyError:
+            call = reactor.callLater(self._receipt_delay, self._flush_receipts, key)
+            self._receipts[key] = (list(entries), call)
+
+    def _flush_receipts(self, key):
+        '''Sends all queued receipt entries for a sender/recipient pair in a single message.'''
+        entries, call = self._receipts.pop(key)
+        if call.active():
+            call.cancel()
+
+        sender, userid = key
+        r = c2s.ReceiptMessage()
+        for m in entries:
+            e = r.entry.add()
+            e.message_id = m['messageid']
+            e.status = m['status']
+            e.timestamp = m['timestamp']
+
+        self.publish_user(sender, userid, { 'mime' : MIME_RECEIPT, 'flags' : [] }, r.SerializeToString(), MSG_ACK_MANUAL)
+
+    def _merge_receipts(self, uid, stored):
+        '''
+        Merges stored receipts from the same sender into a single receipt message.
+        Returns the new message list and a Deferred fired when the merged
+        receipts have replaced the old ones in storage.
+        '''
+        outlist = []
+        receipts = {}
+        for msg in stored:
+            if msg['headers']['mime'] == MIME_RECEIPT:
+                sender = msg['sender']
+                if sender not in receipts:
+                    receipts[sender] = []
+                    # merged receipt will take the place of the first one
+                    outlist.append(sender)
+                receipts[sender].append(msg)
+            else:
+                outlist.append(msg)
+
+        jobs = []
+        for i in range(len(outlist)):
+            if isinstance(outlist[i], dict):
+                continue
+
+            msglist = receipts[outlist[i]]
+            if len(msglist) == 1:
+                outlist[i] = msglist[0]
+                continue
+
+            r = c2s.ReceiptMessage()
+            for msg in msglist:
+                m = c2s.ReceiptMessage()
+                m.ParseFromString(msg['payload'])
+                r.MergeFrom(m)
+
+            merged = {
+                'messageid' : self.message_id(),
+                'sender' : outlist[i],
+                'recipient' : uid,
+                'timestamp' : msglist[-1]['timestamp'],
+                'need_ack' : MSG_ACK_MANUAL,
+                'headers' : { 'mime' : MIME_RECEIPT, 'flags' : [] },
+                'payload' : r.SerializeToString(),
+                'storage' : True
+            }
+            outlist[i] = merged
+
+            # store the merged receipt before deleting the old ones
+            d = self._track_write(uid, self.storage.store(uid, merged))
+            d.addCallback(lambda _, msglist: self.storage.delete_messages(uid, [msg['messageid'] for msg in msglist]), msglist)
+            d.addErrback(self._error)
+            jobs.append(d)
+
+        return outlist, defer.DeferredList(jobs)
+
+    def _flush_usercache(self):
+        return self.usercache.flush().addErrback(self._error)
+
+    def _reload_keyring(self):
+        '''Reloads the server list, recomputing trust tables in the crypto pool if it changed.'''
+        def _loaded(servers):
+            if not self.keyring.changed(servers):
+                # addresses might have changed
+                self.keyring.update(servers)
+                return
+
+            log.debug("server list changed, reloading keyring")
+            d = self.crypto.compute_keyring(self.keyring, servers)
+            d.addCallback(lambda tables: self.keyring.update(servers, tables))
+            return d
+
+        d = self.dbpool.run_query(database.servers, 'get_list')
+        d.addCallback(_loaded)
+        d.addErrback(self._error)
+        return d
+
+    def _purge_usercache(self, limit, budget):
         #log.debug("purging usercache")
-        self.usercache.purge_users()
+        return self.usercache.purge_users(self.config['broker']['usercache.expire'], limit, budget)
 
-    def _purge_messages(self):
+    def _purge_messages(self, limit, budget):
         #log.debug("purging messages")
-        self.storage.purge_messages()
+        return self.storage.purge_messages(limit, budget)
         # TODO send error receipts for expired messages
 
-    def _purge_validations(self):
+    def _purge_validations(self, limit, budget):
         #log.debug("purging validations")
-        self.storage.purge_validations()
+        return self.storage.purge_validations(self.config['broker']['validations.expire'], limit, budget)
+
+    def _purge_deliveries(self, limit, budget):
+        #log.debug("purging deliveries")
+        return self.storage.purge_deliveries(self.config['broker']['deliveries.resource_expire'], limit, budget)
 
     def _push_init(self):
         '''Sends push messages on startup for incoming messages.'''
+        def _notify(msglist):
+            for uhash, count in msglist.items():
+                log.debug("push notifying user %s" % uhash)
+                try:
+                    self.push_manager.notify_all(uhash)
+                except:
+                    # TODO notify errors
+                    import traceback
+                    traceback.print_exc()
+
         # FIXME this might trigger notifications even when it's not needed
-        msglist = self.storage.load(None)
-        for uhash, count in msglist.items():
-            log.debug("push notifying user %s" % uhash)
-            try:
-                self.push_manager.notify_all(uhash)
-            except:
-                # TODO notify errors
-                import traceback
-                traceback.print_exc()
+        d = self.storage.load(None)
+        d.addCallback(_notify)
+        d.addErrback(self._error)
 
     def set_user_hide_status(self, userid, hide=False):
         """Sets internal hide status for a user."""
@@ -184,16 +554,23 @@ class MessageBroker(service.Service):
             #log.debug("showing user %s" % (userid, ))
             self._hidden.discard(userid)
 
+        # the other workers answer lookups for this user too
+        if self.shards:
+            self.shards.announce_hidden(userid, hide)
+
     def _usermbox_worker(self, mbox):
         '''
         Processes a bunch of messages to be sent massively to recipients.
         This takes every message and put it in different lists to be delivered
         to their respective channels - if available.
+        Returns a Deferred fired when messages have been sent out by consumers.
         TODO this method is used only to requeue messages on login, so we can
         take something for granted, e.g. userid will be the same for every
         message, push notifications are not needed, ...
         '''
         outbox = {}
+        # pending storage operations
+        jobs = []
 
         for msg in mbox:
             userid = msg['recipient']
@@ -203,55 +580,29 @@ class MessageBroker(service.Service):
             # generic user, post to every consumer
             if len(userid) == utils.USERID_LENGTH:
                 try:
-                    for resource, q in self._consumers[userid].iteritems():
-                        outmsg = dict(msg)
-                        # branch the message :)
-                        outmsg['messageid'] = self.message_id()
-                        outmsg['originalid'] = msg['messageid']
-                        outmsg['recipient'] += resource
-
-                        # store to disk (if need_ack)
-                        if need_ack:
-                            try:
-                                #log.debug("storing message %s to disk" % outmsg['messageid'])
-                                self.storage.deliver(outmsg['recipient'], outmsg)
-                            except:
-                                # TODO handle errors
-                                import traceback
-                                traceback.print_exc()
-
+                    for uid, outlist in self._deliver_generic(userid, (msg, )).iteritems():
                         # keep in outbox
-                        if outmsg['recipient'] not in outbox:
-                            outbox[outmsg['recipient']] = []
-                        outbox[outmsg['recipient']].append(outmsg)
+                        if uid not in outbox:
+                            outbox[uid] = []
+                        outbox[uid].extend(outlist)
 
                 except KeyError:
                     #log.debug("warning: no consumer to deliver message to %s" % userid)
                     # store to temporary spool
-                    self.storage.store(userid, msg)
+                    if need_ack and 'storage' not in msg:
+                        self._track_write(userid, self.storage.store(userid, msg)).addErrback(self._error)
                     # send push notifications to all matching users
-                    try:
-                        # do not push for receipts
-                        if self.push_manager and msg['headers']['mime'] != MIME_RECEIPT:
-                            self.push_manager.notify_all(userid)
-                    except:
-                        # TODO notify errors
-                        import traceback
-                        traceback.print_exc()
+                    self._push_notify(userid, (msg, ), True)
 
             elif len(userid) == utils.USERID_LENGTH_RESOURCE:
                 uhash, resource = utils.split_userid(userid)
 
                 # store to disk (if need_ack)
-                if need_ack:
-                    try:
-                        #log.debug("storing message %s to disk" % msg['messageid'])
-                        if 'storage' not in msg:
-                            self.storage.store(userid, msg)
-                    except:
-                        # TODO handle errors
-                        import traceback
-                        traceback.print_exc()
+                if need_ack and 'storage' not in msg:
+                    #log.debug("storing message %s to disk" % msg['messageid'])
+                    d = self._track_write(userid, self.storage.store(userid, msg))
+                    d.addErrback(self._error)
+                    jobs.append(d)
 
                 # keep in outbox
                 if userid not in outbox:
@@ -261,103 +612,273 @@ class MessageBroker(service.Service):
             else:
                 log.warn("warning: unknown userid format %s" % userid)
 
-        for userid, msglist in outbox.iteritems():
-            uhash, resource = utils.split_userid(userid)
+        def _dispatch(result):
+            sent = []
+            for userid, msglist in outbox.iteritems():
+                uhash, resource = utils.split_userid(userid)
+
+                try:
+                    q = self._consumers[uhash][resource]
+                except KeyError:
+                    #log.debug("warning: no consumer to deliver message to %s/%s!" % (uhash, resource))
+                    # send push notification
+                    self._push_notify(userid, msglist)
+                else:
+                    # send to client consumer
+                    #log.debug("sending message %s to consumer" % msg['messageid'])
+                    sent.extend(self._put(userid, q, msglist))
+
+            return defer.DeferredList(sent, consumeErrors=True)
+
+        # messages are handed to consumers only when they are safely stored
+        d = defer.DeferredList(jobs)
+        d.addCallback(_dispatch)
+        return d
+
+    def _dispatch(self):
+        '''Processes all messages published since the last reactor iteration.'''
+        queue = self._dispatch_queue
+        self._dispatch_queue = []
+        self._dispatch_call = None
+        self._dispatch_spool = []
+
+        self._dispatch_stats['batches'] += 1
+        self._dispatch_stats['messages'] += len(queue)
+        self._dispatch_stats['last_batch'] = len(queue)
+        self._dispatch_stats['max_batch'] = max(self._dispatch_stats['max_batch'], len(queue))
+
+        # group messages by recipient
+        outbox = OrderedDict()
+        for msg in queue:
+            userid = msg['recipient']
+            if userid not in outbox:
+                outbox[userid] = []
+            outbox[userid].append(msg)
 
+        for userid, msglist in outbox.iteritems():
             try:
-                # send to client consumer
-                #log.debug("sending message %s to consumer" % msg['messageid'])
-                self._consumers[uhash][resource].put(msglist)
+                self._usermsg_worker(msglist)
             except:
-                #log.debug("warning: no consumer to deliver message to %s/%s!" % (uhash, resource))
-                # send push notification
-                try:
-                    # do not push for receipts
-                    receipt_found = False
-                    for msg in msglist:
-                        if msg['headers']['mime'] == MIME_RECEIPT:
-                            receipt_found = True
-                            break
-                    if self.push_manager and not receipt_found:
-                        self.push_manager.notify(userid)
-                except:
-                    # TODO notify errors
-                    import traceback
-                    traceback.print_exc()
+                import traceback
+                traceback.print_exc()
 
+        # write all spooled messages at once
+        spool = self._dispatch_spool
+        self._dispatch_spool = None
+        if spool:
+            def _stored(result):
+                for msglist, d in spool:
+                    d.callback(result)
+
+            def _failed(failure):
+                for msglist, d in spool:
+                    d.errback(failure)
+
+            d = self.storage.store_messages([msg for msglist, _d in spool for msg in msglist])
+            d.addCallbacks(_stored, _failed)
+
+    def _spool(self, userid, msglist):
+        '''Writes messages to storage, together with the others spooled by the current dispatch.'''
+        if self._dispatch_spool is None:
+            return self._track_write(userid, self.storage.store_messages(msglist))
+
+        d = self._track_write(userid, defer.Deferred())
+        self._dispatch_spool.append((msglist, d))
+        return d
+
+    def dispatch_stats(self):
+        '''Returns dispatch queue statistics.'''
+        stats = dict(self._dispatch_stats)
+        stats['queue'] = len(self._dispatch_queue)
+        return stats
+
+    def _put(self, userid, q, msglist):
+        '''
+        Sends messages to a consumer queue, in a single mailbox if supported.
+        Returns a list of Deferreds fired when the consumer has sent them out.
+        '''
+        try:
+            mailbox = self._callbacks[userid]['mailbox']
+        except KeyError:
+            mailbox = False
 
-    def _usermsg_worker(self, msg):
-        userid = msg['recipient']
-        need_ack = msg['need_ack']
-        #log.debug("queue data for user %s (need_ack=%s)" % (userid, need_ack))
+        if mailbox and len(msglist) > 1:
+            jobs = [q.put(msglist)]
+        else:
+            jobs = [q.put(msg) for msg in msglist]
+        # dropped messages (not needing ack) have no Deferred
+        jobs = [d for d in jobs if d]
+        for d in jobs:
+            # held messages of a stopped consumer are persisted with its write-behind entries
+            d.addErrback(lambda failure: failure.trap(ConsumerStopped))
+        return jobs
+
+    def _push_notify(self, userid, msglist, generic = False):
+        '''Sends push notifications for messages to a user which is not online.'''
+        try:
+            # do not push for receipts
+            receipt_found = False
+            for msg in msglist:
+                if msg['headers']['mime'] == MIME_RECEIPT:
+                    receipt_found = True
+                    break
+            if self.push_manager and not receipt_found:
+                if generic:
+                    self.push_manager.notify_all(userid)
+                else:
+                    self.push_manager.notify(userid)
+        except:
+            # TODO notify errors
+            import traceback
+            traceback.print_exc()
+
+    def _deliver_generic(self, uhash, msglist):
+        '''
+        Prepares messages for a generic user for every resource online which
+        didn't receive them yet. Messages are not branched: every resource
+        gets the same message (and storage row) and acknowledges it on its
+        own; the message is deleted when every resource it was delivered to
+        acknowledged it. Deliveries of stored messages are written to storage.
+        Returns a dict of specific userid: list of messages.
+        Raises KeyError if no resource is online.
+        '''
+        resources = self._consumers[uhash]
+        outbox = {}
+        delivered = []
+        for msg in msglist:
+            msgid = msg['messageid']
+            if msg['need_ack']:
+                state = self._deliveries.setdefault(msgid, {})
+                if state and all(state.values()):
+                    # acknowledged by every resource but not deleted
+                    del self._deliveries[msgid]
+                    if 'storage' in msg:
+                        self.storage.delete_messages(uhash, [msgid]).addErrback(self._error)
+                    continue
+
+                # resources which didn't ack it and are not waiting for it
+                targets = [r for r in resources if not state.get(r) and
+                    msgid not in self._delivered_to.get(uhash + r, ())]
+                if not targets:
+                    continue
+
+                for resource in targets:
+                    state[resource] = False
+                    self._delivered_to.setdefault(uhash + resource, set()).add(msgid)
+
+                if 'storage' in msg:
+                    delivered.extend([(msgid, resource, False) for resource in targets])
+                else:
+                    # store to disk only if not acknowledged in time
+                    self._write_behind(uhash, msg)
+            else:
+                targets = resources.keys()
+
+            for resource in targets:
+                # consumers might alter the message dict
+                outbox.setdefault(uhash + resource, []).append(dict(msg, recipient=uhash + resource))
+
+        if delivered:
+            self._track_write(uhash, self.storage.update_deliveries(delivered)).addErrback(self._error)
+        return outbox
+
+    def _load_deliveries(self, deliveries):
+        '''Merges the delivery state of stored generic messages with the one in memory.'''
+        for msgid, stored in deliveries.iteritems():
+            state = self._deliveries.setdefault(msgid, {})
+            for resource, acked in stored.iteritems():
+                state[resource] = state.get(resource, False) or acked
+
+    def _delivery_acked(self, userid, msgid):
+        '''
+        Marks a generic message as acknowledged by a resource.
+        Returns a tuple (first ack, last ack) or None if the message was not
+        delivered to the resource as a generic message.
+        '''
+        uhash, resource = utils.split_userid(userid)
+        state = self._deliveries.get(msgid)
+        if state is None or resource not in state:
+            return None
+
+        first = not any(state.values())
+        state[resource] = True
+
+        delivered = self._delivered_to.get(userid)
+        if delivered is not None:
+            delivered.discard(msgid)
+            if not delivered:
+                del self._delivered_to[userid]
+
+        last = all(state.values())
+        if last:
+            del self._deliveries[msgid]
+        return first, last
+
+    def _forget_deliveries(self, userid):
+        '''
+        Forgets generic messages not acknowledged by a resource going offline.
+        They are delivered again on next login, and they are not deleted
+        until then.
+        '''
+        uhash, resource = utils.split_userid(userid)
+        pending = self._pending_ack.get(uhash, {})
+        for msgid in self._delivered_to.pop(userid, ()):
+            state = self._deliveries.get(msgid)
+            # state of messages not stored yet lives only in memory
+            if state is None or msgid in pending:
+                continue
+            if not [r for r in state if msgid in self._delivered_to.get(uhash + r, ())]:
+                # no resource waiting for it, state is in storage
+                del self._deliveries[msgid]
+
+    def _usermsg_worker(self, msglist):
+        '''Processes a list of messages for the same recipient.'''
+        userid = msglist[0]['recipient']
+        #log.debug("queue data for user %s (%d messages)" % (userid, len(msglist)))
 
         # generic user, post to every consumer
         if len(userid) == utils.USERID_LENGTH:
             try:
-                for resource, q in self._consumers[userid].iteritems():
-                    outmsg = dict(msg)
-                    # branch the message :)
-                    outmsg['messageid'] = self.message_id()
-                    outmsg['originalid'] = msg['messageid']
-                    outmsg['recipient'] += resource
-
-                    # store to disk (if need_ack)
-                    if need_ack:
-                        try:
-                            #log.debug("storing message %s to disk" % outmsg['messageid'])
-                            self.storage.deliver(outmsg['recipient'], outmsg)
-                        except:
-                            # TODO handle errors
-                            import traceback
-                            traceback.print_exc()
-
-                    # send to client listener
-                    q.put(outmsg)
+                outbox = self._deliver_generic(userid, msglist)
+                for uid, outlist in outbox.iteritems():
+                    self._put(uid, self._consumers[userid][uid[utils.USERID_LENGTH:]], outlist)
 
             except KeyError:
                 #log.debug("warning: no consumer to deliver message to %s" % userid)
                 # store to temporary spool
-                self.storage.store(userid, msg)
+                self._spool(userid, msglist).addErrback(self._error)
                 # send push notifications to all matching users
-                try:
-                    # do not push for receipts
-                    if self.push_manager and msg['headers']['mime'] != MIME_RECEIPT:
-                        self.push_manager.notify_all(userid)
-                except:
-                    # TODO notify errors
-                    import traceback
-                    traceback.print_exc()
-
+                self._push_notify(userid, msglist, True)
 
         elif len(userid) == utils.USERID_LENGTH_RESOURCE:
             uhash, resource = utils.split_userid(userid)
 
-            # store to disk (if need_ack)
-            if need_ack:
+            def _deliver(result):
                 try:
-                    #log.debug("storing message %s to disk" % msg['messageid'])
-                    if 'storage' not in msg:
-                        self.storage.store(userid, msg)
-                except:
-                    # TODO handle errors
-                    import traceback
-                    traceback.print_exc()
+                    # send to client consumer
+                    #log.debug("sending %d messages to consumer" % len(msglist))
+                    q = self._consumers[uhash][resource]
+                except KeyError:
+                    #log.debug("warning: no consumer to deliver message to %s/%s!" % (uhash, resource))
+                    # send push notification
+                    self._push_notify(userid, msglist)
+                else:
+                    self._put(userid, q, msglist)
 
-            try:
-                # send to client consumer
-                #log.debug("sending message %s to consumer" % msg['messageid'])
-                self._consumers[uhash][resource].put(msg)
-            except:
-                #log.debug("warning: no consumer to deliver message to %s/%s!" % (uhash, resource))
-                # send push notification
-                try:
-                    # do not push for receipts
-                    if self.push_manager and msg['headers']['mime'] != MIME_RECEIPT:
-                        self.push_manager.notify(userid)
-                except:
-                    # TODO notify errors
-                    import traceback
-                    traceback.print_exc()
+            # store to disk (if need_ack)
+            store_list = [msg for msg in msglist if msg['need_ack'] and 'storage' not in msg]
+            if store_list and self.user_online(userid):
+                # store to disk only if not acknowledged in time
+                for msg in store_list:
+                    self._write_behind(userid, msg)
+                _deliver(None)
+            elif store_list:
+                #log.debug("storing %d messages to disk" % len(store_list))
+                d = self._spool(userid, store_list)
+                d.addCallback(_deliver)
+                d.addErrback(self._error)
+            else:
+                _deliver(None)
 
         else:
             log.warn("warning: unknown userid format %s" % userid)
@@ -374,18 +895,28 @@ class MessageBroker(service.Service):
         else:
             self._consumers[uhash] = {}
 
-        self._callbacks[userid] = { 'conflict' : worker.conflict, 'client_protocol' : worker.get_client_protocol }
-        # TODO configurable queue width
-        self._consumers[uhash][resource] = ResizableDispatchQueue(worker.incoming, 50)
+        self._callbacks[userid] = { 'conflict' : worker.conflict, 'client_protocol' : worker.get_client_protocol, 'mailbox' : supports_mailbox }
+        self._consumers[uhash][resource] = ConsumerQueue(worker,
+            self.config['broker']['queue.%s.width' % worker.queue_type],
+            self.config['broker']['queue.%s.max_size' % worker.queue_type])
+        if self.shards:
+            self.shards.announce(userid, True)
 
         # mark user as online in the push notifications manager
         if self.push_manager:
             self.push_manager.mark_user_online(userid)
 
         # broadcast presence (if not hidden)
-        if not self.user_hidden(userid):
+        if self._cancel_offline(userid):
+            # subscribers never knew the user went offline
+            self._presence_stats['online_suppressed'] += 1
+        elif not self.user_hidden(userid):
             self.broadcast_presence(userid, c2s.UserPresence.EVENT_ONLINE, None, not broadcast_presence)
 
+        # messages waiting for ack by the previous consumer will be requeued
+        self._persist(userid)
+        # generic ones still in memory are delivered to this resource too
+        self._requeue_generic(uhash)
         # requeue pending messages
         self.pending_messages(userid, supports_mailbox)
 
@@ -396,7 +927,7 @@ class MessageBroker(service.Service):
             # end user storage
             self.storage.stop(userid)
             # user logout
-            self.usercache.touch_user(userid)
+            self.usercache.touch_user(userid).addErrback(self._error)
             try:
                 # remove callbacks
                 del self._callbacks[userid]
@@ -407,14 +938,47 @@ class MessageBroker(service.Service):
             del self._consumers[uhash][resource]
             if len(self._consumers[uhash]) == 0:
                 del self._consumers[uhash]
+            if self.shards:
+                self.shards.announce(userid, False)
         except:
             import traceback
             traceback.print_exc()
 
+        # write messages waiting for ack by this resource to storage
+        self._persist(userid)
+        self._persist_delivered(userid)
+        self._forget_deliveries(userid)
         # remove presence subscriptions
         self.unsubscribe_user_presence(userid)
-        # broadcast presence
-        self.broadcast_presence(userid, c2s.UserPresence.EVENT_OFFLINE, None, not broadcast_presence)
+        # broadcast presence if the user doesn't come back in time
+        self._cancel_offline(userid)
+        self._offline_pending[userid] = reactor.callLater(self._offline_delay,
+            self._broadcast_offline, userid, not broadcast_presence)
+
+    def _cancel_offline(self, userid):
+        '''Cancels a held offline event. Returns true if there was one.'''
+        try:
+            call = self._offline_pending.pop(userid)
+        except KeyError:
+            return False
+        if call.active():
+            call.cancel()
+        self._presence_stats['offline_cancelled'] += 1
+        return True
+
+    def _broadcast_offline(self, userid, network_only):
+        del self._offline_pending[userid]
+        try:
+            del self._last_status[userid]
+        except KeyError:
+            pass
+        self.broadcast_presence(userid, c2s.UserPresence.EVENT_OFFLINE, None, network_only)
+
+    def presence_event_stats(self):
+        '''Returns presence events counters.'''
+        stats = dict(self._presence_stats)
+        stats['offline_held'] = len(self._offline_pending)
+        return stats
 
     def pending_messages(self, userid, supports_mailbox = False):
         uhash, resource = utils.split_userid(userid)
@@ -422,35 +986,42 @@ class MessageBroker(service.Service):
         WARNING these two need to be called in this order!!!
         Otherwise bad things happen...
         """
+        # wait for messages still being written
+        d = self._writes_done(userid, uhash)
         # load previously stored messages (for specific) and requeue them
-        self._reload_usermsg_queue(userid, supports_mailbox)
+        d.addCallback(lambda _: self._reload_usermsg_queue(userid))
         # load previously stored messages (for generic) and requeue them
-        self._reload_usermsg_queue(uhash, supports_mailbox)
+        d.addCallback(lambda _: self._reload_usermsg_queue(uhash))
+        d.addErrback(self._error)
+        return d
 
 
     def message_id(self):
-        return utils.rand_str(30)
+        return self._msgid.next()
 
     def broadcast_presence(self, userid, event, status = None, network_only = False):
         #log.debug("broadcasting event %d by user %s to network (network_only=%s)" % (event, userid, network_only, ))
+        if event == c2s.UserPresence.EVENT_STATUS_CHANGED:
+            # suppress status changes which are not actual changes
+            if userid in self._last_status and self._last_status[userid] == status:
+                self._presence_stats['status_suppressed'] += 1
+                return
+            self._last_status[userid] = status
+
+        self._presence_stats['sent'] += 1
         if not network_only:
-            def _broadcast(self, by_userid, to_userid, event, status):
-                #log.debug("broadcasting event %d by user %s to user %s" % (event, by_userid, to_userid))
+            mask = USER_EVENT_MASKS[event]
+            recipients = []
+            for subs in self.get_presence_subscribers(userid):
+                if subs:
+                    recipients.extend([sub for sub, events in subs.iteritems() if events & mask])
+
+            if recipients:
                 m = c2s.UserPresence()
                 m.event = event
                 if status != None:
                     m.status_message = status
-                self.publish_user(by_userid, to_userid, { 'mime' : MIME_PRESENCE, 'flags' : [] }, m.SerializeToString(), MSG_ACK_NONE)
-
-            subs_generic, subs_specific = self.get_presence_subscribers(userid)
-            if subs_generic:
-                for sub, mask in subs_generic.iteritems():
-                    if mask & USER_EVENT_MASKS[event]:
-                        _broadcast(self, userid, sub, event, status)
-            if subs_specific:
-                for sub, mask in subs_specific.iteritems():
-                    if mask & USER_EVENT_MASKS[event]:
-                        _broadcast(self, userid, sub, event, status)
+                self.publish_ephemeral(userid, recipients, { 'mime' : MIME_PRESENCE, 'flags' : [] }, m.SerializeToString())
 
         # broadcast to servers
         """
@@ -486,50 +1057,103 @@ class MessageBroker(service.Service):
         if events > c2s.USER_EVENT_MASK_ALL:
             return c2s.UserPresenceSubscribeResponse.STATUS_ERROR
 
-        uhash, resource = utils.split_userid(uid)
-        if uhash not in self._presence:
-            self._presence[uhash] = {}
-        if resource not in self._presence[uhash]:
-            self._presence[uhash][resource] = {}
-        if userid not in self._presence_lists:
-            self._presence_lists[userid] = []
-
         if events == 0:
-            try:
-                # remove from subscriptions map
-                del self._presence[uhash][resource][userid]
-            except:
-                pass
+            self._presence_remove(userid, uid)
             if not internal:
-                try:
-                    # remove from subscriptions lists
-                    self._presence_lists[userid].remove(uid)
-                except:
-                    pass
+                subs = self._presence_lists.get(userid)
+                if subs is not None:
+                    subs.discard(uid)
+                    if not subs:
+                        del self._presence_lists[userid]
+        elif self.shards and not self.shards.is_local(uid):
+            # subscriptions are kept by the worker owning the user
+            self.shards.send(self.shards.shard(uid), 'subscribe', userid, uid, events, True)
+            if not internal:
+                self._presence_lists.setdefault(userid, set()).add(uid)
         else:
+            uhash, resource = utils.split_userid(uid)
             # add to subscriptions map
-            self._presence[uhash][resource][userid] = events
+            self._presence.setdefault(uhash, {}).setdefault(resource, {})[userid] = events
             if not internal:
                 # add to subscriptions lists
-                if uid not in self._presence_lists:
-                    self._presence_lists[userid].append(uid)
+                self._presence_lists.setdefault(userid, set()).add(uid)
 
         return c2s.UserPresenceSubscribeResponse.STATUS_SUCCESS
 
+    def _presence_remove(self, userid, uid):
+        '''Removes userid from the subscribers of uid, dropping empty entries.'''
+        if self.shards and not self.shards.is_local(uid):
+            self.shards.send(self.shards.shard(uid), 'subscribe', userid, uid, 0, True)
+            return
+
+        uhash, resource = utils.split_userid(uid)
+        try:
+            by_resource = self._presence[uhash]
+            subs = by_resource[resource]
+            del subs[userid]
+        except KeyError:
+            return
+        if not subs:
+            del by_resource[resource]
+            if not by_resource:
+                del self._presence[uhash]
+
     def unsubscribe_user_presence(self, userid):
         '''Unsubscribes user to any kind of event by any user.'''
         #log.debug("ubsubscribing %s from all presence notifications" % userid)
-        if userid in self._presence_lists:
-            for sub in self._presence_lists[userid]:
-                self.subscribe_user_presence(userid, sub, 0, True)
-            del self._presence_lists[userid]
+        subs = self._presence_lists.pop(userid, None)
+        if subs:
+            for uid in subs:
+                self._presence_remove(userid, uid)
+
+    def shard_stats(self):
+        '''Returns statistics about the channel to the other worker processes.'''
+        if not self.shards:
+            return None
+        stats = dict(self.shards.stats)
+        stats['worker'] = self.worker
+        stats['workers'] = self.shards.count
+        return stats
+
+    def usercache_stats(self):
+        '''Returns usercache layer statistics, if enabled.'''
+        try:
+            return self.usercache.stats()
+        except AttributeError:
+            return None
+
+    def presence_stats(self):
+        '''Returns statistics about presence subscriptions and their memory usage.'''
+        targets = 0
+        subscriptions = 0
+        size = sys.getsizeof(self._presence) + sys.getsizeof(self._presence_lists)
+        for by_resource in self._presence.itervalues():
+            size += sys.getsizeof(by_resource)
+            for subs in by_resource.itervalues():
+                targets += 1
+                subscriptions += len(subs)
+                size += sys.getsizeof(subs)
+        for subs in self._presence_lists.itervalues():
+            size += sys.getsizeof(subs)
+
+        return {
+            'subscribers' : len(self._presence_lists),
+            'targets' : targets,
+            'subscriptions' : subscriptions,
+            'size' : size
+        }
 
     def user_hidden(self, uid):
+        if self.shards and not self.shards.is_local(uid):
+            return self.shards.user_hidden(uid)
         return uid in self._hidden
 
     def user_online(self, uid):
         '''Returns true if the specified user currently is a registered consumer.'''
         uhash, resource = utils.split_userid(uid)
+        if self.shards and not self.shards.is_local(uhash):
+            return self.shards.user_online(uid)
+
         generic_online = (uhash in self._consumers and len(self._consumers[uhash]) > 0)
 
         if resource:
@@ -537,168 +1161,434 @@ class MessageBroker(service.Service):
         else:
             return generic_online
 
-    def _reload_usermsg_queue(self, uid, mbox = True):
-        '''Loads and requeues messages to a users.'''
-        stored = self.storage.load(uid)
-        if stored:
-            if mbox:
-                self._usermbox_worker(stored)
+    def _reload_usermsg_queue(self, uid, cursor = None, merged = None):
+        '''
+        Loads and requeues stored messages to a user, one page at a time.
+        The next page is loaded only when the consumers have sent out the
+        previous one.
+        '''
+        if merged is None:
+            # merged receipts already sent, they might show up in later pages
+            merged = set()
+
+        def _requeue(result, stored):
+            return self._usermbox_worker(stored)
+
+        def _deliveries(result, stored):
+            # resources which acknowledged generic messages won't get them again
+            d = self.storage.get_deliveries([msg['messageid'] for msg in stored if msg['need_ack']])
+            d.addCallback(self._load_deliveries)
+            return d
+
+        def _merge(result):
+            stored, next_cursor = result
+            stored = [msg for msg in stored if msg['messageid'] not in merged]
+            if stored:
+                loaded = set([msg['messageid'] for msg in stored])
+                stored, d = self._merge_receipts(uid, stored)
+                merged.update([msg['messageid'] for msg in stored if msg['messageid'] not in loaded])
+                if len(uid) == utils.USERID_LENGTH:
+                    d.addCallback(_deliveries, stored)
+                d.addCallback(_requeue, stored)
             else:
-                for msg in stored:
-                    self._usermsg_worker(msg)
+                d = defer.succeed(None)
+
+            if next_cursor:
+                d.addCallback(_next, next_cursor)
+            return d
+
+        def _next(result, next_cursor):
+            # user went away in the meantime
+            if self.user_online(uid):
+                return self._reload_usermsg_queue(uid, next_cursor, merged)
+
+        d = self.storage.load_page(uid, cursor,
+            self.config['broker']['mailbox.page_size'],
+            self.config['broker']['mailbox.page_rows'])
+        d.addCallback(_merge)
+        return d
 
     def publish_user(self, sender, userid, headers = None, msg = None, need_ack = MSG_ACK_NONE):
         '''Publish a message to a user, either generic or specific.'''
+        return self.publish_users(sender, (userid, ), headers, msg, need_ack)[userid]
 
-        # TODO many other checks
-        if len(userid) != utils.USERID_LENGTH and len(userid) != utils.USERID_LENGTH_RESOURCE:
-            log.warn("invalid userid format: %s" % userid)
-            # TODO should we throw an exception here?
-            return None
+    def publish_users(self, sender, userids, headers = None, msg = None, need_ack = MSG_ACK_NONE):
+        '''
+        Publish a message to several users, either generic or specific.
+        Headers and payload are shared by all the recipients.
+        Returns a dict of userid: message id (or error status).
+        '''
+        res = {}
+        # messages for users owned by other worker processes
+        remote = {}
+        timestamp = datetime.utcnow()
+
+        for userid in userids:
+            # TODO many other checks
+            if len(userid) != utils.USERID_LENGTH and len(userid) != utils.USERID_LENGTH_RESOURCE:
+                log.warn("invalid userid format: %s" % userid)
+                # TODO should we throw an exception here?
+                res[userid] = None
+                continue
+
+            if self.config['broker']['reject_unknown_recipients']:
+                # check if user exists
+                # TODO this check should be done over the whole network (?)
+                if not self.storage.get_user_stat(userid) and not self.user_online(userid):
+                    log.warn("user %s not found" % userid)
+                    res[userid] = c2s.MessagePostResponse.MessageSent.STATUS_USER_NOTFOUND
+                    continue
+
+            # prepare message dict
+            msg_id = self.message_id()
+            outmsg = {
+                'messageid' : msg_id,
+                'sender' : sender,
+                'recipient' : userid,
+                'timestamp' : timestamp,
+                'need_ack' : need_ack,
+                'headers' : headers,
+                'payload' : msg
+            }
+
+            if self.shards and not self.shards.is_local(userid):
+                remote.setdefault(self.shards.shard(userid), []).append(outmsg)
+            else:
+                # process message on the next iteration, together with the others
+                self._dispatch_queue.append(outmsg)
+            res[userid] = msg_id
+
+        for shard_id, msglist in remote.iteritems():
+            self.shards.send(shard_id, 'dispatch', msglist)
+
+        self.dispatch_messages()
+        return res
 
-        if self.config['broker']['reject_unknown_recipients']:
-            # check if user exists
-            # TODO this check should be done over the whole network (?)
-            if not self.storage.get_user_stat(userid) and not self.user_online(userid):
-                log.warn("user %s not found" % userid)
-                return c2s.MessagePostResponse.MessageSent.STATUS_USER_NOTFOUND
+    def dispatch_messages(self, msglist = ()):
+        '''Queues messages for dispatching on the next reactor iteration.'''
+        self._dispatch_queue.extend(msglist)
+        if self._dispatch_queue and not self._dispatch_call:
+            self._dispatch_call = reactor.callLater(0, self._dispatch)
 
-        # prepare message dict
-        msg_id = self.message_id()
+    def publish_ephemeral(self, sender, userids, headers, msg):
+        '''
+        Publish a message which needs no storage, acknowledgement or push
+        notification (e.g. presence) to several users, either generic or
+        specific. The message is sent right away to the consumer queues of the
+        recipients which are online and discarded for the others.
+        Returns the number of consumers the message was sent to.
+        '''
         outmsg = {
-            'messageid' : msg_id,
+            'messageid' : self.message_id(),
             'sender' : sender,
-            'recipient' : userid,
             'timestamp' : datetime.utcnow(),
-            'need_ack' : need_ack,
+            'need_ack' : MSG_ACK_NONE,
             'headers' : headers,
             'payload' : msg
         }
 
-        # process message on the next iteration
-        # FIXME is this safe? Check for race conditions
-        reactor.callLater(0, self._usermsg_worker, outmsg)
+        count = 0
+        remote = {}
+        for userid in userids:
+            if self.shards and not self.shards.is_local(userid):
+                remote.setdefault(self.shards.shard(userid), []).append(userid)
+
+            elif len(userid) == utils.USERID_LENGTH:
+                queues = self._consumers.get(userid)
+                if not queues:
+                    continue
+                for resource, q in queues.iteritems():
+                    # consumers might alter the message dict
+                    q.put(dict(outmsg, recipient=userid + resource))
+                    count += 1
+
+            elif len(userid) == utils.USERID_LENGTH_RESOURCE:
+                uhash, resource = utils.split_userid(userid)
+                try:
+                    q = self._consumers[uhash][resource]
+                except KeyError:
+                    continue
+                q.put(dict(outmsg, recipient=userid))
+                count += 1
+
+        for shard_id, uids in remote.iteritems():
+            self.shards.send(shard_id, 'ephemeral', sender, uids, headers, msg)
 
-        return msg_id
+        return count
 
     def ack_user(self, sender, msgid_list):
-        '''Manually acknowledge a message.'''
+        '''Manually acknowledge a message.
+        Returns a Deferred fired with a dict of msgid: success.'''
+        uhash, resource = utils.split_userid(sender)
+
+        def _ack(pending_msgs, stored_msgs, generic):
+            # result returned to the confirming client
+            res = {}
+            # message receipts grouped by recipient
+            rcpt_list = {}
+
+            db = dict((msg['messageid'], msg) for msg in pending_msgs)
+            stored = dict((msg['messageid'], msg) for msg in stored_msgs)
+            db.update(stored)
+            for msgid in msgid_list:
+                try:
+                    msg = db[msgid]
+
+                    # generic messages are receipted by the first resource only
+                    if msg['need_ack'] == MSG_ACK_BOUNCE and (msgid not in generic or generic[msgid][0]):
+                        #log.debug("found message to be acknowledged - %s" % msgid)
+
+                        # group receipts by user so we can batch send
+                        backuser = msg['sender']
+                        if backuser not in rcpt_list:
+                            rcpt_list[backuser] = []
+
+                        e = {
+                            'messageid' : msgid if 'originalid' not in msg else msg['originalid'],
+                            'storageid' : msgid,
+                            'status' : c2s.ReceiptMessage.Entry.STATUS_SUCCESS,
+                            'timestamp' : datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                        }
+                        rcpt_list[backuser].append(e)
 
-        # result returned to the confirming client
-        res = {}
-        # message receipts grouped by recipient
-        rcpt_list = {}
+                    res[msgid] = True
+
+                except:
+                    log.debug("message not found - %s" % msgid)
+                    res[msgid] = False
+
+            # push the receipts back to the senders
+            for backuser, msglist in rcpt_list.iteritems():
+                if len(backuser) != utils.USERID_LENGTH and len(backuser) != utils.USERID_LENGTH_RESOURCE:
+                    log.warn("invalid userid format: %s" % backuser)
+                    # mark the messages NOT SAFE to delete
+                    for m in msglist:
+                        res[m['storageid']] = False
+                    continue
 
-        # retrieve messages that needs to be acknowledged
-        # FIXME this is totally inefficient - this call will select all user
-        # messages everytime an ack request is sent by the client!!!
-        db = self.storage.load(sender)
+                # receipts will be merged with others for the same user
+                self._queue_receipt(sender, backuser, msglist)
+
+            # it's safe to delete the messages now
+            safe_list = []
+            generic_safe_list = []
+            # stored generic messages still waiting for other resources
+            acked_list = []
+            for msgid, safe in res.iteritems():
+                # generic messages are deleted when every resource they were delivered to acknowledged them
+                if msgid in generic and not generic[msgid][1]:
+                    if msgid in stored and safe:
+                        acked_list.append((msgid, resource, True))
+                    continue
 
+                if msgid in stored:
+                    if safe:
+                        if msgid in generic:
+                            generic_safe_list.append(msgid)
+                        else:
+                            safe_list.append(msgid)
+                elif msgid in db and not safe:
+                    # message was never written - store it now
+                    msg = db[msgid]
+                    self._store(msg['recipient'], msg).addErrback(self._error)
+
+            self.storage.delete_messages(sender, safe_list).addErrback(self._error)
+            self.storage.delete_messages(uhash, generic_safe_list).addErrback(self._error)
+            self._track_write(uhash, self.storage.update_deliveries(acked_list)).addErrback(self._error)
+
+            return res
+
+        # messages still waiting for ack in memory will never hit storage
+        pending_msgs = []
+        stored_list = []
+        # generic messages shared by several resources: msgid: (first ack, last ack)
+        generic = {}
+        generic_list = []
+        pending = self._pending_ack.get(sender, {})
+        generic_pending = self._pending_ack.get(uhash, {})
         for msgid in msgid_list:
             try:
-                # search message in list
-                msg = None
-                for entry in db:
-                    if entry['messageid'] == msgid:
-                        msg = entry
-                        break
-                if not msg:
-                    raise KeyError
-
-                if msg['need_ack'] == MSG_ACK_BOUNCE:
-                    #log.debug("found message to be acknowledged - %s" % msgid)
-
-                    # group receipts by user so we can batch send
-                    backuser = msg['sender']
-                    if backuser not in rcpt_list:
-                        rcpt_list[backuser] = []
-
-                    e = {
-                        'messageid' : msgid if 'originalid' not in msg else msg['originalid'],
-                        'storageid' : msgid,
-                        'status' : c2s.ReceiptMessage.Entry.STATUS_SUCCESS,
-                        'timestamp' : datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-                    }
-                    rcpt_list[backuser].append(e)
-
-                res[msgid] = True
+                msg, call = pending.pop(msgid)
+                call.cancel()
+                pending_msgs.append(msg)
+                continue
+            except KeyError:
+                pass
 
-            except:
-                log.debug("message not found - %s" % msgid)
-                res[msgid] = False
+            state = self._delivery_acked(sender, msgid)
+            if state is None:
+                stored_list.append(msgid)
+                continue
+
+            generic[msgid] = state
+            if msgid in generic_pending:
+                msg, call = generic_pending[msgid]
+                if state[1]:
+                    # every resource acknowledged it
+                    del generic_pending[msgid]
+                    call.cancel()
+                pending_msgs.append(msg)
+            else:
+                generic_list.append(msgid)
+
+        for uid, p in ((sender, pending), (uhash, generic_pending)):
+            if uid in self._pending_ack and not p:
+                del self._pending_ack[uid]
+
+        def _load(result):
+            jobs = [
+                self.storage.get_messages(sender, stored_list),
+                self.storage.get_messages(uhash, generic_list)
+            ]
+            return defer.gatherResults(jobs)
+
+        def _loaded(result):
+            stored_msgs, generic_msgs = result
+            return _ack(pending_msgs, stored_msgs + generic_msgs, generic)
+
+        # retrieve only the stored messages that needs to be acknowledged
+        d = self._writes_done(sender, uhash)
+        d.addCallback(_load)
+        d.addCallback(_loaded)
+        return d
+
+    def remote_lookup(self, users):
+        '''
+        Looks users up on the other servers, asking each server only for
+        users it has no cached result for. Returns a Deferred fired with the
+        list of found entries when all servers have answered or when the
+        lookup deadline passes, whichever comes first; late answers are
+        only cached.
+        '''
+        if not self.network:
+            # server-to-server services run in worker 0
+            def _failed(failure):
+                log.debug("error in lookup through worker 0: %s" % failure.getErrorMessage())
+                return []
+
+            return self.shards.lookup(users).addErrback(_failed)
+
+        found = {}
+        jobs = []
+
+        def _add(fingerprint, entries):
+            for e in entries:
+                found[(fingerprint, e['userid'])] = e
+
+        def _response((fingerprint, tx_id, data), ask):
+            results = dict((u, []) for u in ask)
+            for e in data.entry:
+                s = {
+                    'server': fingerprint,
+                    'userid' : e.user_id
+                }
+                if e.HasField('timestamp'):
+                    s['timestamp'] = e.timestamp
+                if e.HasField('status'):
+                    s['status'] = e.status
+
+                # specific or generic userid requested
+                for u in (e.user_id, e.user_id[:utils.USERID_LENGTH]):
+                    if u in results:
+                        results[u].append(s)
+
+            for u, entries in results.iteritems():
+                if entries:
+                    self._lookup_found.set((fingerprint, u), entries)
+                else:
+                    self._lookup_missing.set((fingerprint, u), True)
+            _add(fingerprint, sum(results.values(), []))
+
+        def _error(failure, fingerprint):
+            log.debug("error in lookup from %s: %s" % (fingerprint, failure.getErrorMessage()))
+
+        for fp in self.keyring:
+            # do not send to local server
+            if fp == self.fingerprint:
+                continue
+
+            ask = []
+            for u in users:
+                entries = self._lookup_found.get((fp, u))
+                if entries is not None:
+                    self._lookup_stats['hits'] += 1
+                    _add(fp, entries)
+                elif (fp, u) in self._lookup_missing:
+                    self._lookup_stats['negative_hits'] += 1
+                else:
+                    ask.append(u)
 
-        # push the receipts back to the senders
-        for backuser, msglist in rcpt_list.iteritems():
-            r = c2s.ReceiptMessage()
-            for m in msglist:
-                e = r.entry.add()
-                e.message_id = m['messageid']
-                e.status = m['status']
-                e.timestamp = m['timestamp']
-
-            if not self.publish_user(sender, backuser, { 'mime' : MIME_RECEIPT, 'flags' : [] }, r.SerializeToString(), MSG_ACK_MANUAL):
-                # mark the messages NOT SAFE to delete
-                for m in msglist:
-                    res[m['storageid']] = False
-
-        # it's safe to delete the messages now
-        for msgid, safe in res.iteritems():
-            if safe:
-                self.storage.delete(sender, msgid)
+            if ask:
+                self._lookup_stats['requests'] += 1
+                d = self.network.lookup(fp, ask)
+                d.addCallback(_response, ask)
+                d.addErrback(_error, fp)
+                jobs.append(d)
 
-        return res
+        if not jobs:
+            return defer.succeed(found.values())
 
-    def lookup_users(self, users):
-        '''Lookup users locally or remotely as needed.'''
-        lookup = []
-        local_users = []
-
-        for u in users:
-            data = self.usercache.get_user_data(u)
-            if data:
-                # hidden user - skip
-                if self.user_hidden(data['userid']):
-                    continue
+        result = defer.Deferred()
 
-                local_users.append(data)
-                # generic userid found in cache but not online, try remote lookup
-                if len(u) == utils.USERID_LENGTH and not self.user_online(u):
-                    lookup.append(u)
-            else:
-                if self.user_online(u):
-                    # user is online but didn't set any fields, put a dummy entry
-                    local_users.append({'userid' : u})
+        def _done(partial):
+            if not result.called:
+                if partial:
+                    self._lookup_stats['partial'] += 1
+                result.callback(found.values())
+
+        defer.DeferredList(jobs).addCallback(lambda _: _done(False))
+        timer = reactor.callLater(self.config['broker']['lookup.deadline'], _done, True)
+
+        def _cancel(res):
+            if timer.active():
+                timer.cancel()
+            return res
+
+        result.addBoth(_cancel)
+        return result
+
+    def lookup_stats(self):
+        stats = dict(self._lookup_stats)
+        stats['entries'] = len(self._lookup_found) + len(self._lookup_missing)
+        return stats
+
+    def lookup_users(self, users):
+        '''Lookup users locally or remotely as needed.
+        Returns a Deferred fired with the list of found users.'''
+
+        def _local(result):
+            lookup = []
+            local_users = []
+
+            for u, data in zip(users, result):
+                if data:
+                    # hidden user - skip
+                    if self.user_hidden(data['userid']):
+                        continue
+
+                    local_users.append(data)
+                    # generic userid found in cache but not online, try remote lookup
+                    if len(u) == utils.USERID_LENGTH and not self.user_online(u):
+                        lookup.append(u)
                 else:
-                    # remote lookup
-                    lookup.append(u)
-
-        if len(lookup) > 0:
-            # user deferred
-            duser = defer.Deferred()
-            def _lookup(result, local_users, deferred):
-                #log.debug("return from lookup: %s / %s / %s" % (result, local_users, deferred))
-                setup = local_users
-                for r in result:
-                    for e in r[2].entry:
-                        s = {
-                            'server': r[0],
-                            'userid' : e.user_id
-                        }
-                        if e.HasField('timestamp'):
-                            s['timestamp'] = e.timestamp
-                        if e.HasField('status'):
-                            s['status'] = e.status
-
-                        setup.append(s)
-                duser.callback(setup)
-
-            def _error(result, local_users, deferred):
-                log.debug("error in lookup: %s / %s / %s" % (result, local_users, deferred))
-                deferred.callback(local_users)
-
-            d = self.network.lookup_broadcast(lookup)
-            d.addCallback(_lookup, local_users, duser)
-            d.addErrback(_error, local_users, duser)
-            return duser
-        else:
-            return local_users
+                    if self.user_online(u):
+                        # user is online but didn't set any fields, put a dummy entry
+                        local_users.append({'userid' : u})
+                    else:
+                        # remote lookup
+                        lookup.append(u)
+
+            if len(lookup) > 0 and (self.network or self.shards):
+                def _lookup(result, local_users):
+                    #log.debug("return from lookup: %s / %s" % (result, local_users))
+                    return local_users + result
+
+                d = self.remote_lookup(lookup)
+                d.addCallback(_lookup, local_users)
+                return d
+            else:
+                return local_users
+
+        d = self.usercache.get_user_data_many(users)
+        d.addCallback(_local)
+        return d
@@ -21,14 +21,20 @@
 
 from twisted.internet.protocol import ServerFactory, connectionDone
 from twisted.internet.task import LoopingCall
-from twisted.internet import reactor, protocol, defer, error
+from twisted.internet import reactor, protocol, defer, error, interfaces
+from zope.interface import implements
 
-import time
+import time, heapq
+from collections import deque
+from txrdq.rdq import ResizableDispatchQueue
 from kontalklib import txprotobuf, utils
+import kontalklib.logging as log
 
 import kontalklib.c2s_pb2 as c2s
 import kontalklib.s2s_pb2 as s2s
 
+from cache import ExpiringCache, MISSING
+
 # in 30 seconds clients will be kicked out if they don't respond
 
 # how many seconds to wait for next idle signal
@@ -37,6 +43,135 @@ IDLE_DELAY = 15
 PING_DELAY = 15
 
 
+class SendBufferWatch:
+    '''
+    Streaming producer registered on a transport only to know whether its
+    send buffer is full: the transport pauses it when more than bufferSize
+    bytes are waiting to be written, and resumes it when they are written.
+    '''
+    implements(interfaces.IPushProducer)
+
+    def __init__(self, transport, size):
+        self.paused = False
+        transport.bufferSize = size
+        transport.registerProducer(self, True)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def stopProducing(self):
+        self.paused = False
+
+
+class ConsumerStopped(Exception):
+    '''Held data was not sent because its consumer queue was stopped.'''
+    pass
+
+
+class ConsumerQueue:
+    '''
+    Dispatch queue for a message consumer.
+    Queue width is adapted periodically to how fast the consumer is sending
+    data out, by looking at the time taken by the consumer to process a
+    message and at the amount of data still waiting to be sent.
+    When the queue is full, messages not needing ack are dropped, the others
+    are held and queued as soon as there is room.
+    '''
+
+    def __init__(self, worker, width, max_size):
+        self.worker = worker
+        self.max_width = width
+        self.max_size = max_size
+        # average time taken by the consumer to process a message
+        self.latency = 0
+        # messages dropped because the queue was full
+        self.dropped = 0
+        # messages needing ack waiting for room in the queue
+        self._held = deque()
+        self._latency_sum = 0
+        self._latency_count = 0
+        self._queue = ResizableDispatchQueue(self._incoming, width)
+
+    def _incoming(self, data):
+        start = time.time()
+
+        def _done(result):
+            self._latency_sum += time.time() - start
+            self._latency_count += 1
+            self._release()
+            return result
+
+        d = defer.maybeDeferred(self.worker.incoming, data)
+        d.addBoth(_done)
+        return d
+
+    def _need_ack(self, data):
+        if isinstance(data, list):
+            # mailbox
+            return any(msg['need_ack'] for msg in data)
+        return data['need_ack']
+
+    def put(self, data):
+        full = self.max_size and len(self) >= self.max_size
+        if full and not self._need_ack(data):
+            log.warn("consumer queue full - dropping data")
+            self.dropped += 1
+            return None
+
+        if full or self._held:
+            # keep order with messages already held
+            d = defer.Deferred()
+            self._held.append((data, d))
+            return d
+        return self._queue.put(data)
+
+    def _release(self):
+        '''Queues held messages while there is room.'''
+        while self._held and len(self) < self.max_size:
+            data, d = self._held.popleft()
+            self._queue.put(data).chainDeferred(d)
+
+    def held(self):
+        return len(self._held)
+
+    def stop(self, *args):
+        held, self._held = self._held, deque()
+        for data, d in held:
+            d.errback(ConsumerStopped())
+        return self._queue.stop(*args)
+
+    def width(self):
+        return self._queue.width
+
+    def adapt(self, buffer_max, latency_max):
+        '''
+        Shrinks the queue if the consumer is slow or its send buffer is full,
+        grows it back to the configured width otherwise.
+        '''
+        if self._latency_count > 0:
+            self.latency = self._latency_sum / self._latency_count
+        self._latency_sum = 0
+        self._latency_count = 0
+
+        width = self._queue.width
+        if self.worker.send_blocked(buffer_max):
+            # hold everything until the send buffer is drained
+            width = 0
+        elif self.latency > latency_max:
+            width = max(1, width / 2)
+        elif width < self.max_width:
+            width += 1
+
+        if width != self._queue.width:
+            self._queue.width = width
+
+    def __len__(self):
+        return len(self._queue.pending())
+
+
 class InternalServerProtocol(txprotobuf.Protocol):
 
     def connectionMade(self):
@@ -58,20 +193,81 @@ class S2SMessageServerProtocol(InternalServerProtocol):
 
 
 class S2SRequestServerProtocol(txprotobuf.DatagramProtocol):
-    '''Server-to-server request protocol.'''
+    '''
+    Server-to-server request protocol.
+    Requests are retransmitted with exponential backoff until a response
+    arrives or their deadline passes; retransmissions use the same tx_id,
+    so requests received more than once are answered from the responses
+    sent before and late or duplicate responses are dropped.
+    '''
 
-    '''Timeout delay.'''
-    timeout_delay = 5
+    '''Maximum number of remembered received requests.'''
+    seen_max_size = 10000
 
     def __init__(self, config):
         txprotobuf.DatagramProtocol.__init__(self, s2s)
-        '''Map of packets waiting for a response.'''
+        '''Timeout delay.'''
+        self.timeout_delay = config['server']['s2s.request_timeout']
+        '''Delay before the first retransmission, doubled at every retransmission.'''
+        self.retransmit_delay = config['server']['s2s.retransmit_delay']
+        self.retransmit_max = config['server']['s2s.retransmit_max']
+        '''Map of packets waiting for a response: (fingerprint, tx_id) -> transaction.'''
         self._tx = {}
-
-    def _timeout(self, user_defer):
-        '''Handles a deferred timeout.'''
-        if not user_defer.called:
-            user_defer.errback(error.TimeoutError('Server did not respond.'))
+        '''Retransmission and timeout events, as a heap of (time, (fingerprint, tx_id)).'''
+        self._events = []
+        self._timer = None
+        '''Requests received recently, with the response sent (None while processing).'''
+        self._seen = ExpiringCache(self.timeout_delay * 2, self.seen_max_size)
+        self.stats = { 'sent' : 0, 'retransmits' : 0, 'replies' : 0, 'timeouts' : 0, 'duplicates' : 0 }
+
+    def in_flight(self):
+        return len(self._tx)
+
+    def _schedule(self, when, key):
+        heapq.heappush(self._events, (when, key))
+        if self._timer is None or not self._timer.active():
+            self._timer = reactor.callLater(max(0, when - time.time()), self._run_events)
+        elif when < self._timer.getTime():
+            self._timer.reset(max(0, when - time.time()))
+
+    def _run_events(self):
+        '''Retransmits or expires transactions whose next event is due.'''
+        self._timer = None
+        now = time.time()
+        while self._events and self._events[0][0] <= now:
+            when, key = heapq.heappop(self._events)
+            tx = self._tx.get(key)
+            # already answered
+            if not tx:
+                continue
+
+            if now >= tx['deadline']:
+                self._timeout(key)
+            else:
+                tx['retries'] += 1
+                self.stats['retransmits'] += 1
+                txprotobuf.DatagramProtocol.sendBox(self, tx['addr'], tx['data'], key[1])
+                self._schedule(self._next_event(tx), key)
+
+        if self._events and self._timer is None:
+            self._timer = reactor.callLater(max(0, self._events[0][0] - now), self._run_events)
+
+    def _next_event(self, tx):
+        if tx['retries'] >= self.retransmit_max:
+            return tx['deadline']
+        return min(time.time() + self.retransmit_delay * 2 ** tx['retries'], tx['deadline'])
+
+    def _timeout(self, key):
+        '''Handles a transaction timeout.'''
+        self.stats['timeouts'] += 1
+        tx = self._tx.pop(key)
+        tx['deferred'].errback(error.TimeoutError('Server did not respond.'))
+
+    def _reply(self, fingerprint, tx_id, data):
+        '''Sends a response, keeping it for retransmitted requests.'''
+        self._seen.set((fingerprint, tx_id), data)
+        # we don't want a deferred for a response packet
+        txprotobuf.DatagramProtocol.sendBox(self, self.keyring.s2s_addr(fingerprint), data, tx_id)
 
     def boxReceived(self, fingerprint, tx_id, data):
         # optional reply
@@ -81,43 +277,62 @@ class S2SRequestServerProtocol(txprotobuf.DatagramProtocol):
 
         fingerprint = str(fingerprint)
         tx_id = str(tx_id)
-
-        # tx is pending response
-        if fingerprint in self._tx and tx_id in self._tx[fingerprint]:
-            self._tx[fingerprint][tx_id].callback((str(fingerprint), tx_id, data))
-            del self._tx[fingerprint][tx_id]
-
-        # process requests anyway
+        key = (fingerprint, tx_id)
+
+        if name.endswith('Response'):
+            tx = self._tx.pop(key, None)
+            # tx is pending response
+            if tx:
+                self.stats['replies'] += 1
+                tx['deferred'].callback((str(fingerprint), tx_id, data))
+            else:
+                # response to an expired or already answered request
+                self.stats['duplicates'] += 1
+            return
+
+        # retransmitted request
+        response = self._seen.get(key, MISSING)
+        if response is not MISSING:
+            self.stats['duplicates'] += 1
+            if response:
+                txprotobuf.DatagramProtocol.sendBox(self, self.keyring.s2s_addr(fingerprint), response, tx_id)
+            return
+        self._seen.set(key, None)
 
         if name == 'UserPresence':
             self.service.user_presence(fingerprint, str(data.user_id), data.event, data.status_message)
 
         elif name == 'UserLookupRequest':
+            def lookup_complete(found, fingerprint, tx_id):
+                r = c2s.UserLookupResponse()
+                for u in found:
+                    e = r.entry.add()
+                    e.user_id = u['userid']
+                    if 'status' in u and u['status']:
+                        e.status = u['status']
+                    if 'timestamp' in u:
+                        e.timestamp = u['timestamp']
+                    if 'timediff' in u:
+                        e.timediff = u['timediff']
+                self._reply(fingerprint, tx_id, r)
+
             found = self.service.lookup_users(fingerprint, [str(x) for x in data.user_id])
-            r = c2s.UserLookupResponse()
-            print "FOUND", found
-            for u in found:
-                e = r.entry.add()
-                e.user_id = u['userid']
-                if 'status' in u and u['status']:
-                    e.status = u['status']
-                if 'timestamp' in u:
-                    e.timestamp = u['timestamp']
-                if 'timediff' in u:
-                    e.timediff = u['timediff']
+            found.addCallback(lookup_complete, fingerprint, tx_id)
 
         if r:
-            # we don't want a deferred for a response packet
-            txprotobuf.DatagramProtocol.sendBox(self, self.keyring.s2s_addr(fingerprint), r, tx_id)
+            self._reply(fingerprint, tx_id, r)
 
     def sendBox(self, fingerprint, data, tx_id = None):
-        tx_id = txprotobuf.DatagramProtocol.sendBox(self, self.keyring.s2s_addr(fingerprint), data, tx_id)
+        addr = self.keyring.s2s_addr(fingerprint)
+        tx_id = txprotobuf.DatagramProtocol.sendBox(self, addr, data, tx_id)
+        self.stats['sent'] += 1
         # store the request
         d = defer.Deferred()
-        if fingerprint not in self._tx:
-            self._tx[fingerprint] = dict()
-        self._tx[fingerprint][tx_id] = d
-        reactor.callLater(self.timeout_delay, self._timeout, d)
+        key = (fingerprint, tx_id)
+        tx = { 'deferred' : d, 'addr' : addr, 'data' : data, 'retries' : 0,
+            'deadline' : time.time() + self.timeout_delay }
+        self._tx[key] = tx
+        self._schedule(self._next_event(tx), key)
 
         return tx_id, d
 
@@ -190,6 +405,13 @@ class C2SServerProtocol(InternalServerProtocol):
         self.service.ping_timeout()
         self.pinger = None
 
+    def loginAdopted(self, userid, tx_id, client_protocol, flags):
+        '''Completes a login started by another worker process.'''
+        r = c2s.LoginResponse()
+        (r.status, userid) = self.service.login_user(tx_id, userid, client_protocol, flags)
+        r.user_id = userid
+        self.sendBox(r, tx_id)
+
     def boxReceived(self, data, tx_id = None):
         # reset idler
         try:
@@ -202,24 +424,39 @@ class C2SServerProtocol(InternalServerProtocol):
         name = data.__class__.__name__
 
         if name == 'LoginRequest':
-            r = c2s.LoginResponse()
-            (r.status, userid) = self.service.login(str(tx_id), data.token, data.client_protocol, data.client_version, data.flags)
-            if userid:
-                r.user_id = userid
+            # token verification is deferred to the crypto pool
+            def login_complete((status, userid), tx_id, return_value = False):
+                # no status: connection was handed over to another worker
+                if status is None:
+                    return None
+                r = c2s.LoginResponse()
+                r.status = status
+                if userid:
+                    r.user_id = userid
+                if return_value:
+                    return r
+                else:
+                    self.sendBox(r, tx_id)
+
+            res = self.service.login(str(tx_id), data.token, data.client_protocol, data.client_version, data.flags)
+            if isinstance(res, defer.Deferred):
+                res.addCallback(login_complete, tx_id)
+            else:
+                r = login_complete(res, tx_id, True)
 
         elif name == 'AuthenticateRequest':
-            r = c2s.AuthenticateResponse()
-            r.valid = self.service.authenticate(str(tx_id), data.token)
+            def auth_complete(valid, tx_id):
+                r = c2s.AuthenticateResponse()
+                r.valid = valid
+                self.sendBox(r, tx_id)
+
+            self.service.authenticate(str(tx_id), data.token).addCallback(auth_complete, tx_id)
 
         elif name == 'MessagePostRequest':
             if self.service.is_logged():
-                r = c2s.MessagePostResponse()
-                if len(data.recipient) > 0:
-                    res = self.service.post_message(str(tx_id),
-                        tuple(data.recipient),
-                        str(data.mime),
-                        tuple(data.flags),
-                        data.content)
+                # attachments need a storage lookup, so posting can be deferred
+                def post_complete(res, tx_id, return_value = False):
+                    r = c2s.MessagePostResponse()
                     for userid, msgid in res.iteritems():
                         me = r.entry.add()
                         me.user_id = userid
@@ -230,25 +467,48 @@ class C2SServerProtocol(InternalServerProtocol):
                             me.status = msgid
                         else:
                             me.status = c2s.MessagePostResponse.MessageSent.STATUS_ERROR
+                    if return_value:
+                        return r
+                    else:
+                        self.sendBox(r, tx_id)
+
+                if len(data.recipient) > 0:
+                    res = self.service.post_message(str(tx_id),
+                        tuple(data.recipient),
+                        str(data.mime),
+                        tuple(data.flags),
+                        data.content)
+                    if isinstance(res, defer.Deferred):
+                        res.addCallback(post_complete, tx_id)
+                    else:
+                        r = post_complete(res, tx_id, True)
+                else:
+                    r = c2s.MessagePostResponse()
 
         elif name == 'MessageAckRequest':
             if self.service.is_logged():
-                r = c2s.MessageAckResponse()
-                res = self.service.ack_message(str(tx_id), tuple(data.message_id))
-                for _msgid in data.message_id:
-                    msgid = str(_msgid)
-                    e = r.entry.add()
-                    e.message_id = msgid
-                    try:
-                        success = res[msgid]
-                        if success:
-                            e.status = c2s.MessageAckResponse.Entry.STATUS_SUCCESS
-                        else:
-                            e.status = c2s.MessageAckResponse.Entry.STATUS_NOTFOUND
-                    except:
-                        import traceback
-                        traceback.print_exc()
-                        e.status = c2s.MessageAckResponse.Entry.STATUS_ERROR
+                # acknowledgement needs a storage lookup, so defer it
+                def ack_complete(res, tx_id, message_ids):
+                    r = c2s.MessageAckResponse()
+                    for _msgid in message_ids:
+                        msgid = str(_msgid)
+                        e = r.entry.add()
+                        e.message_id = msgid
+                        try:
+                            success = res[msgid]
+                            if success:
+                                e.status = c2s.MessageAckResponse.Entry.STATUS_SUCCESS
+                            else:
+                                e.status = c2s.MessageAckResponse.Entry.STATUS_NOTFOUND
+                        except:
+                            import traceback
+                            traceback.print_exc()
+                            e.status = c2s.MessageAckResponse.Entry.STATUS_ERROR
+                    self.sendBox(r, tx_id)
+
+                message_ids = tuple(data.message_id)
+                res = self.service.ack_message(str(tx_id), message_ids)
+                res.addCallback(ack_complete, tx_id, message_ids)
 
         elif name == 'RegistrationRequest':
             if not self.service.is_logged():
@@ -291,10 +551,7 @@ class C2SServerProtocol(InternalServerProtocol):
 
                 # force generic users only
                 found = self.service.lookup_users(tx_id, [str(x)[:utils.USERID_LENGTH] for x in data.user_id])
-                if isinstance(found, defer.Deferred):
-                    found.addCallback(lookup_complete, tx_id)
-                else:
-                    r = lookup_complete(found, tx_id, True)
+                found.addCallback(lookup_complete, tx_id)
 
         elif name == 'ServerInfoRequest':
             r = c2s.ServerInfoResponse()
@@ -307,7 +564,14 @@ class C2SServerProtocol(InternalServerProtocol):
 
         elif name == 'UserInfoUpdateRequest':
             if self.service.is_logged():
-                r = c2s.UserInfoUpdateResponse()
+                def update_complete(status, tx_id, return_value = False):
+                    r = c2s.UserInfoUpdateResponse()
+                    r.status = status
+                    if return_value:
+                        return r
+                    else:
+                        self.sendBox(r, tx_id)
+
                 flags = None
                 if data.HasField('flags'):
                     flags = data.flags
@@ -320,7 +584,11 @@ class C2SServerProtocol(InternalServerProtocol):
                 else:
                     google_regid = None
 
-                r.status = self.service.user_update(flags, status_msg, google_regid)
+                status = self.service.user_update(flags, status_msg, google_regid)
+                if isinstance(status, defer.Deferred):
+                    status.addCallback(update_complete, tx_id)
+                else:
+                    r = update_complete(status, tx_id, True)
 
         elif name == 'UserPresenceSubscribeRequest':
             if self.service.is_logged():
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+'''In-memory caches.'''
+'''
+  Kontalk Pyserver
+  Copyright (C) 2011 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+from collections import OrderedDict
+
+
+# marks a cache miss, as None is a valid cached value
+MISSING = object()
+
+
+class ExpiringCache:
+    '''A bounded mapping whose entries expire; evicts in least recently used order.'''
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        '''key -> (expire time, value)'''
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def get(self, key, default=None):
+        try:
+            expire, value = self._entries.pop(key)
+        except KeyError:
+            return default
+
+        if expire < time.time():
+            return default
+
+        # most recently used
+        self._entries[key] = (expire, value)
+        return value
+
+    def set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + self.ttl, value)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(False)
+
+    def pop(self, key, default=None):
+        try:
+            return self._entries.pop(key)[1]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self._entries.clear()
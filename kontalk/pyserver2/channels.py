@@ -29,6 +29,7 @@ import kontalklib.c2s_pb2 as c2s
 import kontalklib.s2s_pb2 as s2s
 
 import version, broker
+from broker_twisted import SendBufferWatch
 
 def protoservice(func):
     '''Apply this decorator to methods callable by protocol classes.'''
@@ -40,6 +41,8 @@ class C2SChannel:
 
     # default protocol is legacy
     client_protocol = version.DEFAULT_CLIENT_PROTOCOL
+    # consumer queue configuration to use
+    queue_type = 'c2s'
 
     def __init__(self, protocol, broker, config):
         self.protocol = protocol
@@ -48,11 +51,14 @@ class C2SChannel:
         self.flags = 0
         self.userid = None
         self.zombie = False
+        self._send_watch = None
 
     @protoservice
     def connected(self):
         addr = self.protocol.transport.getPeer()
         log.debug("new client connection from %s" % addr.host)
+        # tells when the client is not reading fast enough
+        self._send_watch = SendBufferWatch(self.protocol.transport, self.config['broker']['queue.buffer_max'])
         return self.serverinfo()
 
     @protoservice
@@ -76,45 +82,66 @@ class C2SChannel:
         if client_protocol < version.CLIENT_PROTOCOL:
             return c2s.LoginResponse.STATUS_PROTOCOL_MISMATCH, None
 
-        if client_protocol:
-            self.client_protocol = client_protocol
-        self.flags = flags
+        def _verified(userid):
+            # client disconnected while its token was being verified
+            if not self.protocol.transport.connected:
+                return None, None
 
-        try:
-            userid = token.verify_user_token(auth_token, self.broker.keyring, str(self.config['server']['fingerprint']))
-        except:
-            import traceback
-            traceback.print_exc()
+            if userid:
+                shards = self.broker.shards
+                if shards and not shards.is_local(userid):
+                    # user belongs to another worker process, which will reply
+                    log.debug("[%s] handing user %s over to worker %d" % (tx_id, userid, shards.shard(userid)))
+                    shards.handoff(self.protocol.transport, userid, tx_id, client_protocol, flags)
+                    return None, None
+
+                return self.login_user(tx_id, userid, client_protocol, flags)
+
+            return c2s.LoginResponse.STATUS_AUTH_FAILED, None
+
+        d = self._verify_token(tx_id, auth_token)
+        d.addCallback(_verified)
+        return d
+
+    def _verify_token(self, tx_id, auth_token):
+        '''Verifies a token in the crypto pool; fires with the userid or None.'''
+        def _failed(failure):
+            failure.printTraceback()
             log.debug("[%s] token verification failed: %s" % (tx_id, auth_token))
-            userid = None
 
-        if userid:
-            log.debug("[%s] user %s logged in." % (tx_id, userid))
-            self.userid = userid
-            self.broker.register_user_consumer(userid, self, self.can_broadcast_presence(), self.supports_mailbox())
-            return c2s.LoginResponse.STATUS_LOGGED_IN, self.userid
+        d = self.broker.crypto.verify_user_token(auth_token, self.broker.keyring)
+        d.addErrback(_failed)
+        return d
 
-        return c2s.LoginResponse.STATUS_AUTH_FAILED, None
+    @protoservice
+    def login_user(self, tx_id, userid, client_protocol = None, flags = 0):
+        '''Logs in an authenticated user.'''
+        if client_protocol:
+            self.client_protocol = client_protocol
+        self.flags = flags
+
+        log.debug("[%s] user %s logged in." % (tx_id, userid))
+        self.userid = userid
+        self.broker.register_user_consumer(userid, self, self.can_broadcast_presence(), self.supports_mailbox())
+        return c2s.LoginResponse.STATUS_LOGGED_IN, self.userid
 
     @protoservice
     def authenticate(self, tx_id, auth_token):
         '''Client tried to authenticate.'''
         log.debug("[%s] deprecated authentication mode" % (tx_id, ))
-        try:
-            userid = token.verify_user_token(auth_token, self.broker.keyring, str(self.config['server']['fingerprint']))
-        except:
-            import traceback
-            traceback.print_exc()
-            log.debug("[%s] token verification failed: %s" % (tx_id, auth_token))
-            userid = None
 
-        if userid:
-            log.debug("[%s] user %s logged in." % (tx_id, userid))
-            self.userid = userid
-            self.broker.register_user_consumer(userid, self)
-            return True
+        def _verified(userid):
+            if userid and self.protocol.transport.connected:
+                log.debug("[%s] user %s logged in." % (tx_id, userid))
+                self.userid = userid
+                self.broker.register_user_consumer(userid, self)
+                return True
 
-        return False
+            return False
+
+        d = self._verify_token(tx_id, auth_token)
+        d.addCallback(_verified)
+        return d
 
     @protoservice
     def serverinfo(self, tx_id = None, client_version = None, client_protocol = None):
@@ -150,40 +177,49 @@ class C2SChannel:
         attachment = 'attachment' in flags
         if attachment and mime in self.config['fileserver']['accept_content']:
             fileid = str(content)
+
+            def _attachment(info):
+                (filename, _mime, _md5sum) = info
+                # TODO risking thumbnail larger than the max allowed size
+                content = utils.generate_preview_content(filename, mime)
+                # update userids
+                d = self.broker.storage.update_extra_storage(fileid, recipient)
+                d.addCallback(lambda _: self._post_message(tx_id, recipient, mime, flags, content, fileid))
+                return d
+
             # TODO check for errors
-            (filename, _mime, _md5sum) = self.broker.storage.get_extra(fileid, '')
-            # update userids
-            self.broker.storage.update_extra_storage(fileid, recipient)
-            # TODO risking thumbnail larger than the max allowed size
-            content = utils.generate_preview_content(filename, mime)
+            d = self.broker.storage.get_extra(fileid, '')
+            d.addCallback(_attachment)
+            return d
         else:
-            filename = None
-
-        res = {}
-        for rcpt in recipient:
-            u = str(rcpt)
-            length = len(content)
-            mime_supported = mime in self.config['fileserver']['accept_content'] \
-                if attachment else mime in self.config['broker']['accept_content']
-            if not mime_supported:
-                log.debug("[%s] mime type not supported: %s - dropping" % \
-                    (tx_id, mime))
-                res[u] = c2s.MessagePostResponse.MessageSent.STATUS_NOTSUPPORTED
-            elif length > self.config['broker']['max_size']:
-                log.debug("[%s] message too big (%d bytes) - dropping" % \
-                    (tx_id, length))
-                res[u] = c2s.MessagePostResponse.MessageSent.STATUS_BIG
-            else:
-                misc = {
-                    'mime' : mime,
-                    'flags' : flags
-                }
-                if filename:
-                    misc['filename'] = fileid
+            return self._post_message(tx_id, recipient, mime, flags, content)
+
+    def _post_message(self, tx_id, recipient, mime, flags, content, filename = None):
+        '''Publishes a posted message to its recipients.'''
+        attachment = 'attachment' in flags
+        length = len(content)
+        mime_supported = mime in self.config['fileserver']['accept_content'] \
+            if attachment else mime in self.config['broker']['accept_content']
+        if not mime_supported:
+            log.debug("[%s] mime type not supported: %s - dropping" % \
+                (tx_id, mime))
+            status = c2s.MessagePostResponse.MessageSent.STATUS_NOTSUPPORTED
+        elif length > self.config['broker']['max_size']:
+            log.debug("[%s] message too big (%d bytes) - dropping" % \
+                (tx_id, length))
+            status = c2s.MessagePostResponse.MessageSent.STATUS_BIG
+        else:
+            misc = {
+                'mime' : mime,
+                'flags' : flags
+            }
+            if filename:
+                misc['filename'] = filename
 
-                res[u] = self.broker.publish_user(self.userid, u, misc, content, broker.MSG_ACK_BOUNCE)
+            # a single message shared by all recipients
+            return self.broker.publish_users(self.userid, [str(rcpt) for rcpt in recipient], misc, content, broker.MSG_ACK_BOUNCE)
 
-        return res
+        return dict((str(rcpt), status) for rcpt in recipient)
 
     @protoservice
     def ack_message(self, tx_id, messages):
@@ -192,11 +228,9 @@ class C2SChannel:
 
     @protoservice
     def lookup_users(self, tx_id, users):
-        # setup a deferred to return
-        d = defer.Deferred()
         start = time.time()
 
-        def _stat_found(found, deferred = True):
+        def _stat_found(found):
             end = time.time()
             #log.debug("lookup of %d users took %.2f seconds (found %d users)" % (len(users), end-start, len(found)))
 
@@ -234,18 +268,11 @@ class C2SChannel:
                             ret[userid]['status'] = stat['status']
 
             #log.debug("RESULT/%s" % (ret,))
-            ret = ret.values()
-            if deferred:
-                d.callback(ret)
-            else:
-                return ret
+            return ret.values()
 
-        dstat = self.broker.lookup_users(users)
-        if isinstance(dstat, defer.Deferred):
-            dstat.addCallback(_stat_found)
-            return d
-        else:
-            return _stat_found(dstat, False)
+        d = self.broker.lookup_users(users)
+        d.addCallback(_stat_found)
+        return d
 
     @protoservice
     def user_update(self, flags = None, status_msg = None, google_regid = None):
@@ -267,16 +294,22 @@ class C2SChannel:
             google_regid = google_regid.strip()
             fields['google_registrationid'] = google_regid if len(google_regid) > 0 else None
 
-        try:
-            self.broker.usercache.set_user_data(self.userid, fields)
+        def _updated(result):
+            if self.broker.push_manager:
+                self.broker.push_manager.user_updated(self.userid, fields)
             if 'status' in fields:
                 self.broker.broadcast_presence(self.userid, c2s.UserPresence.EVENT_STATUS_CHANGED, fields['status'], not self.can_broadcast_presence())
             return c2s.UserInfoUpdateResponse.STATUS_SUCCESS
-        except:
-            import traceback
-            traceback.print_exc()
+
+        def _error(failure):
+            failure.printTraceback()
             return c2s.UserInfoUpdateResponse.STATUS_ERROR
 
+        d = self.broker.usercache.set_user_data(self.userid, fields)
+        d.addCallback(_updated)
+        d.addErrback(_error)
+        return d
+
     def can_broadcast_presence(self):
         return self.flags & c2s.FLAG_HIDE_PRESENCE == 0
 
@@ -304,7 +337,7 @@ class C2SChannel:
             # delete verification entry in validations table
             valdb.delete(code)
             # touch user so we get a first presence
-            self.broker.usercache.touch_user(userid)
+            self.broker.usercache.touch_user(userid).addErrback(self.broker._error)
 
             # here is your token
             log.debug("[%s] generating token for %s" % (tx_id, userid))
@@ -402,6 +435,7 @@ class C2SChannel:
             return False
 
     def _incoming_box(self, data, a = None):
+        '''Fills a NewMessage box. Returns a Deferred fired with the box.'''
         # TODO check for missing keys
         # TODO avoid using c2s directly; instead create a method in C2SServerProtocol
         if not a:
@@ -417,12 +451,22 @@ class C2SChannel:
         a.need_ack = (data['need_ack'] != broker.MSG_ACK_NONE)
         if 'filename' in data['headers']:
             a.url = self.config['fileserver']['download_url'] % data['headers']['filename']
-            try:
-                (filename, _mime, _md5sum) = self.broker.storage.get_extra(data['headers']['filename'], self.userid)
+
+            def _length(info):
+                (filename, _mime, _md5sum) = info
                 a.length = os.path.getsize(filename)
-            except:
+                return a
+
+            def _error(failure):
                 log.warn("attachment not found, unable to send length out")
-        return a
+                return a
+
+            d = self.broker.storage.get_extra(data['headers']['filename'], self.userid)
+            d.addCallback(_length)
+            d.addErrback(_error)
+            return d
+
+        return defer.succeed(a)
 
     @protoservice
     def incoming(self, data):
@@ -432,13 +476,21 @@ class C2SChannel:
         # mailbox
         if type(data) == list:
             pack = c2s.Mailbox()
-            for msg in data:
-                a = pack.message.add()
-                self._incoming_box(msg, a)
+            jobs = [self._incoming_box(msg, pack.message.add()) for msg in data]
+            d = defer.gatherResults(jobs)
+            d.addCallback(lambda _: self.protocol.sendBox(pack))
         else:
-            pack = self._incoming_box(data)
+            d = self._incoming_box(data)
+            d.addCallback(self.protocol.sendBox)
+
+        return d
 
-        return self.protocol.sendBox(pack)
+    def send_blocked(self, buffer_max):
+        '''
+        Returns true if the data waiting to be written to the client exceeds
+        buffer_max (already set as the transport buffer size on connection).
+        '''
+        return self._send_watch is not None and self._send_watch.paused
 
     @protoservice
     def conflict(self):
@@ -484,10 +536,12 @@ class S2SRequestChannel:
                 jobs.append(d)
         return defer.gatherResults(jobs)
 
-    def lookup_broadcast(self, users):
+    def lookup(self, fingerprint, users):
+        '''Sends a lookup request to a single server.'''
         r = s2s.UserLookupRequest()
         r.user_id.extend(users)
-        return self.broadcast(r)
+        tx_id, d = self.protocol.sendBox(fingerprint, r)
+        return d
 
     @protoservice
     def user_presence(self, fingerprint, userid, event, status = None):
@@ -498,20 +552,28 @@ class S2SRequestChannel:
     def lookup_users(self, fingerprint, users):
         '''Lookup users connected locally.'''
         log.debug("request lookup from %s for %s" % (fingerprint, users))
-        ret = []
-        for u in users:
-            nstat = {'userid' : u}
-            stat = self.broker.usercache.get_user_data(u)
-            if stat:
+
+        def _found(result):
+            ret = []
+            for u, stat in zip(users, result):
+                # unknown users are left out, so they can be cached as missing
+                if not stat:
+                    continue
+
+                nstat = {'userid' : u}
                 if stat['status']:
                     nstat['status'] = stat['status']
 
                 if not self.broker.user_online(u):
                     nstat['timestamp'] = stat['timestamp']
 
-            ret.append(nstat)
-        log.debug("lookup will return %s" % (ret, ))
-        return ret
+                ret.append(nstat)
+            log.debug("lookup will return %s" % (ret, ))
+            return ret
+
+        d = self.broker.usercache.get_user_data_many(users)
+        d.addCallback(_found)
+        return d
 
 
 class S2SMessageChannel:
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+'''GPG operations worker pool.'''
+'''
+  Kontalk Pyserver
+  Copyright (C) 2011 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from twisted.internet import reactor, threads, defer
+from twisted.python import threadpool
+
+from kontalklib import token
+
+from cache import MISSING
+
+
+class CryptoPool:
+    '''
+    Runs GPG operations in a pool of threads, so they don't block the
+    reactor. Every thread keeps its own GPGME contexts (see
+    keyring.data_context), created on first use and reused afterwards.
+    All operations return a Deferred.
+    The pool is stopped during reactor shutdown, like the reactor thread pool.
+    '''
+
+    def __init__(self, size):
+        self._pool = threadpool.ThreadPool(1, size, 'crypto')
+        self.stats = { 'trust' : 0, 'token' : 0 }
+
+    def start(self):
+        self._pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+    def pending(self):
+        '''Returns the number of busy threads and queued operations.'''
+        return len(self._pool.working), self._pool.q.qsize()
+
+    def _run(self, op, func, *args):
+        self.stats[op] += 1
+        return threads.deferToThreadPool(reactor, self._pool, func, *args)
+
+    def compute_keyring(self, kr, servers):
+        '''Computes the trust tables of a server list (see Keyring.compute).'''
+        return self._run('trust', kr.compute, servers)
+
+    def verify_user_token(self, auth_token, kr):
+        '''Verifies a user token using the keyring verified tokens cache.'''
+        tokens = kr.tokens
+        userid = tokens.get(auth_token)
+        if userid is not MISSING:
+            return defer.succeed(userid)
+
+        generation = tokens.generation
+        d = self._run('token', token.verify_user_token, auth_token, kr, kr.fingerprint)
+        d.addCallback(lambda userid: tokens.set(auth_token, userid, generation=generation))
+        return d
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''Pooled, thread-offloaded database connections.'''
+'''
+  Kontalk Pyserver
+  Copyright (C) 2011 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+
+from twisted.enterprise import adbapi
+
+from kontalklib import database
+import kontalklib.logging as log
+
+
+class ConnectionPool(adbapi.ConnectionPool):
+    '''
+    A twisted.enterprise.adbapi connection pool whose connections are created
+    through database.connect_config, so they are set up exactly like the
+    main broker connection.
+    Every query runs in one of the pool threads and returns a Deferred.
+    '''
+
+    def __init__(self, config):
+        self._config = config
+        adbapi.ConnectionPool.__init__(self, 'oursql',
+            cp_min=config['database']['pool.min'],
+            cp_max=config['database']['pool.max'],
+            cp_noisy=False,
+            cp_reconnect=True)
+
+    def connect(self):
+        '''Returns the connection for the current pool thread, creating it if needed.'''
+        if self.running == 0:
+            raise adbapi.ConnectionNotOpen
+        tid = self.threadID()
+        conn = self.connections.get(tid)
+        if conn is None:
+            log.debug("opening pooled database connection")
+            conn = database.connect_config(self._config)
+            self.connections[tid] = conn
+        return conn
+
+    def run_query(self, table, method, *args, **kwargs):
+        '''
+        Calls method on a kontalklib.database table helper (e.g.
+        database.messages) bound to a pooled connection.
+        Returns a Deferred firing with the method return value.
+        '''
+        def _query(conn):
+            return getattr(table(conn), method)(*args, **kwargs)
+        return self.runWithConnection(_query)
+
+    def run_chunked(self, chunk, limit, budget, *args):
+        '''
+        Calls chunk(conn, limit, *args) repeatedly in a pool thread,
+        committing after every call, until it affects less than limit rows
+        or budget seconds have passed. chunk returns the number of affected
+        rows, or None if unknown (it will be called only once).
+        Returns a Deferred fired with a tuple (rows, seconds, complete).
+        '''
+        def _run(conn):
+            start = time.time()
+            rows = 0
+            while True:
+                count = chunk(conn, limit, *args)
+                conn.commit()
+                elapsed = time.time() - start
+                if count is None:
+                    return None, elapsed, True
+                rows += count
+                if count < limit:
+                    return rows, elapsed, True
+                if elapsed >= budget:
+                    return rows, elapsed, False
+
+        return self.runWithConnection(_run)
+
+
+def connect_config(config):
+    '''Creates a connection pool from the server configuration.'''
+    return ConnectionPool(config)
@@ -32,6 +32,7 @@ from twisted.cred.portal import IRealm, Portal
 from twisted.web.guard import HTTPAuthSessionWrapper
 
 from kontalklib import database, token, utils
+import kontalklib.c2s_pb2 as c2s
 import broker, version, storage
 
 
@@ -74,6 +75,11 @@ class BaseRequest(resource.Resource):
         else:
             output = self.method(request)
 
+        if isinstance(output, defer.Deferred):
+            output.addCallback(self._render_deferred, request)
+            output.addErrback(self._render_error, request)
+            return server.NOT_DONE_YET
+
         if output != server.NOT_DONE_YET:
             if output:
                 return json.dumps(output)
@@ -83,6 +89,18 @@ class BaseRequest(resource.Resource):
         # return raw output
         return output
 
+    def _render_deferred(self, output, request):
+        if output:
+            request.write(json.dumps(output))
+        else:
+            utils.no_content(request)
+        request.finish()
+
+    def _render_error(self, failure, request):
+        log.error("error: %s" % (failure.getTraceback(), ))
+        request.setResponseCode(500)
+        request.finish()
+
     def render_GET(self, request):
         if self.post_method():
             #log.debug("POST only method - dropping request")
@@ -106,6 +124,9 @@ class BaseRequest(resource.Resource):
 class EndpointChannel(JSONResource):
     '''HTTP endpoint channel.'''
 
+    # consumer queue configuration to use
+    queue_type = 'endpoint'
+
     def __init__(self, endpoint, sid, userid):
         resource.Resource.__init__(self)
         self.endpoint = endpoint
@@ -148,6 +169,16 @@ class EndpointChannel(JSONResource):
         '''Internal queue worker.'''
         self.queue.put(data)
 
+    def send_blocked(self, buffer_max):
+        '''Returns true if the data waiting to be retrieved by polling exceeds buffer_max.'''
+        size = 0
+        for data in self.queue.pending:
+            if type(data) != list:
+                data = (data, )
+            for msg in data:
+                size += len(msg['payload'])
+        return size > buffer_max
+
     def _format_msg(self, msg):
         msg['content'] = base64.b64encode(msg['payload'])
         msg['need_ack'] = (msg['need_ack'] != broker.MSG_ACK_NONE)
@@ -204,7 +235,10 @@ class EndpointChannel(JSONResource):
 
     def pending(self, request):
         '''Requeues pending incoming messages to be retrieved by polling.'''
-        self.broker.pending_messages(self.userid, True)
+        d = self.broker.pending_messages(self.userid, True)
+        # nothing to return (204)
+        d.addCallback(lambda _: None)
+        return d
 
     def polling(self, request):
         '''Polling for incoming messages.'''
@@ -238,29 +272,25 @@ class EndpointChannel(JSONResource):
         filename = None
         flags = []
 
-        res = {}
-        for rcpt in data['to']:
-            u = str(rcpt)
-            length = len(content)
-            mime_supported = mime in self.broker.config['fileserver']['accept_content'] \
-                if attachment else mime in self.broker.config['broker']['accept_content']
-            if not mime_supported:
-                log.debug("[%s] mime type not supported: %s - dropping" % \
-                    (tx_id, mime))
-                res[u] = c2s.MessagePostResponse.MessageSent.STATUS_NOTSUPPORTED
-            elif length > self.broker.config['broker']['max_size']:
-                log.debug("[%s] message too big (%d bytes) - dropping" % \
-                    (tx_id, length))
-                res[u] = c2s.MessagePostResponse.MessageSent.STATUS_BIG
-            else:
-                misc = {
-                    'mime' : mime,
-                    'flags' : flags
-                }
-                if filename:
-                    misc['filename'] = fileid
+        length = len(content)
+        mime_supported = mime in self.broker.config['fileserver']['accept_content'] \
+            if attachment else mime in self.broker.config['broker']['accept_content']
+        if not mime_supported:
+            log.debug("mime type not supported: %s - dropping" % (mime, ))
+            res = dict((str(rcpt), c2s.MessagePostResponse.MessageSent.STATUS_NOTSUPPORTED) for rcpt in data['to'])
+        elif length > self.broker.config['broker']['max_size']:
+            log.debug("message too big (%d bytes) - dropping" % (length, ))
+            res = dict((str(rcpt), c2s.MessagePostResponse.MessageSent.STATUS_BIG) for rcpt in data['to'])
+        else:
+            misc = {
+                'mime' : mime,
+                'flags' : flags
+            }
+            if filename:
+                misc['filename'] = filename
 
-                res[u] = self.broker.publish_user(self.userid, u, misc, content, broker.MSG_ACK_BOUNCE)
+            # a single message shared by all recipients
+            res = self.broker.publish_users(self.userid, [str(rcpt) for rcpt in data['to']], misc, content, broker.MSG_ACK_BOUNCE)
 
         log.debug("message sent! %s" % (res, ))
         return res
@@ -318,7 +348,7 @@ class Endpoint(resource.Resource):
             # delete verification entry in validations table
             valdb.delete(code)
             # touch user so we get a first presence
-            self.broker.usercache.touch_user(userid)
+            self.broker.usercache.touch_user(userid).addErrback(self.broker._error)
 
             # here is your token
             log.debug("generating token for %s" % (userid, ))
@@ -335,7 +365,7 @@ class Endpoint(resource.Resource):
         '''Create a channel for the requested userid.'''
         try:
             auth = data['auth']
-            userid = token.verify_user_token(auth, self.broker.keyring, self.broker.fingerprint)
+            userid = self.broker.keyring.verify_user_token(auth)
         except:
             import traceback
             traceback.print_exc()
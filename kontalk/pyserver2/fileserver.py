@@ -28,6 +28,7 @@ from zope.interface import implements
 from twisted.application import internet, service
 from twisted.internet import task
 from twisted.web import server, resource
+from twisted.web.iweb import ICredentialFactory
 from twisted.cred.portal import IRealm, Portal
 from twisted.web.guard import HTTPAuthSessionWrapper
 from twisted.protocols.basic import FileSender
@@ -35,7 +36,7 @@ from twisted.python.log import err
 
 import kontalklib.c2s_pb2 as c2s
 from kontalklib import database, token, utils
-import version, storage
+import version, storage, dbpool, purger, keyring
 
 
 class ServerlistDownload(resource.Resource):
@@ -86,28 +87,34 @@ class FileDownload(resource.Resource):
         #log.debug("request from %s: %s" % (self.userid, request.args))
         if 'f' in request.args:
             fn = request.args['f'][0]
-            info = self.fileserver.storage.get_extra(fn, self.userid)
-            if info:
-                (filename, mime, md5sum) = info
-                log.debug("sending file type %s, path %s, md5sum %s" % (mime, filename, md5sum))
-                genfilename = utils.generate_filename(mime)
-                request.setHeader('content-type', mime)
-                request.setHeader('content-length', os.path.getsize(filename))
-                request.setHeader('content-disposition', 'attachment; filename="%s"' % (genfilename))
-                request.setHeader('x-md5sum', md5sum)
-
-                # stream file to the client
-                fp = open(filename, 'rb')
-                d = FileSender().beginFileTransfer(fp, request)
-                def finished(ignored):
-                    fp.close()
+
+            def _send(info):
+                if info:
+                    (filename, mime, md5sum) = info
+                    log.debug("sending file type %s, path %s, md5sum %s" % (mime, filename, md5sum))
+                    genfilename = utils.generate_filename(mime)
+                    request.setHeader('content-type', mime)
+                    request.setHeader('content-length', os.path.getsize(filename))
+                    request.setHeader('content-disposition', 'attachment; filename="%s"' % (genfilename))
+                    request.setHeader('x-md5sum', md5sum)
+
+                    # stream file to the client
+                    fp = open(filename, 'rb')
+                    d = FileSender().beginFileTransfer(fp, request)
+                    def finished(ignored):
+                        fp.close()
+                        request.finish()
+                    d.addErrback(err).addCallback(finished)
+
+                # file not found in extra storage
+                else:
+                    request.write(self.not_found(request))
                     request.finish()
-                d.addErrback(err).addCallback(finished)
-                return server.NOT_DONE_YET
 
-            # file not found in extra storage
-            else:
-                return self.not_found(request)
+            d = self.fileserver.storage.get_extra(fn, self.userid)
+            d.addCallback(_send)
+            d.addErrback(err)
+            return server.NOT_DONE_YET
 
         return self.bad_request(request)
 
@@ -130,6 +137,10 @@ class FileUpload(resource.Resource):
     def bad_request(self, request):
         return self._quick_response(request, 400, 'bad request')
 
+    def _response(self, a, request):
+        request.setHeader('content-type', 'application/x-google-protobuf')
+        return a.SerializeToString()
+
     def render_POST(self, request):
         #log.debug("request from %s: %s" % (self.userid, request.requestHeaders))
         a = c2s.FileUploadResponse()
@@ -148,10 +159,24 @@ class FileUpload(resource.Resource):
                     # TODO convert to file-object management for lighter memory consumption
                     data = request.content.read()
                     if len(data) == length:
-                        (filename, fileid) = self.fileserver.storage.extra_storage(('', ), mime, data)
-                        log.debug("file stored to disk (filename=%s, fileid=%s)" % (filename, fileid))
-                        a.status = c2s.FileUploadResponse.STATUS_SUCCESS
-                        a.file_id = fileid
+                        def _stored(result):
+                            (filename, fileid) = result
+                            log.debug("file stored to disk (filename=%s, fileid=%s)" % (filename, fileid))
+                            a.status = c2s.FileUploadResponse.STATUS_SUCCESS
+                            a.file_id = fileid
+
+                        def _error(failure):
+                            err(failure)
+                            a.status = c2s.FileUploadResponse.STATUS_ERROR
+
+                        def _finish(result):
+                            request.write(self._response(a, request))
+                            request.finish()
+
+                        d = self.fileserver.storage.extra_storage(('', ), mime, data)
+                        d.addCallbacks(_stored, _error)
+                        d.addCallback(_finish)
+                        return server.NOT_DONE_YET
                     else:
                         log.debug("file length not matching content-length header (%d/%d)" % (len(data), length))
                         a.status = c2s.FileUploadResponse.STATUS_ERROR
@@ -162,8 +187,7 @@ class FileUpload(resource.Resource):
                 log.debug("content-length header not found")
                 a.status = c2s.FileUploadResponse.STATUS_ERROR
 
-        request.setHeader('content-type', 'application/x-google-protobuf')
-        return a.SerializeToString()
+        return self._response(a, request)
 
     def logout(self):
         # TODO
@@ -219,10 +243,12 @@ class Fileserver(resource.Resource, service.Service):
             # create storage and database connection on our own
             self.storage = storage.__dict__[self.config['broker']['storage'][0]](*self.config['broker']['storage'][1:])
             self.db = database.connect_config(self.config)
-            self.storage.set_datasource(self.db)
-            self.keyring = keyring.Keyring(database.servers(self.db), str(self.config['server']['fingerprint']))
+            self.storage.set_datasource(dbpool.connect_config(self.config))
+            self.keyring = keyring.Keyring(database.servers(self.db), str(self.config['server']['fingerprint']),
+                self.config['broker']['token_cache.ttl'],
+                self.config['broker']['token_cache.size'])
 
-        credFactory = utils.AuthKontalkTokenFactory(str(self.config['server']['fingerprint']), self.keyring)
+        credFactory = CachedTokenFactory(utils.AuthKontalkTokenFactory(str(self.config['server']['fingerprint']), self.keyring), self.keyring)
 
         # setup upload endpoint
         portal = Portal(FileUploadRealm(self), [utils.AuthKontalkToken()])
@@ -244,15 +270,40 @@ class Fileserver(resource.Resource, service.Service):
         fs_service.setServiceParent(self.parent)
 
         # old attachments entries purger
-        self._loop(self.config['fileserver']['attachments_purger.delay'], self._purge_attachments, True)
+        self._purger = purger.Purger('attachments', self._purge_attachments,
+            self.config['fileserver']['attachments_purger.delay'], self.config['broker'])
+        self._purger.start(True)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        return self._purger.stop()
 
     def _loop(self, delay, call, now=False):
         l = task.LoopingCall(call)
         l.start(delay, now)
         return l
 
-    def _purge_attachments(self):
-        self.storage.purge_extra()
+    def _purge_attachments(self, limit, budget):
+        return self.storage.purge_extra(self.config['fileserver']['attachments.expire'], limit, budget)
+
+
+class CachedTokenFactory:
+    '''
+    Credential factory keeping credentials decoded from verified tokens in
+    the keyring token cache, so tokens are not verified on every request.
+    '''
+    implements(ICredentialFactory)
+
+    def __init__(self, factory, keyring):
+        self.factory = factory
+        self.keyring = keyring
+        self.scheme = factory.scheme
+
+    def getChallenge(self, request):
+        return self.factory.getChallenge(request)
+
+    def decode(self, response, request):
+        return self.keyring.tokens.lookup(response, self.factory.decode, request, namespace='http')
 
 
 class FileserverApp:
@@ -18,11 +18,17 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import hashlib, threading
+
 # pyme
 from pyme import core, callbacks
 from pyme.constants.sig import mode as sigmode
 from pyme.constants.keylist import mode as keymode
 
+from kontalklib import token
+
+from cache import ExpiringCache, MISSING
+
 
 class Keyring:
     '''Handles all keyring releated functions.'''
@@ -34,9 +40,19 @@ class Keyring:
         'messages' : (0, 100)
     }
 
-    def __init__(self, serversdb, fingerprint):
+    def __init__(self, serversdb, fingerprint, token_ttl=600, token_cache_size=50000):
         self._db = serversdb
         self.fingerprint = fingerprint
+        self._list = None
+        self._keyring = None
+        '''Upper case fingerprints of the keyring, for signature matching.'''
+        self._fingerprints = None
+        '''Trust level of every server in the list.'''
+        self._trust = None
+        '''Privileges granted to every server in the list.'''
+        self._granted = None
+        '''Verified user tokens.'''
+        self.tokens = TokenCache(token_ttl, token_cache_size)
         self.reload()
 
     def itervalues(self):
@@ -44,29 +60,98 @@ class Keyring:
         return self._list.itervalues()
 
     def reload(self):
-        self._list = self._db.get_list()
-        self._keyring = [x for x in self._list.iterkeys()]
-        self._keyring.insert(0, self.fingerprint)
+        '''Reloads the server list, recomputing trust levels only if it has changed.'''
+        servers = self._db.get_list()
+        if self.changed(servers):
+            self.update(servers, self.compute(servers))
+        else:
+            self.update(servers)
+
+    def changed(self, servers):
+        '''Returns true if a server list has different servers than the current one.'''
+        return self._list is None or set(servers) != set(self._list)
+
+    def compute(self, servers):
+        '''
+        Computes keyring, trust levels and privileges for a server list in
+        one pass, without changing the current ones; safe to call from
+        another thread. Returns a tuple to be given to update().
+        '''
+        keyring = [x for x in servers.iterkeys()]
+        keyring.insert(0, self.fingerprint)
+        members = set(keyring)
+        ctx = keylist_context()
+        trust = {}
+        for fp in servers:
+            try:
+                trust[fp] = self.get_server_trust(fp, ctx, members)
+            except:
+                # key not found in GPG keyring
+                import traceback
+                traceback.print_exc()
+                trust[fp] = 0
+
+        # our server isn't in list so it's safe to use this value
+        total = len(servers)
+        granted = {}
+        for fp in servers:
+            granted[fp] = set()
+            for priv, privilege in self._privileges.iteritems():
+                if total > len(privilege):
+                    # take the higher privilege requirement
+                    need = privilege[-1]
+                else:
+                    need = privilege[total]
+
+                # calculate percentage of signatures on total servers
+                perc = trust[fp]/total*100
+                if need == 0 or perc >= need:
+                    granted[fp].add(priv)
+
+        return keyring, trust, granted
+
+    def update(self, servers, tables=None):
+        '''Replaces the server list; tables are the trust tables computed by compute().'''
+        self._list = servers
+        if tables is None:
+            return
+
+        old_keyring = self._keyring
+        self._keyring, self._trust, self._granted = tables
+        self._fingerprints = set(fp.upper() for fp in self._keyring)
+
+        # tokens were verified against the old trusted keys
+        if old_keyring is not None and set(old_keyring) != set(self._keyring):
+            self.tokens.invalidate()
+
+    def verify_user_token(self, auth_token):
+        '''Verifies a user token, using the verified tokens cache. Returns the userid.'''
+        return self.tokens.lookup(auth_token, token.verify_user_token, self, self.fingerprint)
 
     def s2s_addr(self, fingerprint):
         d = self._list[fingerprint]
         return d['host'], d['s2s']
 
-    def get_server_trust(self, fingerprint):
-        '''Returns the trust level (ie how many servers trust another) of a given server.'''
+    def get_server_trust(self, fingerprint, ctx=None, keyring=None):
+        '''
+        Returns the trust level (ie how many servers trust another) of a given server.
+        This walks all key signatures: use trust() for the precomputed value.
+        '''
         count = 0
-        ctx = core.Context()
-        ctx.set_keylist_mode(keymode.SIGS)
+        if ctx is None:
+            ctx = keylist_context()
+        if keyring is None:
+            keyring = self._keyring
         key = ctx.get_key(fingerprint, False)
         for uid in key.uids:
             for sign in uid.signatures:
                 skey = ctx.get_key(sign.keyid, False)
                 fpr = skey.subkeys[0].fpr
                 #print "found signature from %s" % fpr
-                #print str(fpr) in self._keyring
+                #print str(fpr) in keyring
                 #print str(fpr) != fingerprint
                 # make sure key is actually in the keyring and the sign is self-made
-                if str(fpr) in self._keyring and str(fpr) != fingerprint:
+                if str(fpr) in keyring and str(fpr) != fingerprint:
                     count += 1
 
         return count
@@ -77,40 +162,16 @@ class Keyring:
         if fingerprint == self.fingerprint:
             return True
 
-        # our server isn't in list so it's safe to use this value
-        total = len(self._list)
-        #print "found %d keys" % total
-        # we are alone in the network or we are
-        if total <= 0:
-            return True
-
-        # key is not in fingerprint
-        if fingerprint not in self._keyring:
-            #print "fingerprint not in keyring"
-            return False
-
-        privilege = self._privileges[priv]
-        if total > len(privilege):
-            # take the higher privilege requirement
-            need = privilege[-1]
-        else:
-            need = privilege[total]
-
-        # do not check for signatures
-        #print "need %.2f%% signatures" % need
-        if need == 0:
+        # we are alone in the network
+        if len(self._list) <= 0:
             return True
 
-        # get signatures count
-        sigs = self.get_server_trust(fingerprint)
-        #print "found %d signatures" % (sigs)
+        # key is not in keyring if it has no entry
+        return priv in self._granted.get(fingerprint, ())
 
-        # calculate percentage of signatures on total servers
-        perc = sigs/total*100
-
-        # check if percentage is enough
-        #print "signatures: %.2f%% out of %.2f%% needed" % (perc, need)
-        return perc >= need
+    def __contains__(self, fingerprint):
+        '''Case insensitive fingerprint lookup.'''
+        return fingerprint.upper() in self._fingerprints
 
     def __len__(self):
         return len(self._keyring)
@@ -120,28 +181,115 @@ class Keyring:
         return iter(self._keyring)
 
 
-def node_data(data, fp):
+class TokenCache:
+    '''
+    Results of successful token verifications, keyed by a digest of the token.
+    Tokens are verified again after ttl seconds, or after the trusted keys
+    have changed. Different uses of a token (e.g. userid and HTTP
+    credentials) are kept apart by namespace.
+    '''
+
+    def __init__(self, ttl, max_entries):
+        self._cache = ExpiringCache(ttl, max_entries)
+        '''Incremented on every invalidation.'''
+        self.generation = 0
+        self.stats = { 'hits' : 0, 'misses' : 0, 'invalidations' : 0 }
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, auth_token, namespace):
+        return hashlib.sha1(namespace + '\0' + auth_token).digest()
+
+    def get(self, auth_token, namespace=''):
+        '''Returns the cached verification result of a token, or MISSING.'''
+        result = self._cache.get(self._key(auth_token, namespace), MISSING)
+        if result is MISSING:
+            self.stats['misses'] += 1
+        else:
+            self.stats['hits'] += 1
+        return result
+
+    def set(self, auth_token, result, namespace='', generation=None):
+        '''
+        Caches the verification result of a token and returns it.
+        Failed verifications (None) are not cached: the key might be trusted
+        soon. If generation is given and the cache has been invalidated
+        since, the result is not cached either.
+        '''
+        if result is not None and (generation is None or generation == self.generation):
+            self._cache.set(self._key(auth_token, namespace), result)
+        return result
+
+    def lookup(self, auth_token, verify, *args, **kwargs):
+        '''
+        Returns the cached result of verify(auth_token, *args), calling it
+        on a miss. Exceptions raised by verify are not cached.
+        '''
+        namespace = kwargs.get('namespace', '')
+        result = self.get(auth_token, namespace)
+        if result is MISSING:
+            result = self.set(auth_token, verify(auth_token, *args), namespace)
+        return result
+
+    def invalidate(self):
+        self._cache.clear()
+        self.generation += 1
+        self.stats['invalidations'] += 1
+
+
+# GPGME contexts of the current thread
+_contexts = threading.local()
+
+def _context(name, factory):
+    '''Returns a context of the current thread, creating it on first use.'''
+    ctx = getattr(_contexts, name, None)
+    if ctx is None:
+        ctx = factory()
+        setattr(_contexts, name, ctx)
+    return ctx
+
+def _data_context():
+    ctx = core.Context()
+    ctx.set_armor(0)
+    return ctx
+
+def _keylist_context():
+    ctx = core.Context()
+    ctx.set_keylist_mode(keymode.SIGS)
+    return ctx
+
+def data_context():
+    '''Returns the GPGME context of the current thread for signing and verifying data.'''
+    return _context('data', _data_context)
+
+def keylist_context():
+    '''Returns the GPGME context of the current thread for listing keys with their signatures.'''
+    return _context('keylist', _keylist_context)
+
+def node_data(data, fp, ctx=None):
     '''Signs data using the key identified by the given fingerprint.'''
     plain = core.Data(data)
     cipher = core.Data()
-    ctx = core.Context()
-    ctx.set_armor(0)
+    if ctx is None:
+        ctx = data_context()
 
     # signing key
+    ctx.signers_clear()
     ctx.signers_add(ctx.get_key(fp, True))
 
     ctx.op_sign(plain, cipher, sigmode.NORMAL)
     cipher.seek(0, 0)
     return cipher.read()
 
-def verify_node_data(data, keyring):
+def verify_node_data(data, keyring, ctx=None):
     '''Verifies a signed chunk of data generated by a server node.'''
 
     # setup pyme
     cipher = core.Data(data)
     plain = core.Data()
-    ctx = core.Context()
-    ctx.set_armor(0)
+    if ctx is None:
+        ctx = data_context()
 
     ctx.op_verify(cipher, None, plain)
     # check verification result
@@ -153,8 +301,12 @@ def verify_node_data(data, keyring):
         sign_fp = sign.fpr.upper()
 
         # lookup in keyring
-        for key in keyring:
-            if sign_fp == key.upper():
-                return (key.upper(), text)
+        if isinstance(keyring, Keyring):
+            if sign_fp in keyring:
+                return (sign_fp, text)
+        else:
+            for key in keyring:
+                if sign_fp == key.upper():
+                    return (key.upper(), text)
 
     return (None, None)
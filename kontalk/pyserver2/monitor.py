@@ -82,6 +82,105 @@ class WebMonitor(rend.Page, service.Service):
         # TODO
         return 'n/a'
 
+    def data_dispatch_queue(self, context, data):
+        stats = self.broker.dispatch_stats()
+        avg = stats['messages'] / stats['batches'] if stats['batches'] else 0
+        return '%d queued (batch avg %d, max %d)' % (stats['queue'], avg, stats['max_batch'])
+
+    def data_crypto(self, context, data):
+        stats = self.broker.crypto_stats()
+        return '%d busy, %d queued - %d tokens, %d trust checks' % \
+            (stats['busy'], stats['queued'], stats['token'], stats['trust'])
+
+    def data_token_cache(self, context, data):
+        stats = self.broker.token_cache_stats()
+        total = stats['hits'] + stats['misses']
+        ratio = (100.0 * stats['hits'] / total) if total else 0
+        return '%d entries, %.1f%% hits (%d verified), %d invalidations' % \
+            (stats['entries'], ratio, stats['misses'], stats['invalidations'])
+
+    def data_push(self, context, data):
+        stats = self.broker.push_stats()
+        if not stats:
+            return 'disabled'
+        total = stats['hits'] + stats['misses']
+        ratio = (100.0 * stats['hits'] / total) if total else 0
+        out = ['%d registrations cached, %.1f%% hits, %d suppressed (%d users)' % \
+            (stats['cache_entries'], ratio, stats['suppressed'], stats['suppress_entries'])]
+        for name in sorted(stats['servers']):
+            st = stats['servers'][name]
+            out.append('%s: %d queued, %d sent in %d requests, %d retries, %d failed, %d dropped' % \
+                (name, st['queued'], st['sent'], st['requests'], st['retries'], st['failed'], st['dropped']))
+        return ', '.join(out)
+
+    def data_remote_lookups(self, context, data):
+        stats = self.broker.lookup_stats()
+        return '%d cached, %d hits, %d negative hits, %d requests, %d partial results' % \
+            (stats['entries'], stats['hits'], stats['negative_hits'], stats['requests'], stats['partial'])
+
+    def data_s2s_requests(self, context, data):
+        stats = self.broker.s2s_stats()
+        if not stats:
+            return 'disabled'
+        return '%d in flight, %d sent, %d retransmits, %d replies, %d timeouts, %d duplicates' % \
+            (stats['in_flight'], stats['sent'], stats['retransmits'], stats['replies'], stats['timeouts'], stats['duplicates'])
+
+    def data_purgers(self, context, data):
+        stats = self.broker.purger_stats()
+        if not stats:
+            return 'none'
+        out = []
+        for name in sorted(stats):
+            st = stats[name]
+            rows = '?' if st['last_rows'] is None else str(st['last_rows'])
+            out.append('%s: %s rows in %.3fs (%d total, %d runs, %d incomplete)' % \
+                (name, rows, st['last_seconds'], st['rows'], st['runs'], st['incomplete']))
+        return ', '.join(out)
+
+    def data_usercache(self, context, data):
+        stats = self.broker.usercache_stats()
+        if not stats:
+            return 'disabled'
+        total = stats['hits'] + stats['misses']
+        ratio = (100.0 * stats['hits'] / total) if total else 0
+        return '%d entries, %.1f%% hits, %d last seen pending (%d written)' % \
+            (stats['entries'], ratio, stats['pending'], stats['flushed'])
+
+    def data_workers(self, context, data):
+        stats = self.broker.shard_stats()
+        if not stats:
+            return 'single process'
+        return '%d workers, %d forwarded, %d received, %d handed over, %d adopted' % \
+            (stats['workers'], stats['forwarded'], stats['received'], stats['handoffs'], stats['adopted'])
+
+    def data_presence(self, context, data):
+        stats = self.broker.presence_stats()
+        return '%d subscriptions by %d users (%d bytes)' % (stats['subscriptions'], stats['subscribers'], stats['size'])
+
+    def data_presence_events(self, context, data):
+        stats = self.broker.presence_event_stats()
+        return '%d sent, %d offline held, %d suppressed (%d offline, %d online, %d status)' % \
+            (stats['sent'], stats['offline_held'],
+            stats['offline_cancelled'] + stats['online_suppressed'] + stats['status_suppressed'],
+            stats['offline_cancelled'], stats['online_suppressed'], stats['status_suppressed'])
+
+    def data_consumer_queues(self, context, data):
+        stats = self.broker.consumer_queue_stats().values()
+        if not stats:
+            return 'n/a'
+        length = [q['length'] for q in stats]
+        held = sum([q['held'] for q in stats])
+        dropped = sum([q['dropped'] for q in stats])
+        return '%d queued (max %d, %d held, %d dropped)' % (sum(length), max(length), held, dropped)
+
+    def data_message_cache(self, context, data):
+        stats = self.broker.storage.cache_stats()
+        if not stats:
+            return 'n/a'
+        lookups = stats['hits'] + stats['misses']
+        ratio = stats['hits'] * 100 / lookups if lookups else 0
+        return '%d%% hits (%d/%d KB)' % (ratio, stats['size'] / 1024, stats['max_size'] / 1024)
+
     def startService(self):
         service.Service.startService(self)
         log.debug("monitor init")
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+'''Time-sortable message ID generator.'''
+'''
+  Kontalk Pyserver
+  Copyright (C) 2011 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import time
+
+
+# 2012-01-01 00:00:00 UTC, in milliseconds
+EPOCH = 1325376000000L
+
+TIMESTAMP_BITS = 41
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+
+NODE_MASK = (1 << NODE_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+
+# IDs are formatted as fixed-width hex so string order is time order
+ID_FORMAT = '%016x'
+
+
+def node_id(fingerprint):
+    '''Derives a node id from a server fingerprint.'''
+    return int(fingerprint[-8:], 16) & NODE_MASK
+
+
+class MessageIdGenerator:
+    '''
+    Snowflake-style message ID generator.
+    An ID is made of a millisecond timestamp, the node id and a per-millisecond
+    sequence number, so IDs generated by a node are unique and monotonic and
+    IDs from the whole network are roughly ordered by time.
+    Worker processes of the same server use consecutive node ids.
+    '''
+
+    def __init__(self, fingerprint, worker = 0):
+        self._node = ((node_id(fingerprint) + worker) & NODE_MASK) << SEQUENCE_BITS
+        self._last = 0
+        self._sequence = 0
+
+    def next(self):
+        now = long(time.time() * 1000) - EPOCH
+        if now > self._last:
+            self._last = now
+            self._sequence = 0
+        else:
+            # same millisecond or clock going backwards: keep counting on the
+            # last timestamp, borrowing the next millisecond on overflow
+            self._sequence = (self._sequence + 1) & SEQUENCE_MASK
+            if self._sequence == 0:
+                self._last += 1
+
+        return ID_FORMAT % ((self._last << (NODE_BITS + SEQUENCE_BITS)) | self._node | self._sequence)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+'''Incremental database purgers.'''
+'''
+  Kontalk Pyserver
+  Copyright (C) 2011 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import random
+
+from twisted.internet import reactor, defer
+
+import kontalklib.logging as log
+
+
+# seconds to wait before continuing a run that used up its time budget
+CONTINUE_DELAY = 1
+
+
+class Purger:
+    '''
+    Runs a purge job periodically.
+    The job is a callable accepting (limit, budget) and returning a Deferred
+    fired with (rows, seconds, complete), as returned by
+    ConnectionPool.run_chunked: the work is done in a database pool thread,
+    limit rows at a time and for at most budget seconds. A random jitter is
+    added to the delay so purgers don't all hit the database at once; an
+    incomplete run is continued shortly after.
+    '''
+
+    def __init__(self, name, job, delay, config):
+        self.name = name
+        self.job = job
+        self.delay = delay
+        self.chunk_size = config['purger.chunk_size']
+        self.budget = config['purger.time_budget']
+        self.jitter = config['purger.jitter']
+        self._call = None
+        '''Deferred of the run in progress.'''
+        self._running = None
+        self._stopped = False
+        self.stats = { 'runs' : 0, 'rows' : 0, 'seconds' : 0.0, 'last_rows' : 0, 'last_seconds' : 0.0, 'incomplete' : 0 }
+
+    def start(self, now=False):
+        self._stopped = False
+        self._schedule(0 if now else self.delay)
+
+    def stop(self):
+        '''Stops the purger. Returns a Deferred fired when the run in progress is done.'''
+        self._stopped = True
+        if self._call and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+        if self._running is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._running.addBoth(lambda _: d.callback(None))
+        return d
+
+    def _schedule(self, delay):
+        if self._stopped:
+            return
+        delay += random.uniform(0, self.jitter)
+        self._call = reactor.callLater(delay, self.run)
+
+    def run(self):
+        self._call = None
+        d = self.job(self.chunk_size, self.budget)
+        d.addCallback(self._done)
+        d.addErrback(self._error)
+        d.addBoth(self._finished)
+        self._running = d
+        return d
+
+    def _finished(self, result):
+        self._running = None
+        return result
+
+    def _done(self, result):
+        rows, seconds, complete = result
+        self.stats['runs'] += 1
+        self.stats['seconds'] += seconds
+        self.stats['last_seconds'] = seconds
+        self.stats['last_rows'] = rows
+        if rows is not None:
+            self.stats['rows'] += rows
+        if rows:
+            log.debug("%s purger: %d rows in %.3f seconds" % (self.name, rows, seconds))
+
+        if complete:
+            self._schedule(self.delay)
+        else:
+            self.stats['incomplete'] += 1
+            self._schedule(CONTINUE_DELAY)
+
+    def _error(self, failure):
+        log.warn("%s purger failed" % self.name)
+        failure.printTraceback()
+        self._schedule(self.delay)
@@ -18,49 +18,130 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import urllib, urllib2
+import json
+from cStringIO import StringIO
+from collections import OrderedDict
+
+from twisted.internet import reactor, defer, protocol
+from twisted.web import client
+from twisted.web.http_headers import Headers
 
 import kontalklib.logging as log
-from kontalklib import database
+from kontalklib import database, utils
+
+from cache import ExpiringCache, MISSING
 
 
 class PushNotifications:
-    '''Push notifications manager.'''
+    '''
+    Push notifications manager.
+    Registration ids are looked up through the database pool and cached,
+    so notifying a known user needs no queries.
+    '''
 
     def __init__(self, config, db):
         self._config = config
         self._db = db
-        self._cachedb = database.usercache(db)
-        self._notify_cache = {}
+        '''Push servers, one per supported service.'''
+        self._servers = [GooglePush(config)]
+
+        cfg = config['broker']
+        '''Users already notified since they were last online.'''
+        self._notify_cache = ExpiringCache(cfg['push.suppress_ttl'], cfg['push.suppress_size'])
+        '''Registration ids by userid: { field : regid }.'''
+        self._regids = ExpiringCache(cfg['push.cache_ttl'], cfg['push.cache_size'])
+        '''Specific userids by user hash.'''
+        self._generic = ExpiringCache(cfg['push.cache_ttl'], cfg['push.cache_size'])
+        self._stats = { 'suppressed' : 0, 'hits' : 0, 'misses' : 0 }
 
     def notify(self, userid):
-        if userid not in self._notify_cache:
-            self._notify_cache[userid] = 0
-            server = self._push_server(userid)
-            if server:
-                log.debug("pushing notification to %s" % userid)
-                return server.notify()
-        else:
-            self._notify_cache[userid] += 1
+        if userid in self._notify_cache:
+            self._stats['suppressed'] += 1
+            return
+
+        self._notify_cache.set(userid, True)
+        regids = self._regids.get(userid, MISSING)
+        if regids is not MISSING:
+            self._stats['hits'] += 1
+            return self._push(userid, regids)
+
+        def _found(e):
+            return self._push(userid, self._cache_regids(userid, e))
+
+        self._stats['misses'] += 1
+        d = self._db.run_query(database.usercache, 'get', userid, True)
+        d.addCallback(_found)
+        d.addErrback(self._error)
+        return d
 
     def notify_all(self, uhash):
-        match = self._cachedb.get_generic(uhash)
-        ret = []
-        for u in match:
-            ret.append(self.notify(u['userid']))
-        return ret
+        def _notify(userids):
+            return [self.notify(userid) for userid in userids]
+
+        def _found(match):
+            userids = []
+            for e in match:
+                self._cache_regids(e['userid'], e)
+                userids.append(e['userid'])
+            self._generic.set(uhash, userids)
+            return _notify(userids)
+
+        userids = self._generic.get(uhash)
+        if userids is not None:
+            self._stats['hits'] += 1
+            return _notify(userids)
+
+        self._stats['misses'] += 1
+        d = self._db.run_query(database.usercache, 'get_generic', uhash)
+        d.addCallback(_found)
+        d.addErrback(self._error)
+        return d
 
     def mark_user_online(self, userid):
-        try:
-            del self._notify_cache[userid]
-        except:
-            pass
+        self._notify_cache.pop(userid)
+
+    def user_updated(self, userid, fields):
+        '''Updates cached registration ids after a user changed its data.'''
+        regids = dict((server.field, fields[server.field]) for server in self._servers if server.field in fields)
+        if not regids:
+            return
 
-    def _push_server(self, userid):
-        '''Returns a PushServer instance for the given userid - if available.'''
-        e = self._cachedb.get(userid, True)
-        if e[GooglePush.field]:
-            return GooglePush(self._config, userid, e[GooglePush.field])
+        cached = self._regids.get(userid)
+        if cached:
+            regids = dict(cached, **regids)
+        self._regids.set(userid, regids)
+
+        # a new device for a known user hash
+        userids = self._generic.get(userid[:utils.USERID_LENGTH])
+        if userids is not None and userid not in userids:
+            userids.append(userid)
+
+    def stop(self):
+        for server in self._servers:
+            server.stop()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['servers'] = dict((server.name, server.stats) for server in self._servers)
+        stats['suppress_entries'] = len(self._notify_cache)
+        stats['cache_entries'] = len(self._regids)
+        return stats
+
+    def _cache_regids(self, userid, e):
+        regids = dict((server.field, e[server.field]) for server in self._servers) if e else {}
+        self._regids.set(userid, regids)
+        return regids
+
+    def _push(self, userid, regids):
+        '''Queues a notification on the first push server the user is registered with.'''
+        for server in self._servers:
+            regid = regids.get(server.field)
+            if regid:
+                log.debug("pushing notification to %s" % userid)
+                return server.notify(regid)
+
+    def _error(self, failure):
+        failure.printTraceback()
 
 
 class PushServer:
@@ -69,36 +150,195 @@ class PushServer:
     def __init__(self):
         pass
 
-    def notify(self):
+    def notify(self, regid):
+        '''Queues a notification for a registration id.'''
         raise NotImplementedError()
 
+    def stop(self):
+        pass
+
+
+class _BodyReceiver(protocol.Protocol):
+    '''Collects a response body and fires a Deferred with it.'''
+
+    def __init__(self, finished):
+        self.finished = finished
+        self.data = []
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        self.finished.callback(''.join(self.data))
+
 
 class GooglePush(PushServer):
-    '''Google Cloud Messaging implementation.'''
+    '''
+    Google Cloud Messaging implementation.
+    Registration ids are queued and sent in multicast requests of up to
+    batch_size ids, through a pool of persistent HTTP connections and
+    with at most max_requests requests in flight. Registration ids GCM
+    could not deliver to are retried with exponential backoff.
+    '''
 
-    # API entrypoint for GCM requests
-    url = 'https://android.googleapis.com/gcm/send'
+    name = 'gcm'
     # usercache field for registration id
     field = 'google_registrationid'
+    # maximum number of registration ids in a multicast request
+    MAX_BATCH = 1000
+    # per-id errors worth retrying
+    RETRY_ERRORS = ('Unavailable', 'InternalServerError')
+
+    def __init__(self, config):
+        cfg = config['google_gcm']
+        self.token = cfg['apikey']
+        # API entrypoint for GCM requests
+        self.url = str(cfg['url'])
+        self.batch_size = min(cfg['batch_size'], self.MAX_BATCH)
+        self.batch_delay = cfg['batch_delay']
+        self.queue_size = cfg['queue_size']
+        self.max_requests = cfg['max_requests']
+        self.retries = cfg['retries']
+        self.retry_delay = cfg['retry_delay']
+        self.retry_max_delay = cfg['retry_max_delay']
+
+        self._pool = client.HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = self.max_requests
+        self._agent = client.Agent(reactor, pool=self._pool)
+        '''Registration ids waiting to be sent, with their failed attempts count.'''
+        self._queue = OrderedDict()
+        self._flush_call = None
+        '''Scheduled retries of failed registration ids.'''
+        self._retry_calls = set()
+        '''Requests in flight.'''
+        self._requests = 0
+        self.stats = { 'queued' : 0, 'dropped' : 0, 'sent' : 0, 'requests' : 0, 'retries' : 0, 'failed' : 0 }
+
+    def notify(self, regid):
+        if regid in self._queue:
+            return
+        if len(self._queue) >= self.queue_size:
+            self.stats['dropped'] += 1
+            return
+        self._queue[regid] = 0
+        self.stats['queued'] += 1
+        self._schedule()
 
-    def __init__(self, config, userid, regid):
-        self.token = config['google_gcm']['apikey']
-        self.userid = userid
-        self.regid = regid
+    def stop(self):
+        if self._flush_call and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        for call in self._retry_calls:
+            if call.active():
+                call.cancel()
+        self._retry_calls.clear()
+        return self._pool.closeCachedConnections()
 
-    def notify(self):
-        params = urllib.urlencode({
-            'registration_id' : self.regid,
+    def pending(self):
+        return len(self._queue), self._requests
+
+    def _schedule(self):
+        if not self._queue or self._requests >= self.max_requests:
+            return
+        # send full batches right away, wait a little for more ids otherwise
+        delay = 0 if len(self._queue) >= self.batch_size else self.batch_delay
+        if self._flush_call is None:
+            self._flush_call = reactor.callLater(delay, self._flush)
+        elif delay == 0:
+            self._flush_call.reset(0)
+
+    def _flush(self):
+        self._flush_call = None
+        while self._queue and self._requests < self.max_requests:
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popitem(last=False))
+            self._send(batch)
+
+    def _send(self, batch):
+        body = json.dumps({
+            'registration_ids' : [regid for regid, attempts in batch],
             'collapse_key' : 'new',
-            'data.action' : 'org.kontalk.CHECK_MESSAGES'
+            'data' : { 'action' : 'org.kontalk.CHECK_MESSAGES' }
         })
-        headers = {
-            'Authorization' : 'key=' + self.token
-        }
-        req = urllib2.Request(self.url, params, headers)
-        fd = urllib2.urlopen(req)
-        # TODO what do we do with the output??
-        data = fd.read()
-        log.debug("data from gcm: %s" % (data, ))
-        fd.close()
-        return data
+        headers = Headers({
+            'Authorization' : ['key=' + self.token],
+            'Content-Type' : ['application/json']
+        })
+
+        self._requests += 1
+        self.stats['requests'] += 1
+        d = self._agent.request('POST', self.url, headers, client.FileBodyProducer(StringIO(body)))
+        d.addCallback(self._response, batch)
+        d.addErrback(self._error, batch)
+        d.addBoth(self._done)
+
+    def _response(self, response, batch):
+        finished = defer.Deferred()
+        response.deliverBody(_BodyReceiver(finished))
+
+        if response.code == 200:
+            finished.addCallback(self._results, batch)
+        elif response.code >= 500:
+            log.debug("GCM unavailable (%d), retrying %d ids" % (response.code, len(batch)))
+            retry_after = response.headers.getRawHeaders('retry-after', [''])[0]
+            delay = int(retry_after) if retry_after.isdigit() else None
+            finished.addCallback(lambda _: self._retry(batch, delay))
+        else:
+            # authentication or request error: retrying would not help
+            self.stats['failed'] += len(batch)
+            finished.addCallback(lambda data: log.warn("GCM request rejected (%d): %s" % (response.code, data)))
+
+        return finished
+
+    def _results(self, data, batch):
+        results = json.loads(data)['results']
+        retry = []
+        for (regid, attempts), result in zip(batch, results):
+            if 'message_id' in result:
+                self.stats['sent'] += 1
+            elif result.get('error') in self.RETRY_ERRORS:
+                retry.append((regid, attempts))
+            else:
+                self.stats['failed'] += 1
+                log.debug("GCM error for %s: %s" % (regid, result.get('error')))
+
+        if retry:
+            self._retry(retry)
+
+    def _error(self, failure, batch):
+        log.debug("GCM request failed: %s" % (failure.getErrorMessage(), ))
+        self._retry(batch)
+
+    def _retry(self, batch, delay=None):
+        retry = []
+        for regid, attempts in batch:
+            if attempts < self.retries:
+                retry.append((regid, attempts + 1))
+            else:
+                self.stats['failed'] += 1
+
+        if retry:
+            self.stats['retries'] += len(retry)
+            if delay is None:
+                attempts = max(a for regid, a in retry)
+                delay = min(self.retry_delay * 2 ** (attempts - 1), self.retry_max_delay)
+            self._retry_calls.add(reactor.callLater(delay, self._requeue, retry))
+
+    def _requeue(self, batch):
+        # forget retries already run (including this one)
+        self._retry_calls = set(call for call in self._retry_calls if call.active())
+        for regid, attempts in batch:
+            # a new notification for the same id resets the attempts count
+            if regid in self._queue:
+                continue
+            if len(self._queue) >= self.queue_size:
+                # make room by dropping the oldest ids
+                self._queue.popitem(last=False)
+                self.stats['dropped'] += 1
+            self._queue[regid] = attempts
+        self._schedule()
+
+    def _done(self, result):
+        self._requests -= 1
+        self._schedule()
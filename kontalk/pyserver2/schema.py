@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+'''Schema changes on top of the kontalklib database schema.'''
+'''
+  Kontalk Pyserver
+  Copyright (C) 2011 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import sys, json
+
+import oursql
+
+from kontalklib import database
+import kontalklib.logging as log
+
+
+'''Tables used by the pyserver besides the kontalklib schema.'''
+TABLES = (
+    # payloads shared by several recipients, stored once
+    'CREATE TABLE IF NOT EXISTS message_content ('
+    'hash BINARY(20) NOT NULL PRIMARY KEY, '
+    'content LONGBLOB, '
+    'refcount INT UNSIGNED NOT NULL DEFAULT 0'
+    ') ENGINE=InnoDB',
+    # resources generic messages were delivered to
+    'CREATE TABLE IF NOT EXISTS message_deliveries ('
+    'msgid VARCHAR(64) NOT NULL, '
+    'resource VARCHAR(64) NOT NULL, '
+    'acked TINYINT(1) NOT NULL DEFAULT 0, '
+    'PRIMARY KEY (msgid, resource)'
+    ') ENGINE=InnoDB',
+)
+
+'''Columns added to kontalklib tables: (table, column, ALTER TABLE statement).'''
+COLUMNS = (
+    # reference to the shared payload of a message
+    ('messages', 'content_hash', 'ALTER TABLE messages ADD COLUMN content_hash BINARY(20) NULL, '
+        'ADD INDEX (content_hash)'),
+)
+
+
+def has_column(c, table, column):
+    c.execute('SELECT COUNT(*) FROM information_schema.columns WHERE '
+        'table_schema = DATABASE() AND table_name = ? AND column_name = ?',
+        (table, column))
+    return c.fetchone()[0] > 0
+
+def upgrade(db):
+    '''
+    Creates the tables and columns missing from the database, blocking.
+    It is run by the main broker process on startup, before any other
+    process uses the database, or once by hand with:
+      python -m kontalk.pyserver2.schema server.conf
+    '''
+    c = db.cursor()
+    for statement in TABLES:
+        c.execute(statement, plain_query=True)
+
+    for table, column, statement in COLUMNS:
+        if not has_column(c, table, column):
+            log.info("adding column %s.%s" % (table, column))
+            try:
+                c.execute(statement, plain_query=True)
+            except oursql.Error:
+                # added by another server in the meantime
+                if not has_column(c, table, column):
+                    raise
+    db.commit()
+
+
+def main(argv):
+    fp = open(argv[1], 'r')
+    config = json.load(fp)
+    fp.close()
+
+    log.init(config)
+    upgrade(database.connect_config(config))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+'''Multi-process C2S front-end: user sharding and inter-process channel.'''
+'''
+  Kontalk Pyserver
+  Copyright (C) 2011 Kontalk Devteam <devteam@kontalk.org>
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os, sys, socket, zlib
+import cPickle as pickle
+
+from zope.interface import implements
+
+from twisted.internet import reactor, protocol, interfaces, defer, error
+from twisted.protocols import basic
+
+import kontalklib.logging as log
+from kontalklib import utils
+
+
+# file descriptor of the shared C2S listening socket in worker processes
+C2S_FD = 3
+
+# seconds to wait before reconnecting to a worker or respawning it
+RETRY_DELAY = 1
+
+
+def shard_of(userid, count):
+    '''Returns the index of the worker owning a userid (generic or specific).'''
+    return (zlib.crc32(userid[:utils.USERID_LENGTH]) & 0xffffffff) % count
+
+
+class ShardProtocol(basic.Int32StringReceiver):
+    '''
+    Inter-process protocol between brokers.
+    Each packet is a pickled tuple (request name, arguments...); a file
+    descriptor can be passed along with a packet.
+    '''
+    implements(interfaces.IFileDescriptorReceiver)
+
+    MAX_LENGTH = 104857600
+
+    def __init__(self, link):
+        self.link = link
+        self.shard = None
+        '''Worker sending presence updates on this connection.'''
+        self.origin = None
+        self._fds = []
+
+    def fileDescriptorReceived(self, fd):
+        self._fds.append(fd)
+
+    def pop_fd(self):
+        return self._fds.pop(0)
+
+    def stringReceived(self, data):
+        try:
+            self.link.request_received(self, pickle.loads(data))
+        except:
+            import traceback
+            traceback.print_exc()
+
+    def send_request(self, fd, request):
+        if fd is not None:
+            self.transport.sendFileDescriptor(fd)
+        self.sendString(pickle.dumps(request, pickle.HIGHEST_PROTOCOL))
+
+    def connectionLost(self, reason):
+        for fd in self._fds:
+            os.close(fd)
+        self._fds = []
+        self.link.lost(self)
+
+
+class ShardFactory(protocol.ServerFactory):
+
+    def __init__(self, link):
+        self.link = link
+
+    def buildProtocol(self, addr):
+        return ShardProtocol(self.link)
+
+
+class AdoptFactory:
+    '''Builds a protocol for an adopted connection and keeps a reference to it.'''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.protocol = None
+
+    def buildProtocol(self, addr):
+        self.protocol = self.factory.buildProtocol(addr)
+        return self.protocol
+
+
+class ShardLink:
+    '''
+    Channel between the brokers of the local C2S worker processes.
+    Each worker owns the users whose hash falls in its shard: client
+    connections are handed over to the owner worker after login and
+    messages for users of other shards are forwarded to their owner.
+    Workers keep a copy of the users online on the other workers and send
+    remote lookups to worker 0, which runs the server-to-server services.
+    '''
+
+    def __init__(self, broker, index, count, path):
+        self.broker = broker
+        self.index = index
+        self.count = count
+        self.path = path
+        '''Connections to the other workers.'''
+        self._peers = {}
+        '''Requests waiting for the connection to a worker.'''
+        self._queue = {}
+        '''Client transports being handed over, by handoff id.'''
+        self._handoffs = {}
+        self._handoff_seq = 0
+        '''Users online on the other workers: generic userid -> set of resources.'''
+        self._online = {}
+        '''Users of the other workers hiding their presence.'''
+        self._hidden = set()
+        '''Requests waiting for an answer, by call id: (worker, Deferred).'''
+        self._calls = {}
+        self._call_seq = 0
+        self.stats = { 'forwarded' : 0, 'received' : 0, 'handoffs' : 0, 'adopted' : 0 }
+
+    def listen(self):
+        path = self.path % self.index
+        if os.path.exists(path):
+            os.unlink(path)
+        return reactor.listenUNIX(path, ShardFactory(self))
+
+    def shard(self, userid):
+        return shard_of(userid, self.count)
+
+    def is_local(self, userid):
+        return self.shard(userid) == self.index
+
+    def send(self, shard, *request):
+        '''Sends a request to another worker.'''
+        self._send(shard, None, request)
+
+    def broadcast(self, *request):
+        '''Sends a request to all the other workers.'''
+        for shard in xrange(self.count):
+            if shard != self.index:
+                self.send(shard, *request)
+
+    def sync(self):
+        '''Asks the other workers for the users online on them.'''
+        self.broadcast('sync', self.index)
+
+    def announce(self, userid, online):
+        '''Tells the other workers a local user went online or offline.'''
+        self.broadcast('online' if online else 'offline', self.index, [userid])
+
+    def announce_hidden(self, userid, hidden):
+        '''Tells the other workers a local user changed its hide status.'''
+        self.broadcast('hide' if hidden else 'show', self.index, [userid])
+
+    def user_hidden(self, userid):
+        '''Returns true if a user owned by another worker is hiding its presence.'''
+        return userid in self._hidden
+
+    def user_online(self, userid):
+        '''Returns true if a user owned by another worker is online.'''
+        uhash, resource = utils.split_userid(userid)
+        resources = self._online.get(uhash)
+        if resource:
+            return bool(resources) and resource in resources
+        return bool(resources)
+
+    def _set_online(self, userids, online):
+        for userid in userids:
+            uhash, resource = utils.split_userid(userid)
+            if online:
+                self._online.setdefault(uhash, set()).add(resource)
+            else:
+                resources = self._online.get(uhash)
+                if resources is not None:
+                    resources.discard(resource)
+                    if not resources:
+                        del self._online[uhash]
+
+    def _forget(self, shard):
+        '''Forgets the users online on a worker which went away.'''
+        for uhash in [u for u in self._online if self.shard(u) == shard]:
+            del self._online[uhash]
+        for userid in [u for u in self._hidden if self.shard(u) == shard]:
+            self._hidden.discard(userid)
+
+    def lookup(self, users):
+        '''Looks users up on the other servers through worker 0.'''
+        return self._call(0, 'lookup', users)
+
+    def _call(self, shard, *request):
+        self._call_seq += 1
+        d = defer.Deferred()
+        self._calls[self._call_seq] = (shard, d)
+        self.send(shard, 'call', self._call_seq, self.index, *request)
+        return d
+
+    def _answer(self, origin, call_id, name, args):
+        if name == 'lookup':
+            d = self.broker.remote_lookup(*args)
+        else:
+            d = defer.fail(ValueError("unknown call: %s" % name))
+
+        d.addCallbacks(lambda result: self.send(origin, 'answer', call_id, True, result),
+            lambda failure: self.send(origin, 'answer', call_id, False, failure.getErrorMessage()))
+
+    def _send(self, shard, fd, request):
+        self.stats['forwarded'] += 1
+        try:
+            self._peers[shard].send_request(fd, request)
+        except KeyError:
+            queue = self._queue.setdefault(shard, [])
+            if not queue:
+                self._connect(shard)
+            queue.append((fd, request))
+
+    def _connect(self, shard):
+        d = protocol.ClientCreator(reactor, ShardProtocol, self).connectUNIX(self.path % shard)
+        d.addCallback(self._connected, shard)
+        d.addErrback(self._connect_failed, shard)
+
+    def _connected(self, proto, shard):
+        proto.shard = shard
+        self._peers[shard] = proto
+        for fd, request in self._queue.pop(shard, ()):
+            proto.send_request(fd, request)
+
+    def _connect_failed(self, failure, shard):
+        log.warn("unable to connect to worker %d: %s" % (shard, failure.getErrorMessage()))
+        reactor.callLater(RETRY_DELAY, self._connect, shard)
+
+    def lost(self, proto):
+        if proto.shard is not None and self._peers.get(proto.shard) is proto:
+            del self._peers[proto.shard]
+            # answers will never come
+            for call_id, (shard, d) in self._calls.items():
+                if shard == proto.shard:
+                    del self._calls[call_id]
+                    d.errback(error.ConnectionLost())
+        if proto.origin is not None:
+            self._forget(proto.origin)
+
+    def handoff(self, transport, userid, *login):
+        '''Hands a client connection over to the worker owning userid.'''
+        transport.stopReading()
+        self._handoff_seq += 1
+        self._handoffs[self._handoff_seq] = transport
+        self.stats['handoffs'] += 1
+        self._send(self.shard(userid), transport.fileno(), ('handoff', self._handoff_seq, userid) + login)
+
+    def request_received(self, proto, request):
+        self.stats['received'] += 1
+        name, args = request[0], request[1:]
+
+        if name == 'dispatch':
+            self.broker.dispatch_messages(*args)
+
+        elif name == 'ephemeral':
+            self.broker.publish_ephemeral(*args)
+
+        elif name == 'subscribe':
+            self.broker.subscribe_user_presence(*args)
+
+        elif name in ('online', 'offline'):
+            proto.origin = args[0]
+            self._set_online(args[1], name == 'online')
+
+        elif name in ('hide', 'show'):
+            proto.origin = args[0]
+            if name == 'hide':
+                self._hidden.update(args[1])
+            else:
+                self._hidden.difference_update(args[1])
+
+        elif name == 'sync':
+            proto.origin = args[0]
+            self.send(args[0], 'online', self.index, self.broker.local_users())
+            self.send(args[0], 'hide', self.index, self.broker.hidden_users())
+
+        elif name == 'call':
+            self._answer(args[1], args[0], args[2], args[3:])
+
+        elif name == 'answer':
+            call_id, success, result = args
+            try:
+                shard, d = self._calls.pop(call_id)
+            except KeyError:
+                return
+            if success:
+                d.callback(result)
+            else:
+                d.errback(RuntimeError(result))
+
+        elif name == 'handoff':
+            handoff_id, userid, login = args[0], args[1], args[2:]
+            fd = proto.pop_fd()
+            adopt = AdoptFactory(self.broker.c2s_factory)
+            try:
+                reactor.adoptStreamConnection(fd, socket.AF_INET, adopt)
+            finally:
+                os.close(fd)
+                # the other worker can now close its copy of the connection
+                proto.send_request(None, ('adopted', handoff_id))
+
+            if adopt.protocol:
+                self.stats['adopted'] += 1
+                adopt.protocol.loginAdopted(userid, *login)
+
+        elif name == 'adopted':
+            transport = self._handoffs.pop(args[0], None)
+            if transport:
+                # the socket is shared with the adopting worker: detach it
+                # from our reactor and close our descriptor only, without
+                # shutting it down or touching its linger options
+                transport.stopReading()
+                transport.stopWriting()
+                transport.socket.close()
+
+        else:
+            log.warn("unknown request from worker: %s" % name)
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    '''Keeps a C2S worker process running.'''
+
+    def __init__(self, cfgfile, index, fd):
+        self.cfgfile = cfgfile
+        self.index = index
+        self.fd = fd
+        self.stopping = False
+
+    def spawn(self):
+        reactor.spawnProcess(self, sys.executable,
+            [sys.executable, '-m', __name__, self.cfgfile, str(self.index)],
+            env=os.environ, childFDs={ 0 : 'w', 1 : 1, 2 : 2, C2S_FD : self.fd })
+
+    def stop(self):
+        self.stopping = True
+        if self.transport:
+            try:
+                self.transport.signalProcess('TERM')
+            except:
+                pass
+
+    def processEnded(self, reason):
+        if not self.stopping:
+            log.warn("worker %d exited: %s - respawning" % (self.index, reason.getErrorMessage()))
+            reactor.callLater(RETRY_DELAY, self.spawn)
+
+
+def spawn_workers(cfgfile, count, fd):
+    '''Starts worker processes 1 to count-1, sharing the C2S socket fd.'''
+    workers = [WorkerProcess(cfgfile, i, fd) for i in range(1, count)]
+    for w in workers:
+        w.spawn()
+        reactor.addSystemEventTrigger('before', 'shutdown', w.stop)
+    return workers
+
+
+def main(argv):
+    from twisted.application import service
+    from kontalk.pyserver2 import app
+
+    cfgfile, index = argv[1], int(argv[2])
+    appl = app.PyserverApp({ 'config' : cfgfile }, index)
+    svc = service.IService(appl.setup())
+    svc.startService()
+    # same as twistd: stop services before the reactor goes down
+    reactor.addSystemEventTrigger('before', 'shutdown', svc.stopService)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -19,13 +19,19 @@
 '''
 
 
-import os, time
+import os, time, hashlib
+from datetime import datetime
+from collections import OrderedDict
+from twisted.internet import defer, reactor
+import oursql
 from kontalklib import database, utils
 import kontalklib.logging as log
 
 
 class MessageStorage:
-    '''Interface for a message broker storage.'''
+    '''Interface for a message broker storage.
+    Methods accessing the datasource return a Deferred.
+    '''
 
     def set_datasource(self, ds):
         '''Sets a datasource after-init.'''
@@ -39,18 +45,53 @@ class MessageStorage:
         '''Loads a storage for a userid.'''
         pass
 
+    def load_page(self, uid, cursor = None, max_size = 262144, max_rows = 500):
+        '''
+        Loads a page of the messages of a userid, ordered by timestamp.
+        A page holds at most max_rows messages and at most max_size bytes of
+        payload (unless the first message alone is bigger).
+        Returns a tuple (messages, cursor of the next page or None).
+        '''
+        pass
+
     def store(self, uid, msg, force = False):
         '''Used to persist a message.'''
         pass
 
+    def store_messages(self, msglist, force = False):
+        '''Used to persist several messages at once, each one for its recipient.'''
+        pass
+
     def deliver(self, userid, msg, force = False):
         '''Used to persist a message that was intended to a generic userid.'''
         pass
 
+    def get_messages(self, uid, msgid_list):
+        '''Loads only the given messages of a userid.'''
+        pass
+
     def delete(self, uid, msgid):
         '''Deletes a single message.'''
         pass
 
+    def delete_messages(self, uid, msgid_list):
+        '''Deletes several messages at once.'''
+        pass
+
+    def get_deliveries(self, msgid_list):
+        '''
+        Returns the resources generic messages were delivered to, as a dict
+        of msgid: {resource: acknowledged}.
+        '''
+        pass
+
+    def update_deliveries(self, entries):
+        '''
+        Records deliveries of generic messages to resources, as a list of
+        (msgid, resource, acknowledged). Acknowledgements are never reset.
+        '''
+        pass
+
     def extra_storage(self, uids, mime, content, name = None):
         '''Store a big file in the storage system.'''
         pass
@@ -63,16 +104,40 @@ class MessageStorage:
         '''Returns the full path of a file in the extra storage.'''
         pass
 
-    def purge_messages(self):
-        '''Purges expired/unknown messages.'''
+    def purge_messages(self, limit, budget):
+        '''
+        Purges expired/unknown messages, limit rows at a time, for at most
+        budget seconds. Returns a Deferred fired with (rows, seconds, complete).
+        '''
         pass
 
-    def purge_extra(self):
-        '''Purges expired/orphan files on extra storage.'''
+    def purge_extra(self, expire, limit, budget):
+        '''
+        Purges attachment entries older than expire seconds and files on
+        extra storage left without entries, limit files at a time, for at
+        most budget seconds. Returns a Deferred fired with (rows, seconds, complete).
+        '''
         pass
 
-    def purge_validations(self):
-        '''Purges old validation entries.'''
+    def purge_validations(self, expire, limit, budget):
+        '''
+        Purges validation entries older than expire seconds, limit rows at a
+        time, for at most budget seconds. Returns a Deferred fired with
+        (rows, seconds, complete).
+        '''
+        pass
+
+    def purge_deliveries(self, expire, limit, budget):
+        '''
+        Gives up deliveries of generic messages to resources not seen for
+        expire seconds, deleting the messages acknowledged by every other
+        resource, limit rows at a time, for at most budget seconds.
+        Returns a Deferred fired with (rows, seconds, complete).
+        '''
+        pass
+
+    def cache_stats(self):
+        '''Returns message cache statistics, if any.'''
         pass
 
 
@@ -119,15 +184,44 @@ class PersistentDictStorage(MessageStorage):
 
     def load(self, uid):
         try:
-            return self._get_storage(uid, 'r', False, False)
+            return defer.succeed(self._get_storage(uid, 'r', False, False))
         except:
-            return None
+            return defer.succeed(None)
+
+    def load_page(self, uid, cursor = None, max_size = 262144, max_rows = 500):
+        try:
+            db = self._get_storage(uid, 'r', False, False)
+        except:
+            return defer.succeed(([], None))
+
+        msglist = sorted(db.itervalues(), key=lambda msg: (msg['timestamp'], msg['messageid']))
+        if cursor:
+            msglist = [msg for msg in msglist if (msg['timestamp'], msg['messageid']) > cursor]
+
+        page = []
+        size = 0
+        for msg in msglist[:max_rows]:
+            size += len(msg['payload'])
+            if page and size > max_size:
+                break
+            page.append(msg)
+
+        next_cursor = None
+        if len(page) < len(msglist):
+            next_cursor = (page[-1]['timestamp'], page[-1]['messageid'])
+        return defer.succeed((page, next_cursor))
 
     def store(self, uid, msg, force = False):
         db = self._get_storage(uid)
         if msg['messageid'] not in db or force:
             db[msg['messageid']] = msg
             db.sync()
+        return defer.succeed(None)
+
+    def store_messages(self, msglist, force = False):
+        for msg in msglist:
+            self.store(msg['recipient'], msg, force)
+        return defer.succeed(None)
 
     def deliver(self, userid, msg, force = False):
         # store the new message
@@ -143,6 +237,11 @@ class PersistentDictStorage(MessageStorage):
             db.sync()
         except:
             pass
+        return defer.succeed(None)
+
+    def get_messages(self, uid, msgid_list):
+        db = self._get_storage(uid)
+        return defer.succeed([db[msgid] for msgid in msgid_list if msgid in db])
 
     def delete(self, uid, msgid):
         try:
@@ -152,6 +251,12 @@ class PersistentDictStorage(MessageStorage):
         except:
             import traceback
             traceback.print_exc()
+        return defer.succeed(None)
+
+    def delete_messages(self, uid, msgid_list):
+        for msgid in msgid_list:
+            self.delete(uid, msgid)
+        return defer.succeed(None)
 
     def extra_storage(self, uids, mime, content, name = None):
         if not name:
@@ -160,24 +265,141 @@ class PersistentDictStorage(MessageStorage):
         f = open(filename, 'w')
         f.write(content)
         f.close()
-        return (filename, name)
+        return defer.succeed((filename, name))
 
     def get_extra(self, name, uid):
         '''Returns the full path of a file in the extra storage.'''
-        return os.path.join(self._extra_path, name), None, None
+        return defer.succeed((os.path.join(self._extra_path, name), None, None))
 
     def touch_user(self, uid):
         # TODO
         pass
 
 
+class MessageCache:
+    '''
+    Per-user message cache.
+    Every user has its own map of messages keyed by message id and kept in
+    insertion order. Users are evicted in least recently used order when the
+    estimated size of all cached messages exceeds the byte budget.
+    '''
+
+    '''Estimated fixed memory cost of a cached message.'''
+    ROW_OVERHEAD = 512
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        '''Estimated size of all cached messages.'''
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        '''User mailboxes in least recently used order.'''
+        self._users = OrderedDict()
+        '''Estimated size of every user mailbox.'''
+        self._sizes = {}
+
+    def _row_size(self, row):
+        size = self.ROW_OVERHEAD
+        for value in row.itervalues():
+            if isinstance(value, basestring):
+                size += len(value)
+        return size
+
+    def _evict(self):
+        while self.size > self.max_size and len(self._users) > 0:
+            uid, mbox = self._users.popitem(False)
+            self.size -= self._sizes.pop(uid)
+            self.evictions += 1
+
+    def get(self, uid):
+        '''Returns the cached mailbox of a user, or None.'''
+        try:
+            mbox = self._users.pop(uid)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        # most recently used
+        self._users[uid] = mbox
+        self.hits += 1
+        return mbox
+
+    def set(self, uid, rows):
+        '''Caches the whole mailbox of a user.'''
+        self.invalidate(uid)
+        mbox = OrderedDict()
+        size = 0
+        for row in rows:
+            mbox[row['id']] = row
+            size += self._row_size(row)
+
+        self._users[uid] = mbox
+        self._sizes[uid] = size
+        self.size += size
+        self._evict()
+
+    def add(self, uid, row):
+        '''Appends a message to a cached mailbox. Uncached users are left alone.'''
+        mbox = self._users.get(uid)
+        if mbox is not None:
+            if row['id'] in mbox:
+                self.remove(uid, row['id'])
+            size = self._row_size(row)
+            mbox[row['id']] = row
+            self._sizes[uid] += size
+            self.size += size
+            self._evict()
+
+    def remove(self, uid, msgid):
+        '''Removes a message from a cached mailbox.'''
+        mbox = self._users.get(uid)
+        if mbox is not None:
+            row = mbox.pop(msgid, None)
+            if row is not None:
+                size = self._row_size(row)
+                self._sizes[uid] -= size
+                self.size -= size
+
+    def invalidate(self, uid):
+        '''Drops the cached mailbox of a user.'''
+        if uid in self._users:
+            del self._users[uid]
+            self.size -= self._sizes.pop(uid)
+
+    def stats(self):
+        return {
+            'users' : len(self._users),
+            'size' : self.size,
+            'max_size' : self.max_size,
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions
+        }
+
+
 class MySQLStorage(MessageStorage):
-    '''MySQL-based message storage.'''
+    '''MySQL-based message storage.
+    Queries are run on a dbpool.ConnectionPool datasource.
+    '''
+
+    '''Payload bytes after which a multi-row INSERT is split.'''
+    INSERT_CHUNK_SIZE = 1048576
+    '''Rows after which a multi-row INSERT is split.'''
+    INSERT_CHUNK_ROWS = 1000
 
-    def __init__(self, path, db = None):
+    '''Messages joined with their shared payload, if any.'''
+    SELECT_MESSAGES = ('SELECT m.*, s.content AS shared_content FROM messages m '
+        'LEFT JOIN message_content s ON s.hash = m.content_hash ')
+
+    def __init__(self, path, cache_size = 10485760, db = None):
         log.debug("init MySQL storage")
         '''User messages cache.'''
-        self._cache = {}
+        self._cache = MessageCache(cache_size)
+        '''Mailbox loads in progress: uid -> [pending loads, written meanwhile].'''
+        self._loading = {}
+        '''Position of the TTL scan of the messages purger, resumed by the next run.'''
+        self._ttl_scan = { 'last' : '' }
         self._extra_path = path
         try:
             os.makedirs(self._extra_path)
@@ -185,35 +407,32 @@ class MySQLStorage(MessageStorage):
             pass
 
         self._db = db
-        self._update_ds()
 
     def set_datasource(self, ds):
+        # tables and columns used here are created by schema.upgrade
         self._db = ds
-        self._update_ds()
-
-    def _update_ds(self):
-        if self._db:
-            self.userdb = database.usercache(self._db)
-            self.msgdb = database.messages(self._db)
-            self.attdb = database.attachments(self._db)
-            self.valdb = database.validations(self._db)
-        else:
-            self.userdb = None
-            self.msgdb = None
-            self.attdb = None
-            self.valdb = None
 
     def _invalidate(self, uid, msgid = None):
-        try:
-            if msgid:
-                for i in range(len(self._cache[uid])):
-                    if self._cache[uid][i]['id'] == msgid:
-                        del self._cache[uid][i]
-                        break
-            else:
-                del self._cache[uid]
-        except:
-            pass
+        if msgid:
+            self._cache.remove(uid, msgid)
+        else:
+            self._cache.invalidate(uid)
+
+    def _purged(self, uids):
+        '''Called in the reactor thread when purgers changed the mailbox of some users.'''
+        for uid in uids:
+            self._written(uid)
+            self._invalidate(uid)
+
+    def _written(self, uid):
+        '''Called when a write to a user mailbox has been completed.'''
+        # a mailbox being loaded now might miss this write
+        if uid in self._loading:
+            self._loading[uid][1] = True
+
+    def cache_stats(self):
+        '''Returns message cache statistics.'''
+        return self._cache.stats()
 
     def stop(self, uid):
         '''Invalidates user message cache.'''
@@ -246,7 +465,10 @@ class MySQLStorage(MessageStorage):
             dm['headers']['filename'] = msg['filename']
 
         # payload
-        dm['payload'] = msg['content']
+        if msg.get('shared_content') is not None:
+            dm['payload'] = msg['shared_content']
+        else:
+            dm['payload'] = msg['content']
         return dm
 
     def load(self, uid):
@@ -254,55 +476,366 @@ class MySQLStorage(MessageStorage):
 
         # special case: null uid -- retrieve message count by userid
         if not uid:
-            msglist = self.msgdb.need_notification()
-            msgdict = {}
-            for msg in msglist:
-                msgdict[msg['recipient']] = msg['num']
-            return msgdict
+            def _count(msglist):
+                msgdict = {}
+                for msg in msglist:
+                    msgdict[msg['recipient']] = msg['num']
+                return msgdict
+
+            d = self._db.run_query(database.messages, 'need_notification')
+            d.addCallback(_count)
+            return d
         # retrieve messages ordered by timestamp
         else:
-            try:
-                msglist = self._cache[uid]
-            except KeyError:
-                msglist = self.msgdb.incoming(uid, True)
-                self._cache[uid] = msglist
+            def _format(msglist):
+                return [self._format_msg(msg) for msg in msglist]
 
+            mbox = self._cache.get(uid)
+            if mbox is not None:
+                d = defer.succeed(mbox.values())
+            else:
+                d = self._load_mailbox(uid, lambda rows: True, self._select_mailbox)
+
+            d.addCallback(_format)
+            return d
+
+    def _load_mailbox(self, uid, complete, select, *args):
+        '''
+        Runs select(conn, uid, *args) in a pool thread and caches the rows if
+        complete(rows) is true, i.e. they are the whole mailbox, unless
+        messages were written in the meantime.
+        '''
+        def _cache(rows):
+            # do not cache if messages were written in the meantime
+            if complete(rows) and not self._loading[uid][1]:
+                self._cache.set(uid, rows)
+            return rows
+
+        def _loaded(result):
+            loading = self._loading[uid]
+            loading[0] -= 1
+            if loading[0] == 0:
+                del self._loading[uid]
+            return result
+
+        self._loading.setdefault(uid, [0, False])[0] += 1
+        d = self._db.runWithConnection(select, uid, *args)
+        d.addCallback(_cache)
+        d.addBoth(_loaded)
+        return d
+
+    def load_page(self, uid, cursor = None, max_size = 262144, max_rows = 500):
+        '''
+        Loads a page of the messages of a userid, ordered by timestamp.
+        Pages are read from the cached mailbox if available, otherwise with a
+        keyset query starting after cursor. A first page holding the whole
+        mailbox is cached.
+        '''
+        def _page(rows):
+            page = []
+            size = 0
+            for row in rows:
+                content = row.get('shared_content') or row['content']
+                if content:
+                    size += len(content)
+                if page and size > max_size:
+                    break
+                page.append(row)
+
+            next_cursor = None
+            if len(page) < len(rows) or len(rows) == max_rows:
+                next_cursor = (page[-1]['timestamp'], page[-1]['id'])
+            return [self._format_msg(row) for row in page], next_cursor
+
+        mbox = self._cache.get(uid)
+        if mbox is not None:
+            rows = sorted(mbox.itervalues(), key=lambda row: (row['timestamp'], row['id']))
+            if cursor:
+                rows = [row for row in rows if (row['timestamp'], row['id']) > cursor]
+            d = defer.succeed(rows[:max_rows])
+        elif cursor is None:
+            d = self._load_mailbox(uid, lambda rows: len(rows) < max_rows,
+                self._select_page, None, max_rows)
+        else:
+            d = self._db.runWithConnection(self._select_page, uid, cursor, max_rows)
+
+        d.addCallback(_page)
+        return d
+
+    def _select_mailbox(self, conn, uid):
+        '''Selects all the messages of a userid (runs in a pool thread).'''
+        c = conn.cursor(oursql.DictCursor)
+        c.execute(self.SELECT_MESSAGES + 'WHERE m.recipient = ? '
+            'ORDER BY m.timestamp, m.id', (uid, ))
+        return c.fetchall()
+
+    def _select_page(self, conn, uid, cursor, max_rows):
+        '''Selects a page of the messages of a userid (runs in a pool thread).'''
+        c = conn.cursor(oursql.DictCursor)
+        if cursor:
+            timestamp, msgid = cursor
+            c.execute(self.SELECT_MESSAGES + 'WHERE m.recipient = ? AND '
+                '(m.timestamp > ? OR (m.timestamp = ? AND m.id > ?)) '
+                'ORDER BY m.timestamp, m.id LIMIT ?',
+                (uid, timestamp, timestamp, msgid, max_rows))
+        else:
+            c.execute(self.SELECT_MESSAGES + 'WHERE m.recipient = ? '
+                'ORDER BY m.timestamp, m.id LIMIT ?', (uid, max_rows))
+        return c.fetchall()
+
+    def get_messages(self, uid, msgid_list):
+        '''Loads only the given messages of a userid.'''
+        def _format(msglist):
             return [self._format_msg(msg) for msg in msglist]
 
+        if not msgid_list:
+            return defer.succeed([])
+
+        mbox = self._cache.get(uid)
+        if mbox is not None:
+            # cached mailboxes are complete
+            d = defer.succeed([mbox[msgid] for msgid in msgid_list if msgid in mbox])
+        else:
+            d = self._db.runWithConnection(self._select_messages, uid, msgid_list)
+
+        d.addCallback(_format)
+        return d
+
+    def _select_messages(self, conn, uid, msgid_list):
+        '''Selects the given messages of a userid (runs in a pool thread).'''
+        c = conn.cursor(oursql.DictCursor)
+        c.execute(self.SELECT_MESSAGES + 'WHERE m.recipient = ? AND m.id IN (%s)' %
+            ', '.join(['?'] * len(msgid_list)), [uid] + list(msgid_list))
+        return c.fetchall()
+
+    def _message_row(self, uid, msg):
+        '''Converts a broker message to a row of the messages table.'''
+        return {
+            'id' : msg['messageid'],
+            'timestamp' : msg['timestamp'],
+            'orig_id' : utils.dict_get_none(msg, 'originalid'),
+            'sender' : msg['sender'],
+            'recipient' : uid,
+            'need_ack' : msg['need_ack'],
+            'mime' : msg['headers']['mime'],
+            # FIXME TTL self-managed!?!?!?
+            'ttl' : 100,
+            'encrypted' : 'encrypted' in msg['headers']['flags'],
+            'filename' : utils.dict_get_none(msg['headers'], 'filename'),
+            'content' : msg['payload']
+        }
+
+    def _insert_rows(self, conn, rows):
+        '''
+        Inserts rows in the messages table with multi-row INSERTs (runs in a pool thread).
+        Payloads are stored once in the message_content table, by hash, and
+        counted once for every row referencing them.
+        '''
+        c = conn.cursor()
+        # payloads by hash, with the number of rows referencing them
+        contents = OrderedDict()
+        # recipients usually share the same payload object
+        digests = {}
+        entries = []
+        for row in rows:
+            content = row['content']
+            if content:
+                digest = digests.get(id(content))
+                if digest is None:
+                    digest = digests[id(content)] = hashlib.sha1(content).digest()
+                if digest in contents:
+                    contents[digest][1] += 1
+                else:
+                    contents[digest] = [content, 1]
+                entries.append((row, None, digest))
+            else:
+                entries.append((row, content, None))
+
+        if contents:
+            self._insert_contents(c, contents)
+        for i in xrange(0, len(entries), self.INSERT_CHUNK_ROWS):
+            self._insert_chunk(c, entries[i:i + self.INSERT_CHUNK_ROWS])
+
+    def _insert_contents(self, c, contents):
+        '''Inserts payloads or increments their refcount if already stored.'''
+        chunk = []
+        size = 0
+        for digest, (content, refs) in contents.iteritems():
+            chunk.append((digest, content, refs))
+            size += len(content)
+            if size >= self.INSERT_CHUNK_SIZE or len(chunk) >= self.INSERT_CHUNK_ROWS:
+                self._insert_contents_chunk(c, chunk)
+                chunk = []
+                size = 0
+
+        if chunk:
+            self._insert_contents_chunk(c, chunk)
+
+    def _insert_contents_chunk(self, c, rows):
+        values = []
+        for row in rows:
+            values.extend(row)
+
+        c.execute('INSERT INTO message_content (hash, content, refcount) VALUES %s '
+            'ON DUPLICATE KEY UPDATE refcount = refcount + VALUES(refcount)' %
+            ', '.join(['(?, ?, ?)'] * len(rows)), values)
+
+    def _insert_chunk(self, c, rows):
+        values = []
+        for row, content, digest in rows:
+            values.extend((
+                row['id'],
+                database.format_timestamp(row['timestamp']),
+                row['sender'],
+                row['recipient'],
+                None,   # TODO groups
+                row['mime'],
+                content,
+                digest,
+                row['encrypted'],
+                row['filename'],
+                row['ttl'],
+                row['need_ack'],
+                row['orig_id']))
+
+        c.execute('INSERT INTO messages (id, timestamp, sender, recipient, `group`, mime, '
+            'content, content_hash, encrypted, filename, ttl, need_ack, orig_id) VALUES %s' %
+            ', '.join(['(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'] * len(rows)), values)
+
     def store(self, uid, msg, force = False):
         '''Used to persist a message.'''
-        orig_id = utils.dict_get_none(msg, 'originalid')
-        filename = utils.dict_get_none(msg['headers'], 'filename')
-        encrypted = 'encrypted' in msg['headers']['flags']
-        self.msgdb.insert(
-            msg['messageid'],
-            database.format_timestamp(msg['timestamp']),
-            msg['sender'],
-            uid,
-            None,   # TODO groups
-            msg['headers']['mime'],
-            msg['payload'],
-            encrypted,
-            filename,
-            # FIXME TTL self-managed!?!?!?
-            100,
-            msg['need_ack'],
-            orig_id)
-        # too much caching can kill you :)
-        self._invalidate(uid)
+        return self._store_rows([self._message_row(uid, msg)])
+
+    def store_messages(self, msglist, force = False):
+        '''
+        Used to persist several messages at once, each one for its recipient.
+        Messages are written with as few INSERTs as possible in a single transaction.
+        '''
+        return self._store_rows([self._message_row(msg['recipient'], msg) for msg in msglist])
+
+    def _store_rows(self, rows):
+        uids = set([row['recipient'] for row in rows])
+
+        def _cache(result):
+            for uid in uids:
+                self._written(uid)
+            for row in rows:
+                self._cache.add(row['recipient'], row)
+            return result
+
+        def _invalidate(failure):
+            # we don't know what happened - reload on next access
+            for uid in uids:
+                self._written(uid)
+                self._invalidate(uid)
+            return failure
+
+        if not rows:
+            return defer.succeed(None)
+
+        d = self._db.runWithConnection(self._insert_rows, rows)
+        d.addCallbacks(_cache, _invalidate)
+        return d
 
     def deliver(self, userid, msg, force = False):
         '''Used to persist a message that was intended to a generic userid.'''
         # store again with specific userid
-        self.store(userid, msg, force)
+        d = self.store(userid, msg, force)
         # delete old generic message
-        self.msgdb.delete(msg['originalid'])
+        d.addCallback(lambda _: self.delete(userid[:utils.USERID_LENGTH], msg['originalid']))
+        return d
 
     def delete(self, uid, msgid):
         '''Deletes a single message.'''
-        self.msgdb.delete(msgid)
-        # too much caching can kill you :)
+        def _deleted(result):
+            self._written(uid)
+            self._invalidate(uid, msgid)
+            return result
+
         self._invalidate(uid, msgid)
+        d = self._db.runWithConnection(self._delete_messages, [msgid])
+        d.addBoth(_deleted)
+        return d
+
+    def delete_messages(self, uid, msgid_list):
+        '''Deletes several messages at once.'''
+        def _deleted(result):
+            self._written(uid)
+            for msgid in msgid_list:
+                self._invalidate(uid, msgid)
+            return result
+
+        if not msgid_list:
+            return defer.succeed(None)
+
+        for msgid in msgid_list:
+            self._invalidate(uid, msgid)
+        d = self._db.runWithConnection(self._delete_messages, msgid_list)
+        d.addBoth(_deleted)
+        return d
+
+    def _delete_messages(self, conn, msgid_list):
+        '''
+        Deletes the given messages, releasing their shared payloads
+        (runs in a pool thread).
+        '''
+        c = conn.cursor()
+        marks = ', '.join(['?'] * len(msgid_list))
+        # lock the rows so concurrent deletes release payloads only once
+        c.execute('SELECT content_hash, COUNT(*) FROM messages WHERE id IN (%s) AND '
+            'content_hash IS NOT NULL GROUP BY content_hash FOR UPDATE' % marks, list(msgid_list))
+        refs = c.fetchall()
+        c.execute('DELETE FROM messages WHERE id IN (%s)' % marks, list(msgid_list))
+        count = c.rowcount
+        c.execute('DELETE FROM message_deliveries WHERE msgid IN (%s)' % marks, list(msgid_list))
+        self._release_content(c, refs)
+        return count
+
+    def _release_content(self, c, refs):
+        '''Decrements the refcount of shared payloads, deleting unreferenced ones.'''
+        for digest, count in refs:
+            c.execute('UPDATE message_content SET refcount = refcount - ? WHERE hash = ?',
+                (count, digest))
+        if refs:
+            c.execute('DELETE FROM message_content WHERE refcount = 0 AND hash IN (%s)' %
+                ', '.join(['?'] * len(refs)), [digest for digest, count in refs])
+
+    def get_deliveries(self, msgid_list):
+        '''
+        Returns the resources generic messages were delivered to, as a dict
+        of msgid: {resource: acknowledged}.
+        '''
+        if not msgid_list:
+            return defer.succeed({})
+        return self._db.runWithConnection(self._select_deliveries, msgid_list)
+
+    def _select_deliveries(self, conn, msgid_list):
+        c = conn.cursor()
+        c.execute('SELECT msgid, resource, acked FROM message_deliveries WHERE msgid IN (%s)' %
+            ', '.join(['?'] * len(msgid_list)), list(msgid_list))
+        deliveries = {}
+        for msgid, resource, acked in c.fetchall():
+            deliveries.setdefault(msgid, {})[resource] = bool(acked)
+        return deliveries
+
+    def update_deliveries(self, entries):
+        '''
+        Records deliveries of generic messages to resources, as a list of
+        (msgid, resource, acknowledged). Acknowledgements are never reset.
+        '''
+        if not entries:
+            return defer.succeed(None)
+        return self._db.runWithConnection(self._update_deliveries, entries)
+
+    def _update_deliveries(self, conn, entries):
+        values = []
+        for msgid, resource, acked in entries:
+            values.extend((msgid, resource, acked))
+
+        c = conn.cursor()
+        c.execute('INSERT INTO message_deliveries (msgid, resource, acked) VALUES %s '
+            'ON DUPLICATE KEY UPDATE acked = GREATEST(acked, VALUES(acked))' %
+            ', '.join(['(?, ?, ?)'] * len(entries)), values)
 
     def extra_storage(self, uids, mime, content, name = None):
         '''Store a big file in the storage system.'''
@@ -321,41 +854,157 @@ class MySQLStorage(MessageStorage):
         md5sum = utils.md5sum(filename)
 
         # store in attachments
-        for rcpt in uids:
-            # TODO check insert errors
-            self.attdb.insert(rcpt[:utils.USERID_LENGTH], name, mime, md5sum)
+        def _insert(conn):
+            attdb = database.attachments(conn)
+            for rcpt in uids:
+                # TODO check insert errors
+                attdb.insert(rcpt[:utils.USERID_LENGTH], name, mime, md5sum)
+            return (filename, name)
 
-        return (filename, name)
+        return self._db.runWithConnection(_insert)
 
     def update_extra_storage(self, name, uids):
         '''Updates local storage data with the supplied uids.'''
-        # retrieve unmanaged attachment
-        att = self.attdb.get(name, '')
-        if att:
-            for u in uids:
-                try:
-                    self.attdb.insert(u[:utils.USERID_LENGTH], name, att['mime'], att['md5sum'])
-                except:
-                    pass
-            self.attdb.delete(name, '')
+        def _update(conn):
+            attdb = database.attachments(conn)
+            # retrieve unmanaged attachment
+            att = attdb.get(name, '')
+            if att:
+                for u in uids:
+                    try:
+                        attdb.insert(u[:utils.USERID_LENGTH], name, att['mime'], att['md5sum'])
+                    except:
+                        pass
+                attdb.delete(name, '')
+
+        return self._db.runWithConnection(_update)
 
     def get_extra(self, name, uid):
         '''Returns the full path of a file in the extra storage.'''
-        att = self.attdb.get(name, uid)
-        if att:
-            return str(os.path.join(self._extra_path, att['filename'])), str(att['mime']), str(att['md5sum'])
+        def _path(att):
+            if att:
+                return str(os.path.join(self._extra_path, att['filename'])), str(att['mime']), str(att['md5sum'])
 
-    def purge_messages(self):
-        '''Purges expired/unknown messages.'''
-        # decrease TTL for messages without a usercache entry
-        self.msgdb.ttl_expired()
-        # delete expired messages
-        self.msgdb.purge_expired(1)
+        d = self._db.run_query(database.attachments, 'get', name, uid)
+        d.addCallback(_path)
+        return d
 
-    def purge_extra(self):
+    def purge_messages(self, limit, budget):
+        '''Purges expired/unknown messages.'''
+        def _delete(ttl_result):
+            # delete expired messages in chunks
+            ttl_rows, ttl_seconds, ttl_complete = ttl_result
+            d = self._db.run_chunked(self._purge_expired, limit, max(budget - ttl_seconds, 0))
+            d.addCallback(lambda (rows, seconds, complete):
+                (rows + ttl_rows, seconds + ttl_seconds, complete and ttl_complete))
+            return d
+
+        d = self._db.run_chunked(self._decrease_ttl, limit, budget, self._ttl_scan)
+        d.addCallback(_delete)
+        return d
+
+    def _decrease_ttl(self, conn, limit, scan):
+        '''
+        Decreases TTL of the next limit messages whose recipient has no
+        usercache entry. Every message is decreased once per complete scan,
+        even if the scan spans several purger runs.
+        '''
+        c = conn.cursor()
+        c.execute('SELECT id FROM messages WHERE id > ? ORDER BY id LIMIT ?', (scan['last'], limit))
+        msgid_list = [row[0] for row in c.fetchall()]
+        if msgid_list:
+            where = ('m.id IN (%s) AND m.ttl > 0 AND NOT EXISTS '
+                '(SELECT 1 FROM usercache u WHERE u.userid LIKE CONCAT(m.recipient, ?))' %
+                ', '.join(['?'] * len(msgid_list)))
+            c.execute('SELECT DISTINCT m.recipient FROM messages m WHERE ' + where,
+                list(msgid_list) + ['%'])
+            uids = [row[0] for row in c.fetchall()]
+            c.execute('UPDATE messages m SET m.ttl = m.ttl - 1 WHERE ' + where,
+                list(msgid_list) + ['%'])
+            if uids:
+                # cached mailboxes hold the old TTL
+                reactor.callFromThread(self._purged, uids)
+
+        # start over on next run when the end is reached
+        scan['last'] = msgid_list[-1] if len(msgid_list) == limit else ''
+        return len(msgid_list)
+
+    def _purge_expired(self, conn, limit):
+        c = conn.cursor()
+        c.execute('SELECT id, recipient FROM messages WHERE ttl < ? LIMIT ?', (1, limit))
+        rows = c.fetchall()
+        if not rows:
+            return 0
+        count = self._delete_messages(conn, [msgid for msgid, recipient in rows])
+        reactor.callFromThread(self._purged, set([recipient for msgid, recipient in rows]))
+        return count
+
+    def purge_extra(self, expire, limit, budget):
         '''Purges expired/orphan files on extra storage.'''
-        return self.attdb.purge_expired()
+        cutoff = datetime.fromtimestamp(time.time() - expire)
+        return self._db.run_chunked(self._purge_attachments, limit, budget, cutoff)
+
+    def _purge_attachments(self, conn, limit, cutoff):
+        c = conn.cursor()
+        c.execute('SELECT DISTINCT filename FROM attachments WHERE timestamp < ? LIMIT ?', (cutoff, limit))
+        names = [row[0] for row in c.fetchall()]
+        if not names:
+            return 0
+
+        marks = ', '.join(['?'] * len(names))
+        c.execute('DELETE FROM attachments WHERE timestamp < ? AND filename IN (%s)' % marks,
+            [cutoff] + names)
+        # files might still be shared with newer entries
+        c.execute('SELECT DISTINCT filename FROM attachments WHERE filename IN (%s)' % marks, names)
+        used = set([row[0] for row in c.fetchall()])
+        for name in names:
+            if name not in used:
+                try:
+                    os.remove(os.path.join(self._extra_path, name))
+                except OSError:
+                    pass
+
+        return len(names)
 
-    def purge_validations(self):
+    def purge_validations(self, expire, limit, budget):
         '''Purges old validation entries.'''
-        return self.valdb.purge_expired()
+        cutoff = datetime.fromtimestamp(time.time() - expire)
+        return self._db.run_chunked(self._purge_validations, limit, budget, cutoff)
+
+    def _purge_validations(self, conn, limit, cutoff):
+        c = conn.cursor()
+        c.execute('DELETE FROM validations WHERE timestamp < ? LIMIT ?', (cutoff, limit))
+        return c.rowcount
+
+    def purge_deliveries(self, expire, limit, budget):
+        '''Gives up deliveries to resources gone for too long.'''
+        cutoff = datetime.fromtimestamp(time.time() - expire)
+        return self._db.run_chunked(self._expire_deliveries, limit, budget, cutoff)
+
+    def _expire_deliveries(self, conn, limit, cutoff):
+        c = conn.cursor()
+        # resources are gone if their last seen time is older than cutoff
+        c.execute('SELECT d.msgid, d.resource, m.recipient FROM message_deliveries d '
+            'JOIN messages m ON m.id = d.msgid '
+            'JOIN usercache u ON u.userid = CONCAT(m.recipient, d.resource) '
+            'WHERE d.acked = 0 AND u.timestamp < ? LIMIT ?', (cutoff, limit))
+        rows = c.fetchall()
+        if not rows:
+            return 0
+
+        # mark them acknowledged: the message is kept for the other resources
+        values = []
+        for msgid, resource, recipient in rows:
+            values.extend((msgid, resource))
+        c.execute('UPDATE message_deliveries SET acked = 1 WHERE (msgid, resource) IN (%s)' %
+            ', '.join(['(?, ?)'] * len(rows)), values)
+
+        recipients = dict((msgid, recipient) for msgid, resource, recipient in rows)
+        c.execute('SELECT msgid FROM message_deliveries WHERE msgid IN (%s) '
+            'GROUP BY msgid HAVING MIN(acked) = 1' % ', '.join(['?'] * len(recipients)),
+            recipients.keys())
+        msgid_list = [row[0] for row in c.fetchall()]
+        if msgid_list:
+            self._delete_messages(conn, msgid_list)
+            reactor.callFromThread(self._purged, set([recipients[msgid] for msgid in msgid_list]))
+        return len(rows)
@@ -20,12 +20,19 @@
 
 
 import os, time
+from datetime import datetime
+from twisted.internet import defer
+import oursql
 from kontalklib import database, utils
 import kontalklib.logging as log
 
+from cache import ExpiringCache, MISSING
+
 
 class Usercache:
-    '''Interface for a usercache storage.'''
+    '''Interface for a usercache storage.
+    Methods accessing the datasource return a Deferred.
+    '''
 
     def set_datasource(self, ds):
         '''Sets a datasource after-init.'''
@@ -39,6 +46,14 @@ class Usercache:
         '''Updates user last seen time to now.'''
         pass
 
+    def touch_users(self, timestamps):
+        '''Updates last seen time of several users at once (dict of userid: timestamp).'''
+        pass
+
+    def flush(self):
+        '''Writes pending updates to the datasource.'''
+        pass
+
     def set_user_data(self, userid, fields):
         '''Updates data of a user.'''
         pass
@@ -47,13 +62,27 @@ class Usercache:
         '''Retrieves user data.'''
         pass
 
-    def purge_users(self):
-        '''Purges old user entries.'''
+    def get_user_data_many(self, uids):
+        '''Retrieves data of several users: a list with an entry (or None) for every uid.'''
+        pass
+
+    def purge_users(self, expire, limit, budget):
+        '''
+        Purges user entries not seen for expire seconds, limit rows at a time,
+        for at most budget seconds. Returns a Deferred fired with (rows, seconds, complete).
+        '''
         pass
 
 
 class MySQLUsercache(Usercache):
-    '''MySQL-based usercache.'''
+    '''MySQL-based usercache.
+    Queries are run on a dbpool.ConnectionPool datasource.
+    '''
+
+    '''Rows updated by a single statement when touching several users.'''
+    TOUCH_CHUNK_SIZE = 500
+    '''Users looked up by a single statement.'''
+    LOOKUP_CHUNK_SIZE = 200
 
     def __init__(self, db = None):
         log.debug("init MySQL usercache")
@@ -61,34 +90,259 @@ class MySQLUsercache(Usercache):
 
     def set_datasource(self, ds):
         self._db = ds
-        self._update_ds()
 
     def unique_users(self):
-        return self.userdb.unique_users_count()
-
-    def _update_ds(self):
-        if self._db:
-            self.userdb = database.usercache(self._db)
-        else:
-            self.userdb = None
+        return self._db.run_query(database.usercache, 'unique_users_count')
 
     def touch_user(self, userid):
         '''Updates user last seen time to now.'''
         if len(userid) == utils.USERID_LENGTH_RESOURCE:
-            self.userdb.update(userid)
+            return self._db.run_query(database.usercache, 'update', userid)
+        return defer.succeed(None)
+
+    def touch_users(self, timestamps):
+        '''Updates last seen time of several users at once (dict of userid: timestamp).'''
+        rows = [(userid, datetime.fromtimestamp(ts)) for userid, ts in timestamps.iteritems()
+            if len(userid) == utils.USERID_LENGTH_RESOURCE]
+        if not rows:
+            return defer.succeed(None)
+        return self._db.runWithConnection(self._touch_users, rows)
+
+    def _touch_users(self, conn, rows):
+        '''Inserts or updates last seen times (runs in a pool thread).'''
+        c = conn.cursor()
+        for i in range(0, len(rows), self.TOUCH_CHUNK_SIZE):
+            chunk = rows[i:i + self.TOUCH_CHUNK_SIZE]
+            c.execute('INSERT INTO usercache (userid, timestamp) VALUES %s '
+                'ON DUPLICATE KEY UPDATE timestamp = VALUES(timestamp)' %
+                ', '.join(['(?, ?)'] * len(chunk)), [v for row in chunk for v in row])
+
+    def flush(self):
+        return defer.succeed(None)
 
     def set_user_data(self, userid, fields):
         '''Updates data of a user.'''
         if len(userid) == utils.USERID_LENGTH_RESOURCE:
-            self.userdb.update(userid, None, **fields)
+            return self._db.run_query(database.usercache, 'update', userid, None, **fields)
+        return defer.succeed(None)
 
-    def get_user_data(self, uid):
-        '''Retrieves user data.'''
-        dd = self.userdb.get(uid, False)
+    def _format(self, dd):
         if dd:
             dd['timestamp'] = long(time.mktime(dd['timestamp'].timetuple()))
         return dd
 
-    def purge_users(self):
+    def get_user_data(self, uid):
+        '''Retrieves user data.'''
+        d = self._db.run_query(database.usercache, 'get', uid, False)
+        d.addCallback(self._format)
+        return d
+
+    def get_user_data_many(self, uids):
+        '''
+        Retrieves data of several users with a few chunked queries.
+        Generic userids get the data of their most recently seen resource.
+        '''
+        def _found(rows):
+            # most recent entry for every specific and generic userid
+            found = {}
+            for row in rows:
+                row = self._format(row)
+                for key in (row['userid'], row['userid'][:utils.USERID_LENGTH]):
+                    if key not in found or found[key]['timestamp'] < row['timestamp']:
+                        found[key] = row
+            return [found.get(uid) for uid in uids]
+
+        if not uids:
+            return defer.succeed([])
+        d = self._db.runWithConnection(self._select_users, list(set(uids)))
+        d.addCallback(_found)
+        return d
+
+    def _select_users(self, conn, uids):
+        '''Selects usercache entries of the given userids (runs in a pool thread).'''
+        c = conn.cursor(oursql.DictCursor)
+        specific = [uid for uid in uids if len(uid) == utils.USERID_LENGTH_RESOURCE]
+        generic = [uid + '%' for uid in uids if len(uid) == utils.USERID_LENGTH]
+
+        rows = []
+        for i in range(0, len(specific), self.LOOKUP_CHUNK_SIZE):
+            chunk = specific[i:i + self.LOOKUP_CHUNK_SIZE]
+            c.execute('SELECT * FROM usercache WHERE userid IN (%s)' %
+                ', '.join(['?'] * len(chunk)), chunk)
+            rows.extend(c.fetchall())
+
+        for i in range(0, len(generic), self.LOOKUP_CHUNK_SIZE):
+            chunk = generic[i:i + self.LOOKUP_CHUNK_SIZE]
+            # prefix matches on the primary key are index range scans
+            c.execute('SELECT * FROM usercache WHERE %s' %
+                ' OR '.join(['userid LIKE ?'] * len(chunk)), chunk)
+            rows.extend(c.fetchall())
+
+        return rows
+
+    def purge_users(self, expire, limit, budget):
         '''Purges old user entries.'''
-        return self.userdb.purge_old_entries()
+        cutoff = datetime.fromtimestamp(time.time() - expire)
+        return self._db.run_chunked(self._purge_users, limit, budget, cutoff)
+
+    def _purge_users(self, conn, limit, cutoff):
+        c = conn.cursor()
+        c.execute('DELETE FROM usercache WHERE timestamp < ? LIMIT ?', (cutoff, limit))
+        return c.rowcount
+
+
+class CachedUsercache(Usercache):
+    '''
+    In-memory usercache layer in front of another usercache.
+    User data is cached for a limited time and evicted in least recently
+    used order; writes update cached entries in place. Last seen times are
+    kept in memory and written in batches by flush().
+    '''
+
+    def __init__(self, usercache, ttl, max_entries):
+        self._usercache = usercache
+        self.hits = 0
+        self.misses = 0
+        self.flushed = 0
+        '''Cached user data: uid -> data (None if the user is not known).'''
+        self._entries = ExpiringCache(ttl, max_entries)
+        '''Last seen times waiting to be written: userid -> timestamp.'''
+        self._touched = {}
+        '''Last seen time not written yet by user hash: uhash -> (userid, timestamp).'''
+        self._last_seen = {}
+
+    def set_datasource(self, ds):
+        self._usercache.set_datasource(ds)
+
+    def unique_users(self):
+        return self._usercache.unique_users()
+
+    def _update(self, userid, fields):
+        '''Updates cached entries of a user and of its generic userid in place.'''
+        for uid in (userid, userid[:utils.USERID_LENGTH]):
+            data = self._entries.get(uid, MISSING)
+            if data is MISSING:
+                continue
+            if data is None:
+                # user was not known: let the next lookup ask the datasource
+                self._entries.pop(uid)
+            else:
+                data.update(fields)
+
+    def touch_user(self, userid):
+        '''Updates user last seen time to now. The datasource is updated by flush().'''
+        if len(userid) == utils.USERID_LENGTH_RESOURCE:
+            now = long(time.time())
+            self._touched[userid] = now
+            self._last_seen[userid[:utils.USERID_LENGTH]] = (userid, now)
+            self._update(userid, { 'timestamp' : now })
+        return defer.succeed(None)
+
+    def touch_users(self, timestamps):
+        for userid, ts in timestamps.iteritems():
+            self.touch_user(userid)
+        return defer.succeed(None)
+
+    def flush(self):
+        '''Writes all pending last seen times in one batch.'''
+        touched = self._touched
+        if not touched:
+            return defer.succeed(None)
+
+        self._touched = {}
+        self.flushed += len(touched)
+
+        def _done(result):
+            for uhash, (userid, ts) in self._last_seen.items():
+                if touched.get(userid) == ts:
+                    del self._last_seen[uhash]
+            return result
+
+        def _error(failure):
+            # try again on next flush, unless touched again meanwhile
+            for userid, ts in touched.iteritems():
+                self._touched.setdefault(userid, ts)
+            return failure
+
+        d = self._usercache.touch_users(touched)
+        d.addCallbacks(_done, _error)
+        return d
+
+    def set_user_data(self, userid, fields):
+        '''Updates data of a user, both in the datasource and in cache.'''
+        if len(userid) == utils.USERID_LENGTH_RESOURCE:
+            self._update(userid, fields)
+        return self._usercache.set_user_data(userid, fields)
+
+    def _seen(self, uid, data):
+        '''Returns a copy of user data with last seen time not written yet.'''
+        if len(uid) == utils.USERID_LENGTH_RESOURCE:
+            ts = self._touched.get(uid)
+            userid = uid
+        else:
+            userid, ts = self._last_seen.get(uid, (None, None))
+        # callers get their own copy
+        if data:
+            data = dict(data)
+        if ts:
+            if not data:
+                data = { 'userid' : userid }
+            data['timestamp'] = ts
+        return data
+
+    def get_user_data(self, uid):
+        '''Retrieves user data, from cache if available.'''
+        data = self._entries.get(uid, MISSING)
+        if data is not MISSING:
+            self.hits += 1
+            return defer.succeed(self._seen(uid, data))
+
+        def _cache(data):
+            self._entries.set(uid, data)
+            return self._seen(uid, data)
+
+        self.misses += 1
+        d = self._usercache.get_user_data(uid)
+        d.addCallback(_cache)
+        return d
+
+    def get_user_data_many(self, uids):
+        '''Retrieves data of several users, asking the datasource only for uncached ones.'''
+        cached = {}
+        missing = []
+        for uid in uids:
+            if uid in cached:
+                continue
+            data = self._entries.get(uid, MISSING)
+            if data is not MISSING:
+                self.hits += 1
+                cached[uid] = data
+            else:
+                self.misses += 1
+                cached[uid] = None
+                missing.append(uid)
+
+        def _cache(result):
+            for uid, data in zip(missing, result):
+                self._entries.set(uid, data)
+                cached[uid] = data
+            return [self._seen(uid, cached[uid]) for uid in uids]
+
+        if missing:
+            d = self._usercache.get_user_data_many(missing)
+        else:
+            d = defer.succeed([])
+        d.addCallback(_cache)
+        return d
+
+    def purge_users(self, expire, limit, budget):
+        return self._usercache.purge_users(expire, limit, budget)
+
+    def stats(self):
+        return {
+            'entries' : len(self._entries),
+            'pending' : len(self._touched),
+            'flushed' : self.flushed,
+            'hits' : self.hits,
+            'misses' : self.misses
+        }